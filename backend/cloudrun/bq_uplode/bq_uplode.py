@@ -1,12 +1,782 @@
+from __future__ import annotations
+
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
-import pandas_gbq
+from fastapi.responses import JSONResponse
 import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import secrets
+import sqlite3
+import importlib
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import defaultdict
 from datetime import datetime, timezone
 import uvicorn
 
-app = FastAPI()
+# ─────────────────────────────────────────────
+# 重いモジュールの遅延インポート（コールドスタート短縮）
+# ─────────────────────────────────────────────
+# モジュール読み込みの開始時刻（起動レポート用）
+MODULE_LOAD_STARTED = time.perf_counter()
+
+class LazyModule:
+    """
+    pandas・BigQuery クライアントの import を初回の属性アクセスまで遅らせるプロキシ。
+    /save_recipe はキューに積むだけで使わないため、書き込みスレッドか lifespan の warmup で読み込む
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+
+    def load(self) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.load(), attr)
+
+pd = LazyModule("pandas")
+google_auth = LazyModule("google.auth")
+bigquery = LazyModule("google.cloud.bigquery")
+# バックグラウンド warmup で先に読み込んでおくモジュール
+LAZY_MODULES = [pd, google_auth, bigquery]
+
+# ─────────────────────────────────────────────
+# プロセス共有のクライアント
+# ─────────────────────────────────────────────
+class ClientRegistry:
+    """
+    BigQuery クライアント・バッチライター・レシピの書き込みキューとその書き込みスレッドを
+    プロセス内で1つずつ保持する。起動時（lifespan）に warmup し、/readyz で状態を返す
+    """
+
+    def __init__(self) -> None:
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+        self.errors: Dict[str, str] = {}
+        self.timings: Dict[str, float] = {}
+        self.ready = False
+        self.warmed_up = False
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        self._factories[name] = factory
+
+    def get(self, name: str) -> Any:
+        if name not in self._instances:
+            with self._lock:
+                if name not in self._instances:
+                    self._instances[name] = self._factories[name]()
+        return self._instances[name]
+
+    def warmup(self) -> None:
+        """登録済みのクライアントをすべて生成する（失敗したものは errors に記録し、次回の get で再試行）"""
+        for name in self._factories:
+            started = time.perf_counter()
+            try:
+                self.get(name)
+                self.errors.pop(name, None)
+            except Exception as e:
+                print(f"{name} の初期化に失敗しました: {str(e)}")
+                self.errors[name] = str(e)
+            self.timings[name] = round(time.perf_counter() - started, 3)
+        self.ready = not self.errors
+        self.warmed_up = True
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "clients": sorted(self._instances), "errors": self.errors}
+
+def create_bigquery_client() -> bigquery.Client:
+    """BigQuery クライアントを生成する"""
+    credentials, default_project = google_auth.default(
+        scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    project = os.getenv("GOOGLE_CLOUD_PROJECT") or default_project
+    return bigquery.Client(project=project, credentials=credentials)
+
+# ─────────────────────────────────────────────
+# 衝突しない時刻順の ID と冪等キー
+# ─────────────────────────────────────────────
+_CROCKFORD32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def encode_ulid(timestamp_ms: int, randomness: int) -> str:
+    """48bit のミリ秒時刻と 80bit の乱数を ULID 形式（Crockford Base32 の26文字）にする"""
+    value = (timestamp_ms << 80) | (randomness & ((1 << 80) - 1))
+    return "".join(_CROCKFORD32[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+class MonotonicUlidGenerator:
+    """
+    ULID を作る。同じミリ秒内では乱数部を1ずつ増やすため、同じプロセスで作った ID は
+    同時刻でも衝突せず、文字列として単調に増える（時計が巻き戻っても前回の値より小さくならない）
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._last_randomness = 0
+
+    def new(self) -> str:
+        timestamp_ms = int(time.time() * 1000)
+        with self._lock:
+            if timestamp_ms <= self._last_ms:
+                timestamp_ms = self._last_ms
+                randomness = self._last_randomness + 1
+                if randomness >= 1 << 80:
+                    timestamp_ms += 1
+                    randomness = secrets.randbits(79)
+            else:
+                # 上位1bit を空けておき、同じミリ秒内で増やしても桁あふれしないようにする
+                randomness = secrets.randbits(79)
+            self._last_ms, self._last_randomness = timestamp_ms, randomness
+        return encode_ulid(timestamp_ms, randomness)
+
+_menu_ids = MonotonicUlidGenerator()
+
+def new_menu_id() -> str:
+    """時刻順に並ぶ一意なメニューID（menu_ + ULID）"""
+    return f"menu_{_menu_ids.new()}"
+
+def menu_id_for_key(idempotency_key: str, created_at: datetime) -> str:
+    """冪等キーと作成時刻から毎回同じメニューIDを作る（再試行しても同じ ID になる）"""
+    digest = hashlib.sha256(idempotency_key.encode("utf-8")).digest()
+    return f"menu_{encode_ulid(int(created_at.timestamp() * 1000), int.from_bytes(digest[:10], 'big'))}"
+
+def row_ids_for_key(idempotency_key: str, table: str, count: int) -> List[str]:
+    """
+    冪等キーから行ごとの insertId を作る。同じキーで同じテーブルに送り直した行は BigQuery 側で重複が排除されるが、
+    insertId による重複排除は約1分以内の再送に対する best effort でしかない。
+    それより離れた再送（クライアントの再試行など）の重複は、読み込み側のビュー
+    （bigquery_schema の created_menu_current など。idempotency_key / menu_id ごとに1件にする）で除く
+    """
+    table_name = table.rsplit(".", 1)[-1]
+    return [f"{idempotency_key}:{table_name}:{i}" for i in range(count)]
+
+# ─────────────────────────────────────────────
+# BigQuery へのバッファ付きストリーミング書き込み
+# ─────────────────────────────────────────────
+def dataframe_to_rows(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    DataFrame を insert_rows_json に渡せる JSON 互換の行リストに変換する
+    （numpy 型・NaN・datetime を JSON の数値 / null / ISO8601 文字列に揃える）
+    """
+    if df.empty:
+        return []
+    return json.loads(df.to_json(orient="records", date_format="iso", force_ascii=False))
+
+class BigQueryWriteError(RuntimeError):
+    """BigQueryBatchWriter が行を書き込めなかった"""
+
+class BigQueryBatchWriter:
+    """
+    テーブルごとに行をバッファし、件数（max_rows）か経過時間（flush_interval_sec）のどちらかに達したら
+    共有クライアントのストリーミング挿入（insertAll）でまとめて書き込む。
+    ロードジョブ（pandas_gbq.to_gbq）と違い1回の書き込みが数十ミリ秒で済み、テーブルごとのロードジョブ数の上限も受けない
+
+    Notes
+    -----
+    バッファはメモリ上にあるため、プロセスが異常終了すると未送信の行は失われる。
+    終了時は必ず close() を呼んで残りを書き出すこと（書き込めなかった行があれば close() が例外を送出する）
+    """
+
+    # insertAll 1リクエストあたりの行数（BigQuery の推奨上限は 500 行）
+    INSERT_CHUNK_ROWS = 500
+
+    def __init__(
+        self,
+        client: bigquery.Client,
+        max_rows: int = 500,
+        flush_interval_sec: float = 1.0,
+    ):
+        self.client = client
+        self.max_rows = max_rows
+        self.flush_interval_sec = flush_interval_sec
+        self._buffers: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._row_ids: Dict[str, List[str]] = defaultdict(list)
+        self._buffered_rows = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.rows_requeued = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self.last_error: Optional[str] = None
+
+    def start(self) -> "BigQueryBatchWriter":
+        """時間経過でフラッシュするバックグラウンドスレッドを開始する"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="bigquery-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def append(
+        self,
+        table: str,
+        rows: List[Dict[str, Any]],
+        row_ids: Optional[List[str]] = None,
+    ) -> None:
+        """
+        行をバッファに追加する（書き込みはバックグラウンドで行われる）
+
+        Parameters
+        ----------
+        table : str
+            書き込み先テーブル（project.dataset.table）
+        rows : List[Dict[str, Any]]
+            JSON 互換の行のリスト
+        row_ids : Optional[List[str]]
+            行ごとの insertId（row_ids_for_key で作る）。省略時は行ごとにランダムな ID を振る
+        """
+        if not rows:
+            return
+        if row_ids is None:
+            row_ids = [uuid.uuid4().hex for _ in rows]
+        elif len(row_ids) != len(rows):
+            raise ValueError("row_ids と rows の件数が一致しません")
+        with self._lock:
+            self._buffers[table].extend(rows)
+            self._row_ids[table].extend(row_ids)
+            self._buffered_rows += len(rows)
+            full = self._buffered_rows >= self.max_rows
+        if full:
+            # 件数に達したら待たずにフラッシュさせる
+            self._wakeup.set()
+
+    def append_dataframe(
+        self,
+        table: str,
+        df: pd.DataFrame,
+        row_ids: Optional[List[str]] = None,
+    ) -> None:
+        self.append(table, dataframe_to_rows(df), row_ids)
+
+    def flush(self) -> int:
+        """
+        バッファ中の行をすべて書き込む
+
+        書き込めなかった行は同じ insertId のままバッファに戻し、次のフラッシュで送り直す
+        （数秒後の再送なので BigQuery の insertId による重複排除が効く）。
+        行の内容が不正（reason=invalid）な行だけは送り直しても成功しないため破棄し、rows_dropped に数える
+
+        Returns
+        -------
+        int
+            バッファに戻した行数
+        """
+        with self._flush_lock:
+            with self._lock:
+                buffers, self._buffers = self._buffers, defaultdict(list)
+                row_ids, self._row_ids = self._row_ids, defaultdict(list)
+                self._buffered_rows = 0
+            requeued = 0
+            for table, rows in buffers.items():
+                ids = row_ids[table]
+                try:
+                    errors = self.insert(table, rows, ids)
+                except Exception as e:
+                    print(f"BigQueryへの書き込みに失敗しました（{table}, {len(rows)}行）: {str(e)}")
+                    with self._lock:
+                        self.last_error = str(e)
+                    self._requeue(table, rows, ids)
+                    requeued += len(rows)
+                    continue
+                retry = [i for i, reasons in errors.items() if "invalid" not in reasons]
+                dropped = len(errors) - len(retry)
+                if dropped:
+                    print(f"BigQueryへの書き込みで不正な行を破棄しました（{table}, {dropped}行）")
+                    with self._lock:
+                        self.rows_dropped += dropped
+                        self.last_error = f"{table}: {dropped}行が不正です"
+                self._requeue(table, [rows[i] for i in retry], [ids[i] for i in retry])
+                requeued += len(retry)
+            if buffers:
+                with self._lock:
+                    self.flushes += 1
+            return requeued
+
+    def _requeue(self, table: str, rows: List[Dict[str, Any]], row_ids: List[str]) -> None:
+        """書き込めなかった行をバッファの先頭に戻す"""
+        if not rows:
+            return
+        with self._lock:
+            self._buffers[table][:0] = rows
+            self._row_ids[table][:0] = row_ids
+            self._buffered_rows += len(rows)
+            self.rows_requeued += len(rows)
+
+    def insert(
+        self,
+        table: str,
+        rows: List[Dict[str, Any]],
+        row_ids: Optional[List[str]] = None,
+    ) -> Dict[int, List[str]]:
+        """
+        バッファを通さずにすぐ書き込む（リクエスト自体が失敗した場合は例外を送出する）
+
+        Parameters
+        ----------
+        table : str
+            書き込み先テーブル（project.dataset.table）
+        rows : List[Dict[str, Any]]
+            JSON 互換の行のリスト
+        row_ids : Optional[List[str]]
+            行ごとの insertId。同じ ID での再送は BigQuery 側で重複が排除される
+
+        Returns
+        -------
+        Dict[int, List[str]]
+            書き込みに失敗した行のインデックス（rows に対する位置）と、その理由（reason）のリスト。
+            reason が invalid の行は内容が不正で、stopped などはほかの行の失敗に巻き込まれただけなので送り直せる
+        """
+        failed: Dict[int, List[str]] = {}
+        for start in range(0, len(rows), self.INSERT_CHUNK_ROWS):
+            chunk = rows[start:start + self.INSERT_CHUNK_ROWS]
+            chunk_ids = row_ids[start:start + self.INSERT_CHUNK_ROWS] if row_ids else None
+            try:
+                errors = self.client.insert_rows_json(table, chunk, row_ids=chunk_ids)
+            except Exception:
+                # 先に成功したチャンクの行も含めて、呼び出し側は全行を送り直す（insertId で重複は排除される）
+                with self._lock:
+                    self.rows_failed += len(rows) - start
+                raise
+            if errors:
+                print(f"BigQueryへの書き込みで一部の行が失敗しました（{table}）: {errors[:3]}")
+                for error in errors:
+                    failed[start + error["index"]] = [e.get("reason", "") for e in error.get("errors", [])]
+            with self._lock:
+                self.rows_failed += len(errors)
+                self.rows_written += len(chunk) - len(errors)
+        return failed
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval_sec)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self, retries: int = 3, retry_interval_sec: float = 1.0) -> None:
+        """
+        バックグラウンドスレッドを止め、残りの行を書き込む
+
+        Raises
+        ------
+        BigQueryWriteError
+            retries 回送り直しても書き込めなかった行や、不正で破棄した行がある場合
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        remaining = self.flush()
+        for attempt in range(retries):
+            if not remaining:
+                break
+            time.sleep(retry_interval_sec * (2 ** attempt))
+            remaining = self.flush()
+        with self._lock:
+            dropped, last_error = self.rows_dropped, self.last_error
+        if remaining or dropped:
+            raise BigQueryWriteError(
+                f"BigQueryに書き込めなかった行があります（未送信 {remaining}行, 破棄 {dropped}行）: {last_error}"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "buffered_rows": self._buffered_rows,
+                "rows_written": self.rows_written,
+                "rows_failed": self.rows_failed,
+                "rows_requeued": self.rows_requeued,
+                "rows_dropped": self.rows_dropped,
+                "flushes": self.flushes,
+                "last_error": self.last_error,
+            }
+
+def create_bigquery_writer() -> BigQueryBatchWriter:
+    """
+    共有の BigQuery クライアントで BigQueryBatchWriter を作成する
+    （レシピは RecipeQueueDrainer が insert で直接書き込むため、フラッシュ用のスレッドは開始しない）
+
+    BIGQUERY_WRITER_MAX_ROWS          : この行数たまったらフラッシュ（既定 500）
+    BIGQUERY_WRITER_FLUSH_INTERVAL_SEC: この秒数ごとにフラッシュ（既定 1.0）
+    """
+    return BigQueryBatchWriter(
+        registry.get("bigquery"),
+        max_rows=int(os.getenv("BIGQUERY_WRITER_MAX_ROWS", "500")),
+        flush_interval_sec=float(os.getenv("BIGQUERY_WRITER_FLUSH_INTERVAL_SEC", "1.0")),
+    )
+
+# ─────────────────────────────────────────────
+# レシピ保存の永続キュー（write-behind）
+# ─────────────────────────────────────────────
+class RecipeWriteQueue:
+    """
+    SQLite（WAL）上のキュー。/save_recipe は受け付けたレシピをここに積むだけで応答し、
+    RecipeQueueDrainer がバックグラウンドで BigQuery に書き込む。
+
+    - 同じ冪等キーのレシピは1度しか積まない（書き込み済みのものも retention_sec の間は記録を残す）
+    - 書き込みに失敗したものは指数バックオフで再試行し、max_attempts 回失敗したら dead にする。
+      dead のレシピと同じ冪等キーで再送された場合は、再び書き込み待ちに戻す（再送を重複として捨てない）
+    - done / dead の記録は retention_sec を過ぎたら消す
+    - 書き込めた行の insertId は written_row_ids に記録し、再試行では残りの行だけを送る
+      （insertId による重複排除は約1分の best effort のため、バックオフ後の再送に頼らない）
+
+    Notes
+    -----
+    守れるのはプロセスのクラッシュまで。Cloud Run のファイルシステムはメモリ上にありインスタンスごとに別なので、
+    インスタンスが破棄されるとファイルごと消える。そのため終了時（SIGTERM）に RecipeQueueDrainer.stop で
+    期限内に書き切り、書き切れなかった件数をログに出す。
+    また書き込みはリクエストの外のスレッドで行うため、CPU を常に割り当てる設定（--no-cpu-throttling）で
+    デプロイすること（既定の「リクエスト処理中のみ」ではアイドル中のインスタンスで書き込みが進まない）
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_attempts: int = 8,
+        retry_base_sec: float = 1.0,
+        retry_max_sec: float = 300.0,
+        retention_sec: float = 86400,
+    ):
+        self.max_attempts = max_attempts
+        self.retry_base_sec = retry_base_sec
+        self.retry_max_sec = retry_max_sec
+        self.retention_sec = retention_sec
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL では NORMAL でもプロセスのクラッシュでコミット済みのデータは失われない（インスタンスの破棄は別。クラスの Notes を参照）
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS recipe_queue ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " idempotency_key TEXT NOT NULL UNIQUE, payload TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL,"
+            " last_error TEXT, written_row_ids TEXT NOT NULL DEFAULT '[]')"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(recipe_queue)")}
+        if "written_row_ids" not in columns:
+            self._conn.execute("ALTER TABLE recipe_queue ADD COLUMN written_row_ids TEXT NOT NULL DEFAULT '[]'")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS recipe_queue_due ON recipe_queue (status, next_attempt_at)"
+        )
+        self._conn.commit()
+
+    def enqueue(self, idempotency_key: str, payload: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        """
+        レシピをキューに積む
+
+        Returns
+        -------
+        Tuple[bool, Dict[str, Any]]
+            新しく積んだかどうか（同じ冪等キーのレシピが書き込み待ち・書き込み済みの場合 False。
+            dead のものは書き込み待ちに戻して True）と、キューにある payload
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO recipe_queue"
+                " (idempotency_key, payload, next_attempt_at, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (idempotency_key, json.dumps(payload, ensure_ascii=False), now, now, now),
+            )
+            if cursor.rowcount == 1:
+                self._conn.commit()
+                return True, payload
+            # 再試行を使い切ったレシピの再送は、書き込み済みの行（written_row_ids）を残したまま最初からやり直す
+            rearmed = self._conn.execute(
+                "UPDATE recipe_queue SET status = 'pending', attempts = 0, next_attempt_at = ?,"
+                " updated_at = ?, last_error = NULL WHERE idempotency_key = ? AND status = 'dead'",
+                (now, now, idempotency_key),
+            ).rowcount == 1
+            self._conn.commit()
+            (stored,) = self._conn.execute(
+                "SELECT payload FROM recipe_queue WHERE idempotency_key = ?", (idempotency_key,)
+            ).fetchone()
+        return rearmed, json.loads(stored)
+
+    def claim(self, limit: int, due_only: bool = True) -> List[Tuple[int, str, Dict[str, Any], float, set]]:
+        """
+        書き込み待ちで再試行時刻を過ぎたものを古い順に (id, 冪等キー, payload, 受付時刻, 書き込み済みの insertId) で返す
+        （due_only=False の場合は再試行時刻を待たずに返す。終了時に書き切るときに使う）
+        """
+        due_at = time.time() if due_only else float("inf")
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, idempotency_key, payload, created_at, written_row_ids FROM recipe_queue"
+                " WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (due_at, limit),
+            ).fetchall()
+        return [
+            (id_, key, json.loads(payload), created_at, set(json.loads(written)))
+            for id_, key, payload, created_at, written in rows
+        ]
+
+    def _purge(self, now: float) -> None:
+        """保持期間を過ぎた done / dead の記録を消す（_lock を取った状態で呼ぶ）"""
+        cutoff = now - self.retention_sec
+        dead_keys = [key for (key,) in self._conn.execute(
+            "SELECT idempotency_key FROM recipe_queue WHERE status = 'dead' AND updated_at < ?", (cutoff,)
+        )]
+        if dead_keys:
+            print(f"書き込めなかったレシピの記録を削除します（{len(dead_keys)}件）: {dead_keys[:10]}")
+        self._conn.execute(
+            "DELETE FROM recipe_queue WHERE status IN ('done', 'dead') AND updated_at < ?", (cutoff,)
+        )
+
+    def ack(self, ids: List[int]) -> None:
+        """書き込み済みにする（冪等キーの記録は残し、保持期間を過ぎた古いものを掃除する）"""
+        if not ids:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE recipe_queue SET status = 'done', updated_at = ?, last_error = NULL WHERE id = ?",
+                [(now, id_) for id_ in ids],
+            )
+            self._purge(now)
+            self._conn.commit()
+
+    def retry(self, id_: int, error: str, written_row_ids: Optional[List[str]] = None) -> None:
+        """
+        失敗を記録し、バックオフ後に再試行する（上限回数に達したら dead にする）。
+        written_row_ids（今回書き込めた行の insertId）は記録に加え、次回は送らない
+        """
+        now = time.time()
+        with self._lock:
+            attempts, written = self._conn.execute(
+                "SELECT attempts, written_row_ids FROM recipe_queue WHERE id = ?", (id_,)
+            ).fetchone()
+            attempts += 1
+            status = "dead" if attempts >= self.max_attempts else "pending"
+            delay = min(self.retry_max_sec, self.retry_base_sec * (2 ** (attempts - 1)))
+            written = sorted(set(json.loads(written)) | set(written_row_ids or []))
+            self._conn.execute(
+                "UPDATE recipe_queue SET status = ?, attempts = ?, next_attempt_at = ?,"
+                " updated_at = ?, last_error = ?, written_row_ids = ? WHERE id = ?",
+                (status, attempts, now + delay, now, error[:1000], json.dumps(written), id_),
+            )
+            if status == "dead":
+                print(f"レシピの書き込みを {attempts} 回失敗したため dead にします（id={id_}）: {error[:200]}")
+            self._purge(now)
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """キューの深さ（書き込み待ち件数）・dead 件数・最も古い書き込み待ちの経過秒数"""
+        with self._lock:
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM recipe_queue GROUP BY status"
+            ).fetchall())
+            (oldest,) = self._conn.execute(
+                "SELECT MIN(created_at) FROM recipe_queue WHERE status = 'pending'"
+            ).fetchone()
+        return {
+            "depth": counts.get("pending", 0),
+            "dead": counts.get("dead", 0),
+            "done_retained": counts.get("done", 0),
+            "oldest_pending_age_sec": round(time.time() - oldest, 3) if oldest else 0.0,
+        }
+
+class RecipeQueueDrainer:
+    """
+    RecipeWriteQueue から batch_size 件ずつ取り出し、テーブルごとにまとめて BigQuery に書き込むスレッド。
+    再試行ではキューに記録した書き込み済みの行を除いて送る（insertId は冪等キーから作るため、
+    同じバッチ内の送り直しやクラッシュ直後の再送も約1分以内なら BigQuery 側で重複が排除される）
+    """
+
+    def __init__(
+        self,
+        queue: RecipeWriteQueue,
+        writer: BigQueryBatchWriter,
+        batch_size: int = 50,
+        interval_sec: float = 0.5,
+    ):
+        self.queue = queue
+        self.writer = writer
+        self.batch_size = batch_size
+        self.interval_sec = interval_sec
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.recipes_written = 0
+        self.recipes_retried = 0
+
+    def start(self) -> "RecipeQueueDrainer":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="recipe-queue-drainer", daemon=True)
+            self._thread.start()
+        return self
+
+    def notify(self) -> None:
+        """新しいレシピが積まれたことを知らせ、待たずに書き込ませる"""
+        self._wakeup.set()
+
+    def drain_once(self, due_only: bool = True) -> int:
+        """1バッチ分を書き込み、処理した件数を返す"""
+        items = self.queue.claim(self.batch_size, due_only=due_only)
+        if not items:
+            return 0
+
+        # テーブルごとに全レシピの未書き込みの行をまとめ、各行がどのレシピのものかを覚えておく
+        tables: Dict[str, Tuple[List[Dict[str, Any]], List[str], List[int]]] = {}
+        errors: Dict[int, str] = {}
+        for id_, key, payload, created_at, written in items:
+            try:
+                recipe_rows = build_recipe_rows(payload, key, datetime.fromtimestamp(created_at, timezone.utc))
+            except Exception as e:
+                errors[id_] = f"行の作成に失敗しました: {str(e)}"
+                continue
+            for table, rows in recipe_rows.items():
+                table_rows, row_ids, owners = tables.setdefault(table, ([], [], []))
+                for row, row_id in zip(rows, row_ids_for_key(key, table, len(rows))):
+                    if row_id in written:
+                        continue
+                    table_rows.append(row)
+                    row_ids.append(row_id)
+                    owners.append(id_)
+
+        # 書き込めた行の insertId（再試行するレシピでは次回送らないように記録する）
+        succeeded: Dict[int, List[str]] = defaultdict(list)
+        for table, (rows, row_ids, owners) in tables.items():
+            try:
+                failed = set(self.writer.insert(table, rows, row_ids))
+            except Exception as e:
+                # どのチャンクまで書き込めたか分からないため、全行を未書き込みとして扱う
+                failed = set(range(len(rows)))
+                error = str(e)
+            else:
+                error = f"{table} の一部の行の書き込みに失敗しました"
+            for index, owner in enumerate(owners):
+                if index in failed:
+                    errors.setdefault(owner, error)
+                else:
+                    succeeded[owner].append(row_ids[index])
+
+        self.queue.ack([item[0] for item in items if item[0] not in errors])
+        for id_, error in errors.items():
+            print(f"レシピの書き込みを再試行します（id={id_}）: {error}")
+            self.queue.retry(id_, error, succeeded.get(id_))
+        self.recipes_written += len(items) - len(errors)
+        self.recipes_retried += len(errors)
+        return len(items)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                drained = self.drain_once()
+            except Exception as e:
+                print(f"キューの書き込み処理でエラーが発生しました: {str(e)}")
+                drained = 0
+            # バッチが埋まっていれば続けて処理し、空なら通知か interval_sec まで待つ
+            if drained < self.batch_size:
+                self._wakeup.wait(self.interval_sec)
+                self._wakeup.clear()
+
+    def stop(self, drain_deadline_sec: float = 0.0) -> int:
+        """
+        スレッドを止め、drain_deadline_sec 秒以内で書き込み待ちのレシピを再試行時刻を待たずに書き切る
+
+        Returns
+        -------
+        int
+            書き切れずにキューに残った件数（Cloud Run ではインスタンスの破棄とともに失われる）
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        deadline = time.monotonic() + drain_deadline_sec
+        while time.monotonic() < deadline:
+            written = self.recipes_written
+            if not self.drain_once(due_only=False) or self.recipes_written == written:
+                # 空になったか、1件も書き込めなかった（BigQuery 側の障害）場合は打ち切る
+                break
+        remaining = self.queue.stats()["depth"]
+        if remaining:
+            print(f"終了時に書き込めなかったレシピがあります（{remaining}件）")
+        return remaining
+
+    def stats(self) -> Dict[str, Any]:
+        return {"recipes_written": self.recipes_written, "recipes_retried": self.recipes_retried}
+
+def create_recipe_queue() -> RecipeWriteQueue:
+    """
+    環境変数から RecipeWriteQueue を作成する
+
+    RECIPE_QUEUE_PATH         : sqlite のファイルパス（既定: recipe_queue.sqlite3）
+    RECIPE_QUEUE_MAX_ATTEMPTS : この回数失敗したら dead にする（既定 8）
+    RECIPE_QUEUE_RETRY_MAX_SEC: 再試行間隔の上限秒数（既定 300）
+    """
+    return RecipeWriteQueue(
+        os.getenv("RECIPE_QUEUE_PATH", "recipe_queue.sqlite3"),
+        max_attempts=int(os.getenv("RECIPE_QUEUE_MAX_ATTEMPTS", "8")),
+        retry_max_sec=float(os.getenv("RECIPE_QUEUE_RETRY_MAX_SEC", "300")),
+    )
+
+def create_queue_drainer() -> RecipeQueueDrainer:
+    """
+    RECIPE_QUEUE_BATCH_SIZE      : 1回に書き込むレシピ数（既定 50）
+    RECIPE_QUEUE_DRAIN_INTERVAL_SEC: キューが空のときの確認間隔（既定 0.5）
+    RECIPE_QUEUE_DRAIN_DEADLINE_SEC: 終了時にキューを書き切る時間（既定 8。Cloud Run の SIGTERM 後の猶予は10秒）
+    """
+    return RecipeQueueDrainer(
+        registry.get("recipe_queue"),
+        registry.get("bq_writer"),
+        batch_size=int(os.getenv("RECIPE_QUEUE_BATCH_SIZE", "50")),
+        interval_sec=float(os.getenv("RECIPE_QUEUE_DRAIN_INTERVAL_SEC", "0.5")),
+    ).start()
+
+registry = ClientRegistry()
+registry.register("bigquery", create_bigquery_client)
+registry.register("bq_writer", create_bigquery_writer)
+registry.register("recipe_queue", create_recipe_queue)
+registry.register("queue_drainer", create_queue_drainer)
+
+def warmup() -> None:
+    """重いモジュールの読み込みとクライアント生成を行い、所要時間を起動レポートとして出力する"""
+    started = time.perf_counter()
+    for module in LAZY_MODULES:
+        module_started = time.perf_counter()
+        module.load()
+        registry.timings[f"import:{module._name}"] = round(time.perf_counter() - module_started, 3)
+    registry.warmup()
+    print(json.dumps({
+        "startup_report": {
+            "module_load_sec": round(MODULE_LOADED - MODULE_LOAD_STARTED, 3),
+            "warmup_sec": round(time.perf_counter() - started, 3),
+            "breakdown_sec": registry.timings,
+        }
+    }, ensure_ascii=False))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warmup はバックグラウンドで行い、ポートの待ち受けを先に始める（準備状況は /readyz で確認）
+    warmup_task = asyncio.create_task(asyncio.to_thread(warmup))
+    yield
+    warmup_task.cancel()
+    # 終了時（Cloud Run の SIGTERM）は猶予の10秒以内にキューを書き切ってから止める
+    # （インスタンスとともにキューのファイルも消えるため、書き切れなかった件数をログに残す）
+    try:
+        drainer = await asyncio.to_thread(registry.get, "queue_drainer")
+        await asyncio.to_thread(drainer.stop, float(os.getenv("RECIPE_QUEUE_DRAIN_DEADLINE_SEC", "8")))
+    except Exception as e:
+        print(f"終了時のキュー停止に失敗しました: {str(e)}")
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS設定（Flutter Webなど必要な場合は制限を適宜調整）
 app.add_middleware(
@@ -16,65 +786,128 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.get("/readyz")
+async def readyz():
+    """レディネスプローブ。warmup 中は 503、初期化に失敗したクライアントがあれば再試行する"""
+    if registry.warmed_up and not registry.ready:
+        await asyncio.to_thread(registry.warmup)
+    status = registry.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics")
+async def metrics():
+    """書き込みキューの深さと BigQuery への書き込み状況"""
+    queue = await asyncio.to_thread(registry.get, "recipe_queue")
+    drainer = await asyncio.to_thread(registry.get, "queue_drainer")
+    return {
+        "queue": await asyncio.to_thread(queue.stats),
+        "drainer": drainer.stats(),
+        "writer": registry.get("bq_writer").stats(),
+    }
+
+# キーの指定がない保存を同じレシピの再送とみなす区間の長さ（秒）
+RECIPE_DEDUP_WINDOW_SEC = float(os.getenv("RECIPE_DEDUP_WINDOW_SEC", "600"))
+
 @app.post("/save_recipe")
 async def save_recipe(request: Request):
     data = await request.json()
-    
-    header_df = pd.DataFrame(data.get("header", []))
-    nutrition_df = pd.DataFrame(data.get("nutrition", []))
-    ingredients_df = pd.DataFrame(data.get("ingredients", []))
-    instructions_df = pd.DataFrame(data.get("instructions", []))
-    user_id = data.get("user_id", None)
-    
-    save_to_bigquery(header_df, nutrition_df, ingredients_df, instructions_df, user_id)
-    return {"result": "ok"}
-
-def save_to_bigquery(
-    header_df: pd.DataFrame,
-    nutrition_df: pd.DataFrame,
-    ingredients_df: pd.DataFrame,
-    instructions_df: pd.DataFrame,
-    user_id: str = None
-) -> None:
+    # 同じレシピの再送（タイムアウト後のリトライや保存ボタンの連打など）は冪等キーで1件にまとめる。
+    # キーの指定がなければレシピの内容と受付時刻の区間（RECIPE_DEDUP_WINDOW_SEC）から作る。
+    # 区間を入れないと、後日あらためて同じレシピを保存したときも同じキーになり1件にまとめられてしまう
+    idempotency_key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    if not idempotency_key:
+        digest = hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        idempotency_key = f"{digest}:{int(time.time() // RECIPE_DEDUP_WINDOW_SEC)}"
+    # menu_id は受付順に振る（重複した場合はキューにある最初の menu_id を返す）
+    data["menu_id"] = new_menu_id()
+
+    # インスタンス内のキューに積んだ時点で応答する（BigQuery への書き込みはバックグラウンドで行う。
+    # インスタンスの破棄までに書き切る前提のため、RecipeWriteQueue の Notes のデプロイ設定が必要）
+    queue = await asyncio.to_thread(registry.get, "recipe_queue")
+    enqueued, stored = await asyncio.to_thread(queue.enqueue, idempotency_key, data)
+    drainer = await asyncio.to_thread(registry.get, "queue_drainer")
+    drainer.notify()
+    return {
+        "result": "ok",
+        "menu_id": stored.get("menu_id"),
+        "idempotency_key": idempotency_key,
+        "duplicate": not enqueued,
+    }
+
+def build_recipe_rows(
+    data: Dict[str, Any],
+    idempotency_key: str,
+    received_at: datetime,
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    /save_recipe のリクエストからテーブルごとの行を作る
+
+    Parameters
+    ----------
+    data : Dict[str, Any]
+        header / nutrition / ingredients / instructions と受付時に振った menu_id を含むリクエストボディ
+    idempotency_key : str
+        冪等キー（menu_id のないリクエストは、キーと受付時刻から毎回同じ menu_id を作る）
+    received_at : datetime
+        受付時刻（キューに積んだ時刻）
+
+    Returns
+    -------
+    Dict[str, List[Dict[str, Any]]]
+        書き込み先テーブル（project.dataset.table）ごとの行
+    """
     project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
     dataset_name = os.getenv('BIGQUERY_DATASET')
-    now = datetime.now(timezone.utc)
-    menu_id = f"menu_{now.strftime('%Y%m%d_%H%M%S')}"
-    
+    menu_id = data.get("menu_id") or menu_id_for_key(idempotency_key, received_at)
+    user_id = data.get("user_id")
+    created_at = received_at.isoformat()
+    header = (data.get("header") or [{}])[0]
+    nutrition = (data.get("nutrition") or [{}])[0]
+
     # --- created_menu（レシピ基本情報） ---
-    menu_data = {
-        "menu_id": [menu_id],
-        "created_at": [now],
-        "title": [header_df.iloc[0].get("title", "")],
-        "total_time_min": [header_df.iloc[0].get("total_time_min", None)],
-        "kcal": [nutrition_df.iloc[0].get("kcal", None)],
-        "protein_g": [nutrition_df.iloc[0].get("protein_g", None)],
-        "fat_g": [nutrition_df.iloc[0].get("fat_g", None)],
-        "carb_g": [nutrition_df.iloc[0].get("carb_g", None)],
-        "salt_g": [nutrition_df.iloc[0].get("salt_g", None)],
-        "fiber_g": [nutrition_df.iloc[0].get("fiber_g", None)],
+    menu_row = {
+        "menu_id": menu_id,
+        "user_id": user_id,
+        "created_at": created_at,
+        # 別のインスタンスで受け付けた再送は menu_id が変わるため、読み込み側はこの列で1件にまとめる
+        "idempotency_key": idempotency_key,
+        "title": header.get("title", ""),
+        "total_time_min": header.get("total_time_min", None),
+        "kcal": nutrition.get("kcal", None),
+        "protein_g": nutrition.get("protein_g", None),
+        "fat_g": nutrition.get("fat_g", None),
+        "carb_g": nutrition.get("carb_g", None),
+        "salt_g": nutrition.get("salt_g", None),
+        "fiber_g": nutrition.get("fiber_g", None),
     }
-    menu_df = pd.DataFrame(menu_data)
-    menu_table = f"{project_name}.{dataset_name}.created_menu"
-    pandas_gbq.to_gbq(menu_df, menu_table, project_id=project_name, if_exists="append")
-
-    # --- ingredients（材料情報） ---
-    if not ingredients_df.empty:
-        ingredients_df = ingredients_df.copy()
-        ingredients_df["menu_id"] = menu_id
-        # 列順を揃える（menu_id, name, quantity, unit）
-        ingredients_df = ingredients_df[["menu_id", "name", "quantity", "unit"]]
-        ingredients_table = f"{project_name}.{dataset_name}.ingredients"
-        pandas_gbq.to_gbq(ingredients_df, ingredients_table, project_id=project_name, if_exists="append")
-
-    # --- instructions ---
-    if not instructions_df.empty:
-        instructions_df = instructions_df.copy()
-        instructions_df["menu_id"] = menu_id
-        # 列順を揃える（menu_id, step, text）
-        instructions_df = instructions_df[["menu_id", "step", "text"]]
-        instructions_table = f"{project_name}.{dataset_name}.instructions"
-        pandas_gbq.to_gbq(instructions_df, instructions_table, project_id=project_name, if_exists="append")
+    rows = {f"{project_name}.{dataset_name}.created_menu": [menu_row]}
+
+    # --- ingredients（材料情報）: menu_id, user_id, created_at, name, quantity, unit ---
+    ingredients = data.get("ingredients") or []
+    if ingredients:
+        rows[f"{project_name}.{dataset_name}.ingredients"] = [
+            {
+                "menu_id": menu_id, "user_id": user_id, "created_at": created_at,
+                "name": item.get("name"), "quantity": item.get("quantity"), "unit": item.get("unit"),
+            }
+            for item in ingredients
+        ]
+
+    # --- instructions: menu_id, user_id, created_at, step, text ---
+    # （created_at はパーティション、user_id はクラスタリングの列。shared/bigquery_schema.py を参照）
+    instructions = data.get("instructions") or []
+    if instructions:
+        rows[f"{project_name}.{dataset_name}.instructions"] = [
+            {
+                "menu_id": menu_id, "user_id": user_id, "created_at": created_at,
+                "step": item.get("step"), "text": item.get("text"),
+            }
+            for item in instructions
+        ]
+    return rows
+
+# モジュール読み込みの完了時刻（起動レポート用）
+MODULE_LOADED = time.perf_counter()
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8080)
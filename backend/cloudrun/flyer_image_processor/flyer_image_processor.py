@@ -1,21 +1,65 @@
+from __future__ import annotations
+
 import os
+import re
 import json
-from typing import Optional, Dict, Any, List
-from dataclasses import dataclass
+import asyncio
+import time
+import importlib
+import threading
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
 from dotenv import load_dotenv
-from google import generativeai as genai
-from google.generativeai import GenerationConfig
-from PIL import Image
 from io import BytesIO
-import firebase_admin
-from firebase_admin import credentials, storage
-import pandas as pd
-import pandas_gbq
-from datetime import datetime, timezone
-from fastapi import FastAPI, HTTPException
+from datetime import datetime, timezone, timedelta
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 import base64
+import unicodedata
+import uuid
+from urllib.parse import quote
+from google.api_core.exceptions import NotFound
+
+# ─────────────────────────────────────────────
+# 重いモジュールの遅延インポート（コールドスタート短縮）
+# ─────────────────────────────────────────────
+# モジュール読み込みの開始時刻（起動レポート用）
+MODULE_LOAD_STARTED = time.perf_counter()
+
+class LazyModule:
+    """
+    Gemini SDK・PIL・pandas・firebase_admin などの import を初回の属性アクセスまで遅らせるプロキシ。
+    コンテナ起動時には読み込まず、lifespan のバックグラウンド warmup か最初のチラシ・メニューのリクエストで読み込む
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+
+    def load(self) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.load(), attr)
+
+pd = LazyModule("pandas")
+pandas_gbq = LazyModule("pandas_gbq")
+genai = LazyModule("google.generativeai")
+Image = LazyModule("PIL.Image")
+firebase_admin = LazyModule("firebase_admin")
+google_auth = LazyModule("google.auth")
+bigquery = LazyModule("google.cloud.bigquery")
+# バックグラウンド warmup で先に読み込んでおくモジュール
+LAZY_MODULES = [pd, pandas_gbq, genai, Image, firebase_admin, google_auth, bigquery]
 
 # ─────────────────────────────────────────────
 # 1. Gemini生成設定
@@ -36,8 +80,8 @@ class GeminiOptions:
     response_mime_type: Optional[str] = "application/json"
     response_schema: Optional[Dict[str, Any]] = None
 
-    def to_generation_config(self) -> GenerationConfig:
-        return GenerationConfig(
+    def to_generation_config(self) -> genai.GenerationConfig:
+        return genai.GenerationConfig(
             temperature        = self.temperature,
             top_p              = self.top_p,
             top_k              = self.top_k,
@@ -47,9 +91,83 @@ class GeminiOptions:
             presence_penalty   = self.presence_penalty or None,
             frequency_penalty  = self.frequency_penalty or None,
             response_mime_type = self.response_mime_type or None,
-            response_schema    = self.response_schema or None,
+            response_schema    = sdk_response_schema(self.response_schema) or None,
         )
 
+# ─────────────────────────────────────────────
+# チラシ画像の前処理（縮小・タイル分割）と結果のマージ
+# ─────────────────────────────────────────────
+def normalize_image_size(image: Image.Image, max_edge: int) -> Image.Image:
+    """長辺が max_edge を超える場合、縦横比を保って縮小する"""
+    if max(image.size) <= max_edge:
+        return image
+    scale = max_edge / max(image.size)
+    new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(new_size, Image.LANCZOS)
+
+def split_into_tiles(image: Image.Image, rows: int, cols: int, overlap: float = 0.1) -> list:
+    """
+    画像を rows × cols のタイルに分割する。
+    境界上の商品が切れないよう、各タイルを上下左右に overlap（タイル幅に対する割合）だけ広げる
+    """
+    if rows <= 1 and cols <= 1:
+        return [image]
+    width, height = image.size
+    tile_w = width / cols
+    tile_h = height / rows
+    pad_x = int(tile_w * overlap)
+    pad_y = int(tile_h * overlap)
+    tiles = []
+    for r in range(rows):
+        for c in range(cols):
+            box = (
+                max(0, int(c * tile_w) - pad_x),
+                max(0, int(r * tile_h) - pad_y),
+                min(width, int((c + 1) * tile_w) + pad_x),
+                min(height, int((r + 1) * tile_h) + pad_y),
+            )
+            tiles.append(image.crop(box))
+    return tiles
+
+def merge_flyer_items(item_lists: list) -> list:
+    """
+    タイルごとの商品リストを結合する。
+    重なり部分で二重に読まれた商品（商品名と値段が同じもの）は1件にまとめ、
+    片方にしかない項目（数量・特売日など）は補完する
+    """
+    def norm(value: Any) -> str:
+        return re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(value or ""))).lower()
+
+    merged: Dict[tuple, dict] = {}
+    for items in item_lists:
+        for item in items:
+            key = (norm(item.get("商品")), norm(item.get("値段")))
+            if not key[0]:
+                continue
+            if key not in merged:
+                merged[key] = dict(item)
+                continue
+            for field, value in item.items():
+                if value and not merged[key].get(field):
+                    merged[key][field] = value
+    return list(merged.values())
+
+# チラシ OCR 結果（JSON）を画像の内容ハッシュ単位で保存するバケット内のプレフィックス
+OCR_CACHE_PREFIX = os.getenv("FLYER_OCR_CACHE_PREFIX", "flyer_ocr_cache/")
+
+def blob_content_hash(blob) -> Optional[str]:
+    # GCS のメタデータ（MD5、なければ CRC32C）から内容ハッシュを得る。ダウンロードは不要
+    for value in (blob.md5_hash, blob.crc32c):
+        if value:
+            return base64.b64decode(value).hex()
+    return None
+
+# チラシは flyers/YYYY-MM-DD/<epoch_ms>.jpg（UTC日付）にアップロードされ、
+# アップロード時に flyers/latest.json（インデックス）へ最新のパスが書き込まれる
+FLYER_PREFIX = os.getenv("FLYER_PREFIX", "flyers/")
+FLYER_INDEX_PATH = f"{FLYER_PREFIX}latest.json"
+FLYER_INDEX_LOOKBACK_DAYS = int(os.getenv("FLYER_INDEX_LOOKBACK_DAYS", "7"))
+
 # ─────────────────────────────────────────────
 # 2. チラシ画像→商品リスト（Gemini+Firebase）
 # ─────────────────────────────────────────────
@@ -73,12 +191,20 @@ class ImageProcessor:
         self.firebase_bucket = firebase_bucket or os.getenv('FIREBASE_STORAGE_BUCKET')
         if not self.firebase_cred_path or not self.firebase_bucket:
             raise ValueError("Firebase認証情報が設定されていません")
+        from firebase_admin import credentials, storage
         if not firebase_admin._apps:
             cred = credentials.Certificate(self.firebase_cred_path)
             firebase_admin.initialize_app(cred, {'storageBucket': self.firebase_bucket})
         self.bucket = storage.bucket()
 
+        self.model_name = model_name
         self.options = options
+        # OCR 前処理の設定（長辺の上限・タイル分割数・タイルの重なり・JPEG品質）
+        self.max_edge = int(os.getenv("FLYER_MAX_EDGE", "2048"))
+        self.tile_rows = int(os.getenv("FLYER_TILE_ROWS", "2"))
+        self.tile_cols = int(os.getenv("FLYER_TILE_COLS", "2"))
+        self.tile_overlap = float(os.getenv("FLYER_TILE_OVERLAP", "0.1"))
+        self.jpeg_quality = int(os.getenv("FLYER_JPEG_QUALITY", "85"))
         # モデル
         self.model = genai.GenerativeModel(
             model_name=model_name,
@@ -108,7 +234,8 @@ class ImageProcessor:
 - 上記のJSON形式以外の文章は含めないでください
 """
 
-    def get_latest_image(self, prefix: str = "") -> Optional[Image.Image]:
+    def _scan_latest_blob(self, prefix: str):
+        # プレフィックス配下を走査する（件数に比例して遅くなるため、インデックスがない場合のみ使う）
         blobs = list(self.bucket.list_blobs(prefix=prefix))
         if not blobs:
             return None
@@ -116,25 +243,107 @@ class ImageProcessor:
         blobs.sort(key=lambda b: b.updated, reverse=True)
         for blob in blobs:
             if blob.name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                image_bytes = blob.download_as_bytes()
-                return Image.open(BytesIO(image_bytes)).convert("RGB")
+                return blob
         return None
 
-    def pil_image_to_gemini_part(self, image: Image.Image) -> dict:
+    def read_flyer_index(self):
+        try:
+            index = json.loads(self.bucket.blob(FLYER_INDEX_PATH).download_as_text())
+            return self.bucket.get_blob(index["path"])
+        except NotFound:
+            return None
+        except Exception as e:
+            print(f"チラシのインデックスの読み込みに失敗しました: {str(e)}")
+            return None
+
+    def write_flyer_index(self, blob) -> None:
+        try:
+            index = {"path": blob.name, "updated": blob.updated.isoformat() if blob.updated else None}
+            self.bucket.blob(FLYER_INDEX_PATH).upload_from_string(
+                json.dumps(index, ensure_ascii=False), content_type="application/json"
+            )
+        except Exception as e:
+            print(f"チラシのインデックスの保存に失敗しました: {str(e)}")
+
+    def get_latest_blob(self, prefix: str = ""):
+        if prefix:
+            return self._scan_latest_blob(prefix)
+        # 通常はインデックスを1回読むだけで、バケット内の件数に依存しない
+        blob = self.read_flyer_index()
+        if blob is not None:
+            return blob
+        # インデックスがない場合は日付プレフィックスを新しい順に探索し、なければ旧形式を走査する
+        today = datetime.now(timezone.utc).date()
+        for days in range(FLYER_INDEX_LOOKBACK_DAYS):
+            blob = self._scan_latest_blob(f"{FLYER_PREFIX}{today - timedelta(days=days):%Y-%m-%d}/")
+            if blob is not None:
+                break
+        else:
+            blob = self._scan_latest_blob(FLYER_PREFIX)
+        if blob is not None:
+            self.write_flyer_index(blob)
+        return blob
+
+    def load_image(self, blob) -> Image.Image:
+        image_bytes = blob.download_as_bytes()
+        return Image.open(BytesIO(image_bytes)).convert("RGB")
+
+    def get_latest_image(self, prefix: str = "") -> Optional[Image.Image]:
+        blob = self.get_latest_blob(prefix)
+        return self.load_image(blob) if blob else None
+
+    def _ocr_cache_path(self, content_hash: str) -> str:
+        # 同じ画像でもモデル・プロンプト・前処理設定が変われば結果が変わるため、キーに含める
+        settings = json.dumps(
+            [self.model_name, self.prompt, self.max_edge, self.tile_rows, self.tile_cols, self.tile_overlap, self.jpeg_quality],
+            ensure_ascii=False,
+        )
+        fingerprint = hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+        return f"{OCR_CACHE_PREFIX}{content_hash}_{fingerprint}.json"
+
+    def load_cached_ocr(self, content_hash: str) -> Optional[list[dict]]:
+        try:
+            return json.loads(self.bucket.blob(self._ocr_cache_path(content_hash)).download_as_text())
+        except NotFound:
+            return None
+        except Exception as e:
+            print(f"OCRキャッシュの読み込みに失敗しました: {str(e)}")
+            return None
+
+    def save_cached_ocr(self, content_hash: str, items: list[dict]) -> None:
+        try:
+            self.bucket.blob(self._ocr_cache_path(content_hash)).upload_from_string(
+                json.dumps(items, ensure_ascii=False), content_type="application/json"
+            )
+        except Exception as e:
+            print(f"OCRキャッシュの保存に失敗しました: {str(e)}")
+
+    def _resolve_latest_flyer(self) -> tuple:
+        # 最新チラシの (内容ハッシュ, キャッシュ済み商品リスト, 画像) を返す。キャッシュヒット時は画像を取得しない
+        blob = self.get_latest_blob()
+        if blob is None:
+            raise Exception("画像が取得できませんでした（Firebaseストレージを確認）")
+        content_hash = blob_content_hash(blob)
+        if content_hash:
+            cached = self.load_cached_ocr(content_hash)
+            if cached is not None:
+                print(f"OCRキャッシュを使用します: {blob.name}")
+                return content_hash, cached, None
+        return content_hash, None, self.load_image(blob)
+
+    def pil_image_to_gemini_part(self, image: Image.Image, quality: Optional[int] = None) -> dict:
         buf = BytesIO()
-        image.save(buf, format='JPEG')
+        image.save(buf, format='JPEG', quality=quality or self.jpeg_quality, optimize=True)
         byte_data = buf.getvalue()
         return {"mime_type": "image/jpeg", "data": byte_data}
 
-    def recognize_flyer(self) -> list[dict]:
-        image = self.get_latest_image()
-        if image is None:
-            raise Exception("画像が取得できませんでした（Firebaseストレージを確認）")
-        image_part = self.pil_image_to_gemini_part(image)
-        response = self.model.generate_content(
-            contents=[image_part, self.prompt],
-            generation_config=self.options.to_generation_config()
-        )
+    def prepare_flyer_parts(self, image: Image.Image) -> list[dict]:
+        # 長辺を max_edge に縮小 → 重なりありのタイルに分割 → JPEG化
+        image = normalize_image_size(image, self.max_edge)
+        tiles = split_into_tiles(image, self.tile_rows, self.tile_cols, self.tile_overlap)
+        return [self.pil_image_to_gemini_part(tile) for tile in tiles]
+
+    def parse_flyer_response(self, response) -> list[dict]:
         text = getattr(response, "text", None)
         if not text:
             raise Exception("Gemini APIから応答がありません")
@@ -155,9 +364,304 @@ class ImageProcessor:
                     raise Exception(f"必須キー({key})がJSONにありません")
         return items
 
+    def _recognize_tile(self, image_part: dict) -> list[dict]:
+        response = self.model.generate_content(
+            contents=[image_part, self.prompt],
+            generation_config=self.options.to_generation_config()
+        )
+        return self.parse_flyer_response(response)
+
+    async def _recognize_tile_async(self, image_part: dict) -> list[dict]:
+        response = await self.model.generate_content_async(
+            contents=[image_part, self.prompt],
+            generation_config=self.options.to_generation_config()
+        )
+        return self.parse_flyer_response(response)
+
+    def _merge_tile_results(self, tile_results: list) -> list[dict]:
+        # 一部のタイルが失敗しても残りの結果で続行し、全タイル失敗時のみエラーにする
+        errors = [r for r in tile_results if isinstance(r, BaseException)]
+        if len(errors) == len(tile_results):
+            raise errors[0]
+        if errors:
+            print(f"{len(errors)}/{len(tile_results)} タイルの認識に失敗しました: {errors[0]}")
+        return merge_flyer_items([r for r in tile_results if not isinstance(r, BaseException)])
+
+    def recognize_flyer(self) -> list[dict]:
+        content_hash, cached, image = self._resolve_latest_flyer()
+        if cached is not None:
+            return cached
+        image_parts = self.prepare_flyer_parts(image)
+
+        def run(image_part: dict) -> Any:
+            try:
+                return self._recognize_tile(image_part)
+            except Exception as e:
+                return e
+
+        # タイルごとに並列で認識
+        with ThreadPoolExecutor(max_workers=len(image_parts)) as executor:
+            tile_results = list(executor.map(run, image_parts))
+        items = self._merge_tile_results(tile_results)
+        # 一部タイルが失敗した不完全な結果はキャッシュしない
+        if content_hash and not any(isinstance(r, BaseException) for r in tile_results):
+            self.save_cached_ocr(content_hash, items)
+        return items
+
+    async def recognize_flyer_async(self) -> list[dict]:
+        # Firebase Storage と PIL は同期APIのためスレッドで実行
+        content_hash, cached, image = await asyncio.to_thread(self._resolve_latest_flyer)
+        if cached is not None:
+            return cached
+        image_parts = await asyncio.to_thread(self.prepare_flyer_parts, image)
+        tile_results = await asyncio.gather(
+            *(self._recognize_tile_async(part) for part in image_parts),
+            return_exceptions=True,
+        )
+        items = self._merge_tile_results(list(tile_results))
+        if content_hash and not any(isinstance(r, BaseException) for r in tile_results):
+            await asyncio.to_thread(self.save_cached_ocr, content_hash, items)
+        return items
+
+# ─────────────────────────────────────────────
+# 応答スキーマ（Gemini 用への変換と、事前コンパイルした検証）
+# ─────────────────────────────────────────────
+# Gemini の response_schema（OpenAPI のサブセット）が受け付けるキー
+_GEMINI_SCHEMA_KEYS = {"type", "format", "description", "nullable", "enum", "properties", "required", "items"}
+
+def _resolve_ref(schema: Dict[str, Any], root: Dict[str, Any]) -> Dict[str, Any]:
+    """"#/$defs/name" 形式の $ref をたどる"""
+    while "$ref" in schema:
+        node: Any = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            node = node[part]
+        schema = node
+    return schema
+
+def to_gemini_schema(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    JSON Schema を GeminiOptions.response_schema に渡せる形にする
+    （$ref を展開し、$schema / title / additionalProperties / minimum などの未対応のキーを除く）
+
+    Gemini は response_schema のキーを名前順で出力するため、properties の定義順を
+    propertyOrdering として付ける（ストリーミングで title から順に届くように）
+    """
+    root = root or schema
+    schema = _resolve_ref(schema, root)
+    converted: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key not in _GEMINI_SCHEMA_KEYS:
+            continue
+        if key == "properties":
+            value = {name: to_gemini_schema(prop, root) for name, prop in value.items()}
+            converted["propertyOrdering"] = list(value)
+        elif key == "items":
+            value = to_gemini_schema(value, root)
+        converted[key] = value
+    return converted
+
+def sdk_response_schema(schema: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    to_gemini_schema の結果を google-generativeai の protos.Schema が受け付ける形にする。
+    propertyOrdering は SDK の property_ordering に読み替え、それが無い版の SDK では除く
+    （その場合キーの順序は SYSTEM_PROMPT の指示だけに頼る）
+    """
+    if not isinstance(schema, dict):
+        return schema
+    protos = getattr(genai, "protos", None)
+    supported = protos is not None and "property_ordering" in protos.Schema.meta.fields
+    converted: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key == "propertyOrdering":
+            if supported:
+                converted["property_ordering"] = value
+            continue
+        if key == "properties":
+            value = {name: sdk_response_schema(prop) for name, prop in value.items()}
+        elif key == "items":
+            value = sdk_response_schema(value)
+        converted[key] = value
+    return converted
+
+class SchemaValidationError(ValueError):
+    """応答がスキーマに合わない（errors に場所ごとのメッセージを持つ）"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors[:5]))
+        self.errors = errors
+
+_JSON_TYPES: Dict[str, Tuple[type, ...]] = {
+    "object": (dict,),
+    "array": (list,),
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+}
+
+def compile_validator(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Callable[[Any], List[str]]:
+    """
+    JSON Schema（type / properties / required / additionalProperties / items / minItems / minimum / enum / $ref）を
+    検証関数に変換する。スキーマの解釈は1回だけで、検証は値をたどるだけになる
+
+    Returns
+    -------
+    Callable[[Any], List[str]]
+        値を受け取り、エラーメッセージ（"$.nutrition.kcal: ..." の形式）のリストを返す関数。空なら妥当
+    """
+    root = root or schema
+    schema = _resolve_ref(schema, root)
+    checks: List[Callable[[Any, str, List[str]], bool]] = []
+
+    if "type" in schema:
+        expected = schema["type"]
+        types = _JSON_TYPES[expected]
+
+        def check_type(value: Any, path: str, errors: List[str]) -> bool:
+            # bool は int のサブクラスなので数値としては扱わない
+            if not isinstance(value, types) or (isinstance(value, bool) and expected != "boolean"):
+                errors.append(f"{path}: {expected} ではありません（{type(value).__name__}）")
+                return False
+            return True
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+
+        def check_enum(value: Any, path: str, errors: List[str]) -> bool:
+            if value not in allowed:
+                errors.append(f"{path}: {allowed} のいずれでもありません")
+            return True
+        checks.append(check_enum)
+
+    if "minimum" in schema:
+        minimum = schema["minimum"]
+
+        def check_minimum(value: Any, path: str, errors: List[str]) -> bool:
+            if isinstance(value, (int, float)) and value < minimum:
+                errors.append(f"{path}: {minimum} 未満です")
+            return True
+        checks.append(check_minimum)
+
+    if "properties" in schema or "required" in schema:
+        properties = {name: compile_validator(prop, root) for name, prop in schema.get("properties", {}).items()}
+        required = schema.get("required", [])
+        closed = schema.get("additionalProperties", True) is False
+
+        def check_object(value: Any, path: str, errors: List[str]) -> bool:
+            if not isinstance(value, dict):
+                return True
+            errors.extend(f"{path}.{name}: ありません" for name in required if name not in value)
+            for name, item in value.items():
+                if name in properties:
+                    errors.extend(properties[name](item, f"{path}.{name}"))
+                elif closed:
+                    errors.append(f"{path}.{name}: 定義にない項目です")
+            return True
+        checks.append(check_object)
+
+    if "items" in schema or "minItems" in schema:
+        item_validator = compile_validator(schema["items"], root) if "items" in schema else None
+        min_items = schema.get("minItems", 0)
+
+        def check_array(value: Any, path: str, errors: List[str]) -> bool:
+            if not isinstance(value, list):
+                return True
+            if len(value) < min_items:
+                errors.append(f"{path}: 要素が {min_items} 個未満です")
+            if item_validator is not None:
+                for i, item in enumerate(value):
+                    errors.extend(item_validator(item, f"{path}[{i}]"))
+            return True
+        checks.append(check_array)
+
+    def validate(value: Any, path: str = "$") -> List[str]:
+        errors: List[str] = []
+        for check in checks:
+            # 型が違う場合はそれ以降の検査をしない
+            if not check(value, path, errors):
+                break
+        return errors
+    return validate
+
+def json_text_validator(validate: Callable[[Any], List[str]]) -> Callable[[str], List[str]]:
+    """応答テキストを JSON として読んでから validate で検証する関数を返す（GeminiProcessor の validator 用）"""
+    def validate_text(text: str) -> List[str]:
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            return [f"$: JSON として読めません: {e}"]
+        return validate(data)
+    return validate_text
+
 # ─────────────────────────────────────────────
 # 3. Geminiメニュー生成関連
 # ─────────────────────────────────────────────
+# スキーマ定義
+RESPONSE_SCHEMA = {
+    "$schema": "https://json-schema.org/draft/2020-12/schema",
+    "title": "MealPlan",
+    "type": "object",
+    "properties": {
+        "title": { "type": "string" },
+        "cuisine": { "type": "string" },
+        "total_time_min": {
+            "type": "integer",
+            "minimum": 0
+        },
+        "nutrition": { "$ref": "#/$defs/nutrition" },
+        "ingredients": {
+            "type": "array",
+            "items": { "$ref": "#/$defs/ingredient" }
+        },
+        "instructions": {
+            "type": "array",
+            "items": { "type": "string" },
+            "minItems": 1
+        },
+        "notes": { "type": "string" }
+    },
+    "required": [
+        "title",
+        "cuisine",
+        "total_time_min",
+        "nutrition",
+        "ingredients",
+        "instructions"
+    ],
+    "additionalProperties": False,
+
+    "$defs": {
+        "nutrition": {
+            "type": "object",
+            "properties": {
+                "kcal":       { "type": "number", "minimum": 0 },
+                "protein_g":  { "type": "number", "minimum": 0 },
+                "fat_g":      { "type": "number", "minimum": 0 },
+                "carb_g":     { "type": "number", "minimum": 0 },
+                "salt_g":     { "type": "number", "minimum": 0 }
+            },
+            "required": ["kcal", "protein_g", "fat_g", "carb_g", "salt_g"],
+            "additionalProperties": False
+        },
+
+        "ingredient": {
+            "type": "object",
+            "properties": {
+                "name":     { "type": "string" },
+                "quantity": { "type": "string" },
+                "unit":     { "type": "string" }
+            },
+            "required": ["name", "quantity", "unit"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Gemini に渡す形（$ref を展開したもの）と、parse_menu_json で使う検証関数（どちらも読み込み時に1回だけ作る）
+GEMINI_RESPONSE_SCHEMA = to_gemini_schema(RESPONSE_SCHEMA)
+validate_meal_plan = compile_validator(RESPONSE_SCHEMA)
+
 SYSTEM_PROMPT = """
 あなたは「パーソナル栄養プランナーAI」です。
 ユーザーの指定する条件に従って、献立をJSON形式で出力してください。
@@ -174,10 +678,6 @@ SYSTEM_PROMPT = """
         "carb_g": 45,
         "salt_g": 2.5
     },
-    "instructions": [
-        "手順1",
-        "手順2"
-    ],
     "ingredients": [
         {
             "name": "鶏胸肉",
@@ -194,6 +694,10 @@ SYSTEM_PROMPT = """
             "quantity": "100",
             "unit": "g"
         }
+    ],
+    "instructions": [
+        "手順1",
+        "手順2"
     ]
 }
 
@@ -201,6 +705,7 @@ SYSTEM_PROMPT = """
 - nutritionの値は必ず数値型で出力
 - ingredientsは必ず配列で出力
 - total_time_minは整数値で出力
+- キーは title, cuisine, total_time_min, nutrition, ingredients, instructions の順で出力
 """
 
 def setup_environment() -> None:
@@ -213,9 +718,192 @@ def create_processor() -> 'GeminiProcessor':
     opts = GeminiOptions(
         temperature=float(os.getenv('GEMINI_TEMPERATURE', '0.3')),
         max_output_tokens=int(os.getenv('GEMINI_MAX_OUTPUT_TOKENS', '10000')),
-        tools=None
+        # 出力を MealPlan のスキーマに制約する（壊れた JSON や欠けた項目の応答を生成させない）
+        response_schema=GEMINI_RESPONSE_SCHEMA,
+    )
+    return GeminiProcessor(
+        options=opts,
+        cache=create_response_cache(),
+        # スキーマに合わない応答はキャッシュしない
+        validator=json_text_validator(validate_meal_plan),
+    )
+
+# ─────────────────────────────────────────────
+# 応答キャッシュ（内容アドレス + LRU + TTL）
+# ─────────────────────────────────────────────
+def make_cache_key(
+    model_name: str,
+    options: Dict[str, Any],
+    system_prompt: Any,
+    human_prompt: Any,
+) -> str:
+    """(モデル名, 生成設定, system-prompt, human-prompt) の SHA-256 をキーにする"""
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "options": options,
+            "system": None if pd.isna(system_prompt) else str(system_prompt),
+            "human": str(human_prompt),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
     )
-    return GeminiProcessor(options=opts)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """プロセス内 LRU + TTL キャッシュ"""
+
+    def __init__(self, max_entries: int = 1024, ttl_sec: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            created_at, value = entry
+            if time.time() - created_at > self.ttl_sec:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class SQLiteCacheBackend:
+    """ローカルディスク（SQLite）上の LRU + TTL キャッシュ"""
+
+    # get / set がディスク I/O を伴う（非同期の呼び出し元ではスレッドで実行する）
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl_sec: float = 86400):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_sec:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            # 期限切れと、上限を超えた古いアクセス順のエントリを削除
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_sec,)
+            )
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                " SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+
+class ResponseCache:
+    """バックエンドを差し替え可能なキャッシュ。ヒット/ミス数を数える"""
+
+    def __init__(self, backend: Any):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self.backend.set(key, value)
+
+    async def get_async(self, key: str) -> Optional[str]:
+        """get の asyncio 版（ディスクを読むバックエンドはスレッドで実行し、イベントループを止めない）"""
+        if getattr(self.backend, "blocking", False):
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def set_async(self, key: str, value: str) -> None:
+        """set の asyncio 版"""
+        if getattr(self.backend, "blocking", False):
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """
+    環境変数からキャッシュを作成する
+
+    GEMINI_CACHE_BACKEND      : none（既定）/ memory / sqlite
+                                生成結果は毎回異なるため、同じ入力に同じ応答を返してよいデプロイでだけ明示的に有効にする
+    GEMINI_CACHE_PATH         : sqlite のファイルパス（既定: gemini_cache.sqlite3）
+    GEMINI_CACHE_MAX_ENTRIES  : 最大エントリ数（既定: 1024）
+    GEMINI_CACHE_TTL_SEC      : 有効期限秒（既定: 3600）
+    """
+    backend_name = os.getenv("GEMINI_CACHE_BACKEND", "none").lower()
+    max_entries = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "1024"))
+    ttl_sec = float(os.getenv("GEMINI_CACHE_TTL_SEC", "3600"))
+    if backend_name == "none":
+        return None
+    if backend_name == "sqlite":
+        path = os.getenv("GEMINI_CACHE_PATH", "gemini_cache.sqlite3")
+        return ResponseCache(SQLiteCacheBackend(path, max_entries=max_entries, ttl_sec=ttl_sec))
+    if backend_name == "memory":
+        return ResponseCache(MemoryCacheBackend(max_entries=max_entries, ttl_sec=ttl_sec))
+    raise ValueError(f"GEMINI_CACHE_BACKEND が不正です: {backend_name}")
 
 class GeminiProcessor:
     def __init__(
@@ -224,21 +912,98 @@ class GeminiProcessor:
         model_name: str = "models/gemini-2.5-flash-lite-preview-06-17",
         options: GeminiOptions = GeminiOptions(),
         project_id: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        validator: Optional[Callable[[str], List[str]]] = None,
     ):
         load_dotenv()
         api_key = os.getenv(api_key_env)
         if not api_key:
             raise ValueError(f"{api_key_env} が設定されていません")
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=options.to_generation_config(),
-            safety_settings=options.safety_settings,
-            system_instruction=options.system_instruction,
-            tools=options.tools,
-        )
+        self.model_name = model_name
         self.options = options
         self.project_id = project_id
+        self.cache = cache
+        # 応答テキストの検証（エラーのリストを返す）。エラーのある応答はキャッシュせず、キャッシュから返しもしない
+        self.validator = validator
+        # system_instruction ごとの GenerativeModel キャッシュ（行ごとの system-prompt で増え続けないよう、
+        # GEMINI_MODEL_CACHE_SIZE 個を超えたら最も長く使われていないものから捨てる）
+        self._models: "OrderedDict[Optional[str], genai.GenerativeModel]" = OrderedDict()
+        self._models_max = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "32"))
+        self._models_lock = threading.Lock()
+        self.model = self._get_model(options.system_instruction)
+
+    def _get_model(self, system_instruction: Optional[str]) -> genai.GenerativeModel:
+        # system_instruction ごとに GenerativeModel を1度だけ生成して使い回す
+        with self._models_lock:
+            model = self._models.get(system_instruction)
+            if model is None:
+                model = genai.GenerativeModel(
+                    model_name=self.model_name,
+                    generation_config=self.options.to_generation_config(),
+                    safety_settings=self.options.safety_settings,
+                    system_instruction=system_instruction,
+                    tools=self.options.tools,
+                )
+                self._models[system_instruction] = model
+                if len(self._models) > self._models_max:
+                    self._models.popitem(last=False)
+            else:
+                self._models.move_to_end(system_instruction)
+            return model
+
+    def _select_model(self, system_prompt: Any) -> genai.GenerativeModel:
+        if pd.notna(system_prompt) and system_prompt:
+            return self._get_model(str(system_prompt))
+        return self.model
+
+    def _cache_key(self, system_prompt: Any, human_prompt: Any) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return make_cache_key(self.model_name, asdict(self.options), system_prompt, human_prompt)
+
+    def _cacheable(self, text: str, log: bool = True) -> bool:
+        """validator を通る応答だけをキャッシュする（壊れた応答を同じプロンプトに返し続けないように）"""
+        if self.validator is None:
+            return True
+        errors = self.validator(text)
+        if errors and log:
+            print(f"応答がスキーマに合わないためキャッシュしません: {'; '.join(errors[:3])}")
+        return not errors
+
+    def _call_row(self, system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+        start = time.perf_counter()
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                return cached, time.perf_counter() - start
+        try:
+            reply = self._select_model(system_prompt).generate_content(str(human_prompt))
+            text = reply.text
+            # エラー応答・スキーマに合わない応答はキャッシュしない
+            if cache_key is not None and self._cacheable(text):
+                self.cache.set(cache_key, text)
+        except Exception as e:
+            text = json.dumps({"error": str(e)})
+        return text, time.perf_counter() - start
+
+    async def _call_row_async(self, system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+        start = time.perf_counter()
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                return cached, time.perf_counter() - start
+        try:
+            model = self._select_model(system_prompt)
+            reply = await model.generate_content_async(str(human_prompt))
+            text = reply.text
+            if cache_key is not None and self._cacheable(text):
+                await self.cache.set_async(cache_key, text)
+        except Exception as e:
+            text = json.dumps({"error": str(e)})
+        return text, time.perf_counter() - start
 
     def process_dataframe(
         self,
@@ -246,40 +1011,193 @@ class GeminiProcessor:
         system_prompt_col: str = "system_prompt",
         human_prompt_col: str = "human_prompt",
         output_col: str = "output",
+        max_concurrency: int = 1,
+        latency_col: Optional[str] = "latency_sec",
     ) -> pd.DataFrame:
         if not {system_prompt_col, human_prompt_col}.issubset(df.columns):
             raise ValueError("必要なカラムがありません")
         res = df.copy()
-        res[output_col] = None
-        for idx, row in res.iterrows():
-            try:
-                chat = self.model.start_chat(history=[])
-                if pd.notna(row[system_prompt_col]):
-                    chat.send_message(row[system_prompt_col])
-                reply = chat.send_message(str(row[human_prompt_col]))
-                res.at[idx, output_col] = reply.text
-            except Exception as e:
-                res.at[idx, output_col] = json.dumps({"error": str(e)})
+        rows = list(zip(res[system_prompt_col], res[human_prompt_col]))
+        if max_concurrency <= 1 or len(rows) <= 1:
+            results = [self._call_row(sp, hp) for sp, hp in rows]
+        else:
+            # executor.map は入力順で結果を返すので行順は保たれる
+            with ThreadPoolExecutor(max_workers=min(max_concurrency, len(rows))) as executor:
+                results = list(executor.map(lambda r: self._call_row(*r), rows))
+        res[output_col] = [text for text, _ in results]
+        if latency_col:
+            res[latency_col] = [latency for _, latency in results]
         return res
 
-def load_bigquery_data() -> pd.DataFrame:
+    async def process_dataframe_async(
+        self,
+        df: pd.DataFrame,
+        system_prompt_col: str = "system_prompt",
+        human_prompt_col: str = "human_prompt",
+        output_col: str = "output",
+        max_concurrency: int = 8,
+        latency_col: Optional[str] = "latency_sec",
+    ) -> pd.DataFrame:
+        if not {system_prompt_col, human_prompt_col}.issubset(df.columns):
+            raise ValueError("必要なカラムがありません")
+        res = df.copy()
+        rows = list(zip(res[system_prompt_col], res[human_prompt_col]))
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run(system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+            async with semaphore:
+                return await self._call_row_async(system_prompt, human_prompt)
+
+        # gather は入力順で結果を返すので行順は保たれる
+        results = await asyncio.gather(*(run(sp, hp) for sp, hp in rows))
+        res[output_col] = [text for text, _ in results]
+        if latency_col:
+            res[latency_col] = [latency for _, latency in results]
+        return res
+
+    async def stream_text_async(self, system_prompt: Any, human_prompt: Any) -> AsyncIterator[str]:
+        # キャッシュヒット時は全文を1チャンクで返す。例外は呼び出し側に伝播する
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                yield cached
+                return
+        model = self._select_model(system_prompt)
+        response = await model.generate_content_async(str(human_prompt), stream=True)
+        chunks = []
+        async for chunk in response:
+            # finish_reason だけのチャンクなど、テキストを持たないものは読み飛ばす
+            if not chunk.parts:
+                continue
+            chunks.append(chunk.text)
+            yield chunk.text
+        text = "".join(chunks)
+        if cache_key is not None and self._cacheable(text):
+            await self.cache.set_async(cache_key, text)
+
+# デモグラ情報を探す期間（日数）。この期間に無ければ全期間から探す
+DEMOGRAPHICS_LOOKBACK_DAYS = int(os.getenv("DEMOGRAPHICS_LOOKBACK_DAYS", "30"))
+
+def load_bigquery_data(user_id: Optional[str] = None) -> pd.DataFrame:
+    """
+    BigQueryから世帯のデモグラ情報を読み込む
+
+    Parameters
+    ----------
+    user_id : Optional[str]
+        世帯のユーザーID。user_id 列のある表ではこのユーザーの行を優先し、
+        無ければ user_id の無い移行前の行から探す（ほかのユーザーの行は返さない）
+
+    Returns
+    -------
+    pd.DataFrame
+        Demo_Remake の最新の1行
+    """
     project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
     dataset_name = os.getenv('BIGQUERY_DATASET')
+
+    # テーブル名の設定
     demo_table = f'{project_name}.{dataset_name}.Demo_Remake'
-    demo_query = f"""
-        SELECT *
-        FROM `{demo_table}`
-        WHERE SAFE.PARSE_TIMESTAMP('%Y-%m-%dT%H:%M:%E*S%Ez', created_at) IS NOT NULL
-        ORDER BY created_at DESC
-        LIMIT 1
-    """
-    demo = pandas_gbq.read_gbq(
-        demo_query.replace('\n', ' ').replace('\u3000', ''),
-        project_id=project_name,
-        dialect='standard'
+
+    # 列と型（移行前の表には user_id 列が無い）
+    columns = {field.name: field.field_type for field in registry.get("bigquery").get_table(demo_table).schema}
+    # 移行前の表では created_at が ISO 8601 の STRING のため、読める値だけを TIMESTAMP にして比べる
+    if columns.get("created_at") == "TIMESTAMP":
+        created_at = "created_at"
+    else:
+        created_at = "SAFE.PARSE_TIMESTAMP('%Y-%m-%dT%H:%M:%E*S%Ez', created_at)"
+    configuration = None
+    if user_id is not None and "user_id" in columns:
+        user_filter = f"(user_id = @user_id OR user_id IS NULL) AND {created_at} IS NOT NULL"
+        order = f"user_id IS NULL, {created_at} DESC"
+        configuration = {"query": {"parameterMode": "NAMED", "queryParameters": [{
+            "name": "user_id",
+            "parameterType": {"type": "STRING"},
+            "parameterValue": {"value": user_id},
+        }]}}
+    else:
+        user_filter = f"{created_at} IS NOT NULL"
+        order = f"{created_at} DESC"
+
+    def read(where: str) -> pd.DataFrame:
+        return pandas_gbq.read_gbq(
+            f"SELECT * FROM `{demo_table}` WHERE {where} ORDER BY {order} LIMIT 1",
+            project_id=project_name,
+            dialect='standard',
+            configuration=configuration,
+        )
+
+    # created_at のパーティションで直近だけを読む（見つからなければ全期間から探す）
+    demo = read(
+        f"{user_filter} AND {created_at} >= "
+        f"TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {DEMOGRAPHICS_LOOKBACK_DAYS} DAY)"
     )
+    if demo.empty:
+        demo = read(user_filter)
     return demo
 
+# ─────────────────────────────────────────────
+# デモグラ情報のキャッシュ
+# ─────────────────────────────────────────────
+class DemographicsCache:
+    """
+    世帯のデモグラ情報（load_bigquery_data(user_id) の結果）を user_id ごとに TTL 付きでメモリに保持する。
+    入力フォームが新しいプロフィールを書き込んだら /invalidate_demographics で破棄する
+
+    Notes
+    -----
+    キャッシュはインスタンスごとに持つため、破棄の通知が届かなかったインスタンスでも
+    ttl_sec を過ぎれば読み直される
+    """
+
+    def __init__(self, loader: Callable[[str], pd.DataFrame], ttl_sec: float = 300):
+        self.loader = loader
+        self.ttl_sec = ttl_sec
+        self._entries: Dict[str, Tuple[float, pd.DataFrame]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str) -> pd.DataFrame:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_sec:
+                self.hits += 1
+                return entry[1].copy()
+            self.misses += 1
+            generation = self._generation
+        demo = self.loader(user_id)
+        with self._lock:
+            # 読み込み中に破棄された場合は古いプロフィールの可能性があるため保存しない
+            if generation == self._generation:
+                self._entries[user_id] = (time.monotonic(), demo)
+        return demo.copy()
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        """user_id のキャッシュを破棄する（省略時はすべて）"""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+# DEMOGRAPHICS_CACHE_TTL_SEC: キャッシュの有効秒数（既定 300、0 でキャッシュしない）
+demographics_cache = DemographicsCache(
+    load_bigquery_data,
+    ttl_sec=float(os.getenv("DEMOGRAPHICS_CACHE_TTL_SEC", "300")),
+)
+
+def get_demographics(user_id: Optional[str] = None) -> pd.DataFrame:
+    """デモグラ情報をキャッシュ経由で取得する"""
+    return demographics_cache.get(user_id or os.getenv("DEFAULT_USER_ID", "user_001"))
+
 def generate_menu(processor: GeminiProcessor, human_prompt: str) -> pd.DataFrame:
     data = {
         "human_prompt": [human_prompt],
@@ -294,8 +1212,88 @@ def generate_menu(processor: GeminiProcessor, human_prompt: str) -> pd.DataFrame
     )
     return result_df
 
+async def generate_menu_async(processor: GeminiProcessor, human_prompt: str) -> pd.DataFrame:
+    df = pd.DataFrame({
+        "human_prompt": [human_prompt],
+        "system_prompt": [SYSTEM_PROMPT]
+    })
+    return await processor.process_dataframe_async(
+        df,
+        human_prompt_col="human_prompt",
+        system_prompt_col="system_prompt",
+        output_col="output"
+    )
+
+class MenuStreamParser:
+    """
+    ストリーミング中のメニューJSONを少しずつ受け取り、
+    値が確定したトップレベルのフィールド（title, nutrition, ingredients ...）を順に取り出す
+    """
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key: Optional[str] = None
+        self._key_start: Optional[int] = None
+        self._value_start: Optional[int] = None
+
+    def _finish_value(self, end: int, completed: List[Tuple[str, Any]]) -> None:
+        if self._key is not None and self._value_start is not None:
+            try:
+                value = json.loads(self.buffer[self._value_start:end])
+            except json.JSONDecodeError:
+                value = None
+            if value is not None:
+                self.fields[self._key] = value
+                completed.append((self._key, value))
+        self._key = None
+        self._value_start = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """チャンクを追加し、新たに確定した (キー, 値) のリストを返す"""
+        self.buffer += chunk
+        completed: List[Tuple[str, Any]] = []
+        for i in range(self._pos, len(self.buffer)):
+            ch = self.buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(self.buffer[self._key_start:i + 1])
+                        self._key_start = None
+                continue
+            if ch == '"':
+                self._in_string = True
+                # トップレベルで値を待っていない文字列はキー
+                if self._depth == 1 and self._key is None:
+                    self._key_start = i
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 1:
+                    self._finish_value(i, completed)
+                self._depth -= 1
+            elif ch == ":" and self._depth == 1 and self._key is not None:
+                self._value_start = i + 1
+            elif ch == "," and self._depth == 1:
+                self._finish_value(i, completed)
+        self._pos = len(self.buffer)
+        return completed
+
 def parse_menu_json(raw_json: str | dict) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # MealPlan のスキーマに合わない応答は DataFrame を作る前に SchemaValidationError にする
     data = raw_json if isinstance(raw_json, dict) else json.loads(raw_json)
+    errors = validate_meal_plan(data)
+    if errors:
+        raise SchemaValidationError(errors)
     header_df = pd.DataFrame([{
         "title":           data["title"],
         "cuisine":         data["cuisine"],
@@ -309,22 +1307,228 @@ def parse_menu_json(raw_json: str | dict) -> tuple[pd.DataFrame, pd.DataFrame, p
     })
     return header_df, nutrition_df, ingredients_df, instructions_df
 
-def generate_food_image(recipe_title: str, ingredient_list: list[str]) -> str:
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-    genai.configure(api_key=GOOGLE_API_KEY)
+# ─────────────────────────────────────────────
+# 料理画像ストア（タイトル＋材料のハッシュで永続キャッシュ）
+# ─────────────────────────────────────────────
+def normalize_dish_key(recipe_title: str, ingredient_list: list[str]) -> str:
+    """
+    タイトルと材料から料理画像のキーを作る。
+    表記ゆれ（全角/半角・大文字小文字・前後空白）と材料の並び順・重複は無視する
+    """
+    def norm(text: Any) -> str:
+        return unicodedata.normalize("NFKC", str(text)).strip().lower()
+
+    payload = json.dumps(
+        {
+            "title": norm(recipe_title),
+            "ingredients": sorted({norm(name) for name in ingredient_list if norm(name)}),
+        },
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def image_size(image_bytes: bytes) -> tuple[int, int]:
+    with Image.open(BytesIO(image_bytes)) as img:
+        return img.size
+
+class FirebaseImageStore:
+    """
+    Firebase Storage に料理画像を保存し、ダウンロードURLとサイズを返す
+    （パス: {prefix}{key}/{name}）
+    """
+
+    def __init__(self, bucket, prefix: str = "dish_images/"):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _path(self, key: str, name: str) -> str:
+        return f"{self.prefix}{key}/{name}"
+
+    def _describe(self, blob) -> Dict[str, Any]:
+        metadata = blob.metadata or {}
+        token = metadata.get("firebaseStorageDownloadTokens", "").split(",")[0]
+        url = (
+            f"https://firebasestorage.googleapis.com/v0/b/{self.bucket.name}/o/"
+            f"{quote(blob.name, safe='')}?alt=media&token={token}"
+        )
+        return {
+            "url": url,
+            "width": int(metadata.get("width", 0)),
+            "height": int(metadata.get("height", 0)),
+            "content_type": blob.content_type,
+        }
+
+    def get(self, key: str, name: str = "original.png") -> Optional[Dict[str, Any]]:
+        # get_blob は存在確認とメタデータ取得を1回のリクエストで行う
+        blob = self.bucket.get_blob(self._path(key, name))
+        if blob is None:
+            return None
+        return self._describe(blob)
+
+    def put(
+        self,
+        key: str,
+        image_bytes: bytes,
+        name: str = "original.png",
+        content_type: str = "image/png",
+    ) -> Dict[str, Any]:
+        width, height = image_size(image_bytes)
+        blob = self.bucket.blob(self._path(key, name))
+        blob.metadata = {
+            "width": str(width),
+            "height": str(height),
+            "firebaseStorageDownloadTokens": uuid.uuid4().hex,
+        }
+        blob.cache_control = "public, max-age=31536000, immutable"
+        blob.upload_from_string(image_bytes, content_type=content_type)
+        return self._describe(blob)
+
+    def get_manifest(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self.bucket.blob(self._path(key, "manifest.json")).download_as_bytes())
+        except NotFound:
+            return None
+
+    def put_manifest(self, key: str, manifest: Dict[str, Any]) -> None:
+        self.bucket.blob(self._path(key, "manifest.json")).upload_from_string(
+            json.dumps(manifest, ensure_ascii=False), content_type="application/json"
+        )
+
+class LocalImageStore:
+    """ローカルファイルシステムに料理画像を保存する（テスト・ローカル開発用）"""
+
+    def __init__(self, root_dir: str, base_url: Optional[str] = None):
+        self.root_dir = root_dir
+        self.base_url = (base_url or f"file://{os.path.abspath(root_dir)}").rstrip("/")
+
+    def get(self, key: str, name: str = "original.png") -> Optional[Dict[str, Any]]:
+        meta_path = os.path.join(self.root_dir, key, f"{name}.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def put(
+        self,
+        key: str,
+        image_bytes: bytes,
+        name: str = "original.png",
+        content_type: str = "image/png",
+    ) -> Dict[str, Any]:
+        width, height = image_size(image_bytes)
+        os.makedirs(os.path.join(self.root_dir, key), exist_ok=True)
+        with open(os.path.join(self.root_dir, key, name), "wb") as f:
+            f.write(image_bytes)
+        info = {
+            "url": f"{self.base_url}/{key}/{name}",
+            "width": width,
+            "height": height,
+            "content_type": content_type,
+        }
+        with open(os.path.join(self.root_dir, key, f"{name}.json"), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        return info
+
+    def get_manifest(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.get(key, name="manifest")
+
+    def put_manifest(self, key: str, manifest: Dict[str, Any]) -> None:
+        os.makedirs(os.path.join(self.root_dir, key), exist_ok=True)
+        with open(os.path.join(self.root_dir, key, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+def create_image_store():
+    """
+    環境変数から料理画像ストアを作成する
+
+    DISH_IMAGE_STORE     : firebase / local（既定: FIREBASE_STORAGE_BUCKET があれば firebase）
+    DISH_IMAGE_LOCAL_DIR : local のときの保存先（既定: dish_images）
+    DISH_IMAGE_BASE_URL  : local のときのURLの接頭辞
+    """
+    default = "firebase" if os.getenv("FIREBASE_STORAGE_BUCKET") else "local"
+    store_name = os.getenv("DISH_IMAGE_STORE", default).lower()
+    if store_name == "local":
+        return LocalImageStore(
+            os.getenv("DISH_IMAGE_LOCAL_DIR", "dish_images"),
+            base_url=os.getenv("DISH_IMAGE_BASE_URL"),
+        )
+    if store_name == "firebase":
+        from firebase_admin import credentials, storage
+        if not firebase_admin._apps:
+            cred_path = os.getenv("FIREBASE_CRED_PATH")
+            # 認証情報ファイルがなければ Cloud Run のサービスアカウント（ADC）を使う
+            cred = credentials.Certificate(cred_path) if cred_path else None
+            firebase_admin.initialize_app(cred, {"storageBucket": os.getenv("FIREBASE_STORAGE_BUCKET")})
+        return FirebaseImageStore(storage.bucket())
+    raise ValueError(f"DISH_IMAGE_STORE が不正です: {store_name}")
+
+# 生成画像のサイズ違い（ラベル, 最大幅）。thumb はカード表示用、full はタップ時の拡大表示用
+IMAGE_VARIANT_WIDTHS = [("thumb", 400), ("full", 1024)]
+# (拡張子, PILのフォーマット名, Content-Type)
+IMAGE_VARIANT_FORMATS = [("webp", "WEBP", "image/webp"), ("jpg", "JPEG", "image/jpeg")]
+# 変換・アップロード用のワーカープール
+image_executor = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_VARIANT_WORKERS", "4")))
+
+def encode_image_variant(image_bytes: bytes, max_width: int, pil_format: str) -> bytes:
+    """画像を最大幅 max_width に縮小し、WebP / JPEG に再エンコードする"""
+    with Image.open(BytesIO(image_bytes)) as img:
+        img = img.convert("RGB")
+        if img.width > max_width:
+            height = round(img.height * max_width / img.width)
+            img = img.resize((max_width, height), Image.LANCZOS)
+        buf = BytesIO()
+        if pil_format == "WEBP":
+            img.save(buf, format="WEBP", quality=80, method=4)
+        else:
+            img.save(buf, format="JPEG", quality=82, optimize=True, progressive=True)
+        return buf.getvalue()
+
+def store_image_variant(
+    key: str,
+    image_bytes: bytes,
+    label: str,
+    max_width: int,
+    ext: str,
+    pil_format: str,
+    content_type: str,
+) -> Dict[str, Any]:
+    data = encode_image_variant(image_bytes, max_width, pil_format)
+    return registry.get("image_store").put(key, data, name=f"{label}.{ext}", content_type=content_type)
+
+async def store_food_image_async(key: str, image_bytes: bytes) -> Dict[str, Any]:
+    """
+    原寸PNGとサイズ違いの WebP / JPEG をワーカープールで並行して作成・保存し、
+    最後に manifest を書き込む（manifest があれば全て揃っている）
+    """
+    loop = asyncio.get_running_loop()
+    image_store = registry.get("image_store")
+    variant_specs = [
+        (label, max_width, ext, pil_format, content_type)
+        for label, max_width in IMAGE_VARIANT_WIDTHS
+        for ext, pil_format, content_type in IMAGE_VARIANT_FORMATS
+    ]
+    original, *variants = await asyncio.gather(
+        loop.run_in_executor(image_executor, image_store.put, key, image_bytes),
+        *(
+            loop.run_in_executor(image_executor, store_image_variant, key, image_bytes, *spec)
+            for spec in variant_specs
+        ),
+    )
+    manifest = {**original, "variants": {}}
+    for (label, _, ext, _, _), info in zip(variant_specs, variants):
+        manifest["variants"].setdefault(label, {})[ext] = info
+    await loop.run_in_executor(image_executor, image_store.put_manifest, key, manifest)
+    return manifest
+
+def build_food_image_prompt(recipe_title: str, ingredient_list: list[str]) -> str:
     ingredient_text = ", ".join(ingredient_list)
-    prompt = (
+    return (
         f"High quality food photograph, {recipe_title}, ingredients: {ingredient_text}, beautiful plating, Japanese cuisine, "
         "shot from above, natural lighting, plain background, no watermark, no text, no logo. "
         "Respond ONLY with a PNG image as base64, NO description, NO explanation, NO text."
     )
-    model = genai.GenerativeModel(model_name="gemini-2.0-flash-preview-image-generation")
-    response = model.generate_content(
-        prompt,
-        generation_config={
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-    )
+
+def extract_image_base64(response) -> str:
     image_base64 = None
     for part in response.candidates[0].content.parts:
         if isinstance(part, dict):
@@ -347,10 +1551,189 @@ def generate_food_image(recipe_title: str, ingredient_list: list[str]) -> str:
         raise Exception("No image found in the response.")
     return image_base64
 
+def generate_food_image(recipe_title: str, ingredient_list: list[str]) -> str:
+    model = registry.get("image_model")
+    response = model.generate_content(
+        build_food_image_prompt(recipe_title, ingredient_list),
+        generation_config={
+            "response_modalities": ["TEXT", "IMAGE"]
+        }
+    )
+    return extract_image_base64(response)
+
+def extract_image_bytes(response) -> bytes:
+    """Gemini の応答から画像のバイト列を取り出す"""
+    return base64.b64decode(extract_image_base64(response))
+
+async def generate_food_image_bytes_async(recipe_title: str, ingredient_list: list[str]) -> bytes:
+    """料理画像を生成し、PNG のバイト列を返す（asyncio 版）"""
+    model = registry.get("image_model")
+    response = await model.generate_content_async(
+        build_food_image_prompt(recipe_title, ingredient_list),
+        generation_config={
+            "response_modalities": ["TEXT", "IMAGE"]
+        }
+    )
+    return extract_image_bytes(response)
+
+async def get_or_create_food_image_async(recipe_title: str, ingredient_list: list[str]) -> Dict[str, Any]:
+    """
+    同じ料理（正規化したタイトル＋材料）の画像がストアにあれば再利用し、
+    なければ生成して保存する
+
+    Returns
+    -------
+    Dict[str, Any]
+        url, width, height, content_type（原寸PNG）, variants（thumb/full の webp/jpg）, cached
+    """
+    key = normalize_dish_key(recipe_title, ingredient_list)
+    image_store = await asyncio.to_thread(registry.get, "image_store")
+    stored = await asyncio.to_thread(image_store.get_manifest, key)
+    if stored is not None:
+        return {**stored, "cached": True}
+    image_bytes = await generate_food_image_bytes_async(recipe_title, ingredient_list)
+    stored = await store_food_image_async(key, image_bytes)
+    return {**stored, "cached": False}
+
+async def generate_menu_and_image_pipelined(
+    processor: GeminiProcessor,
+    human_prompt: str,
+) -> tuple[tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame], Dict[str, Any]]:
+    """
+    メニュー生成をストリーミングで受け取り、title と ingredients が確定した時点で
+    料理画像の生成を開始して、残りのメニュー生成（手順など）と並行させる
+
+    Returns
+    -------
+    tuple
+        ((header_df, nutrition_df, ingredients_df, instructions_df), image_info)
+    """
+    parser = MenuStreamParser()
+    image_task = None
+    try:
+        async for chunk in processor.stream_text_async(SYSTEM_PROMPT, human_prompt):
+            parser.feed(chunk)
+            if image_task is None and "title" in parser.fields and "ingredients" in parser.fields:
+                ingredient_names = [
+                    item.get("name", "") for item in parser.fields["ingredients"] if isinstance(item, dict)
+                ]
+                image_task = asyncio.create_task(
+                    get_or_create_food_image_async(parser.fields["title"], ingredient_names)
+                )
+
+        header_df, nutrition_df, ingredients_df, instructions_df = parse_menu_json(parser.buffer)
+        if image_task is None:
+            # ストリーム途中で取り出せなかった場合はパース結果から生成する
+            ingredient_names = [row["name"] for _, row in ingredients_df.iterrows()]
+            image_task = asyncio.create_task(
+                get_or_create_food_image_async(header_df.iloc[0]["title"], ingredient_names)
+            )
+        image_info = await image_task
+    except BaseException:
+        if image_task is not None:
+            image_task.cancel()
+        raise
+    return (header_df, nutrition_df, ingredients_df, instructions_df), image_info
+
 # ─────────────────────────────────────────────
 # 4. FastAPI サーバ
 # ─────────────────────────────────────────────
-app = FastAPI()
+# ─────────────────────────────────────────────
+# プロセス共有のクライアント
+# ─────────────────────────────────────────────
+class ClientRegistry:
+    """
+    メニュー生成の GeminiProcessor・料理画像のバケット・チラシ認識の ImageProcessor・画像生成モデル・
+    BigQuery クライアントをプロセス内で1つずつ保持する。起動時（lifespan）に warmup し、/readyz で状態を返す
+    """
+
+    def __init__(self) -> None:
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+        self.errors: Dict[str, str] = {}
+        self.timings: Dict[str, float] = {}
+        self.ready = False
+        self.warmed_up = False
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        self._factories[name] = factory
+
+    def get(self, name: str) -> Any:
+        if name not in self._instances:
+            with self._lock:
+                if name not in self._instances:
+                    self._instances[name] = self._factories[name]()
+        return self._instances[name]
+
+    def warmup(self) -> None:
+        """登録済みのクライアントをすべて生成する（失敗したものは errors に記録し、次回の get で再試行）"""
+        for name in self._factories:
+            started = time.perf_counter()
+            try:
+                self.get(name)
+                self.errors.pop(name, None)
+            except Exception as e:
+                print(f"{name} の初期化に失敗しました: {str(e)}")
+                self.errors[name] = str(e)
+            self.timings[name] = round(time.perf_counter() - started, 3)
+        self.ready = not self.errors
+        self.warmed_up = True
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "clients": sorted(self._instances), "errors": self.errors}
+
+def create_bigquery_client() -> bigquery.Client:
+    """BigQuery クライアントを生成し、pandas_gbq も同じ認証情報を使うよう設定する"""
+    credentials, default_project = google_auth.default(
+        scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    project = os.getenv("GOOGLE_CLOUD_PROJECT") or default_project
+    # pandas_gbq の呼び出しごとに行われる認証情報の探索を省く
+    pandas_gbq.context.credentials = credentials
+    pandas_gbq.context.project = project
+    return bigquery.Client(project=project, credentials=credentials)
+
+# 料理画像生成モデル
+IMAGE_MODEL_NAME = os.getenv("IMAGE_MODEL_NAME", "gemini-2.0-flash-preview-image-generation")
+
+def create_image_model() -> genai.GenerativeModel:
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai.GenerativeModel(model_name=IMAGE_MODEL_NAME)
+
+setup_environment()
+registry = ClientRegistry()
+registry.register("processor", create_processor)
+registry.register("image_store", create_image_store)
+# チラシ OCR 用の ImageProcessor（Firebase 認証・モデル生成を1度だけ行う）
+registry.register("flyer_processor", ImageProcessor)
+registry.register("image_model", create_image_model)
+registry.register("bigquery", create_bigquery_client)
+
+def warmup() -> None:
+    """重いモジュールの読み込みとクライアント生成を行い、所要時間を起動レポートとして出力する"""
+    started = time.perf_counter()
+    for module in LAZY_MODULES:
+        module_started = time.perf_counter()
+        module.load()
+        registry.timings[f"import:{module._name}"] = round(time.perf_counter() - module_started, 3)
+    registry.warmup()
+    print(json.dumps({
+        "startup_report": {
+            "module_load_sec": round(MODULE_LOADED - MODULE_LOAD_STARTED, 3),
+            "warmup_sec": round(time.perf_counter() - started, 3),
+            "breakdown_sec": registry.timings,
+        }
+    }, ensure_ascii=False))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warmup はバックグラウンドで行い、ポートの待ち受けを先に始める（準備状況は /readyz で確認）
+    warmup_task = asyncio.create_task(asyncio.to_thread(warmup))
+    yield
+    warmup_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -359,23 +1742,80 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-setup_environment()
-processor = create_processor()
+# メニュー生成と画像生成をパイプライン実行するか（MENU_PIPELINE=0 で逐次実行）
+MENU_PIPELINE = os.getenv("MENU_PIPELINE", "1") == "1"
 
 class DummyRequest(BaseModel):
     pass
 
+# ─────────────────────────────────────────────
+# 呼び出し元の認証（Firebase ID トークン）
+# ─────────────────────────────────────────────
+# ID トークンの検証専用の Firebase アプリ名（Storage 用の既定アプリの設定には触れない）
+ID_TOKEN_APP = "id-token-verifier"
+_id_token_app_lock = threading.Lock()
+
+def verify_firebase_user(authorization: Optional[str]) -> str:
+    """
+    Authorization: Bearer <Firebase ID トークン> を検証して uid を返す（無い・不正な場合は 401）
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Firebase の ID トークンが必要です")
+    from firebase_admin import auth
+    with _id_token_app_lock:
+        try:
+            verifier = firebase_admin.get_app(ID_TOKEN_APP)
+        except ValueError:
+            verifier = firebase_admin.initialize_app(
+                options={"projectId": os.getenv("FIREBASE_PROJECT_ID") or os.getenv("GOOGLE_CLOUD_PROJECT")},
+                name=ID_TOKEN_APP,
+            )
+    try:
+        return auth.verify_id_token(authorization[len("Bearer "):], app=verifier)["uid"]
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"ID トークンの検証に失敗しました: {e}")
+
+class InvalidateDemographicsRequest(BaseModel):
+    user_id: Optional[str] = None
+
+@app.post("/invalidate_demographics")
+async def invalidate_demographics(
+    req: InvalidateDemographicsRequest,
+    authorization: Optional[str] = Header(None),
+):
+    """
+    入力フォームが新しいプロフィールを書き込んだときに呼ぶ。
+    ID トークンのユーザーのキャッシュだけを破棄する（ほかのユーザーの user_id を指定した場合は 403）
+    """
+    user_id = await asyncio.to_thread(verify_firebase_user, authorization)
+    if req.user_id is not None and req.user_id != user_id:
+        raise HTTPException(status_code=403, detail="ほかのユーザーのキャッシュは破棄できません")
+    demographics_cache.invalidate(user_id)
+    return {"result": "ok", "cache": demographics_cache.stats()}
+
+@app.get("/readyz")
+async def readyz():
+    """レディネスプローブ。warmup 中は 503、初期化に失敗したクライアントがあれば再試行する"""
+    if registry.warmed_up and not registry.ready:
+        await asyncio.to_thread(registry.warmup)
+    status = registry.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
 @app.post("/generate_menu_from_flyer")
-def generate_menu_from_flyer(_: DummyRequest):
+async def generate_menu_from_flyer(req: DummyRequest, authorization: Optional[str] = Header(None)):
+    # 世帯は ID トークンの uid で決める（ボディの user_id は信用しない）
+    user_id = await asyncio.to_thread(verify_firebase_user, authorization)
     try:
-        # 1. チラシから商品抽出
-        flyer_processor = ImageProcessor()
-        product_list = flyer_processor.recognize_flyer()
+        # 1. チラシから商品抽出 / 2. デモグラ取得（OCR と BigQuery 読み込みを並行実行）
+        processor = await asyncio.to_thread(registry.get, "processor")
+        flyer_processor = await asyncio.to_thread(registry.get, "flyer_processor")
+        product_list, demo = await asyncio.gather(
+            flyer_processor.recognize_flyer_async(),
+            asyncio.to_thread(get_demographics, user_id),
+        )
         product_names = [item['商品'] for item in product_list if '商品' in item]
         product_block = "\n".join(f"- {name}" for name in product_names)
 
-        # 2. デモグラ取得
-        demo = load_bigquery_data()
         num_people = len(demo)
         people_desc = []
         for _, row in demo.iterrows():
@@ -410,14 +1850,19 @@ def generate_menu_from_flyer(_: DummyRequest):
         - 可能な範囲で近くのスーパーの商品リストを使用してレシピを作ること
         """
 
-        # 4. Gemini呼び出し
-        result_df = generate_menu(processor, human_prompt)
-        header_df, nutrition_df, ingredients_df, instructions_df = parse_menu_json(result_df.loc[0, "output"])
+        if MENU_PIPELINE:
+            # 4. Gemini呼び出し / 5. 画像生成（重ねて実行）
+            menu_dfs, image_info = await generate_menu_and_image_pipelined(processor, human_prompt)
+            header_df, nutrition_df, ingredients_df, instructions_df = menu_dfs
+        else:
+            # 4. Gemini呼び出し
+            result_df = await generate_menu_async(processor, human_prompt)
+            header_df, nutrition_df, ingredients_df, instructions_df = parse_menu_json(result_df.loc[0, "output"])
 
-        # 5. 画像生成
-        ingredient_names = [row["name"] for _, row in ingredients_df.iterrows()]
-        recipe_title = header_df.iloc[0]["title"]
-        image_base64 = generate_food_image(recipe_title, ingredient_names)
+            # 5. 画像生成
+            ingredient_names = [row["name"] for _, row in ingredients_df.iterrows()]
+            recipe_title = header_df.iloc[0]["title"]
+            image_info = await get_or_create_food_image_async(recipe_title, ingredient_names)
 
         # 6. 返却
         return {
@@ -425,10 +1870,13 @@ def generate_menu_from_flyer(_: DummyRequest):
             "nutrition": nutrition_df.to_dict(orient="records"),
             "ingredients": ingredients_df.to_dict(orient="records"),
             "instructions": instructions_df.to_dict(orient="records"),
-            "image_base64": image_base64,
+            "image": image_info,
             "demo": demo.to_dict(orient="records"),
             "flyer_products": product_list
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+# モジュール読み込みの完了時刻（起動レポート用）
+MODULE_LOADED = time.perf_counter()
@@ -7,10 +7,17 @@ import os
 import sys
 import json
 import pandas as pd
-import pandas_gbq 
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from shared.gemini_processor import GeminiOptions, GeminiProcessor
+from shared.gemini_processor import (
+    GeminiOptions, GeminiProcessor, SchemaValidationError, compile_validator, create_response_cache,
+    json_text_validator, to_gemini_schema
+)
+from shared.bigquery_writer import BigQueryBatchWriter, create_bigquery_writer, new_menu_id, row_ids_for_key
+from shared.bigquery_reader import BigQueryReader, create_bigquery_reader
+from shared.inventory import InventoryStore, create_inventory_store, quantity_changes
+from shared.prompt_context import PromptSection, build_prompt_context, days_until, format_report, rank_items
 from typing import Union
 
 # スキーマ定義
@@ -74,6 +81,10 @@ RESPONSE_SCHEMA = {
     }
 }
 
+# Gemini に渡す形（$ref を展開したもの）と、parse_menu_json で使う検証関数（どちらも読み込み時に1回だけ作る）
+GEMINI_RESPONSE_SCHEMA = to_gemini_schema(RESPONSE_SCHEMA)
+validate_meal_plan = compile_validator(RESPONSE_SCHEMA)
+
 # システムプロンプト
 SYSTEM_PROMPT = """
 あなたは「パーソナル栄養プランナーAI」です。
@@ -102,10 +113,6 @@ SYSTEM_PROMPT = """
         "carb_g": 45,      // 数値（g）
         "salt_g": 2.5      // 数値（g）
     }},
-    "instructions": [
-        "手順1",
-        "手順2"
-    ],
     "ingredients": [
         {{
             "name": "鶏胸肉",
@@ -122,6 +129,10 @@ SYSTEM_PROMPT = """
             "quantity": "100",
             "unit": "g"
         }}
+    ],
+    "instructions": [
+        "手順1",
+        "手順2"
     ]
 }}
 
@@ -129,6 +140,7 @@ SYSTEM_PROMPT = """
 - nutritionの値は必ず数値型で出力（単位は含めない）
 - ingredientsは必ずオブジェクトの配列として出力
 - total_time_minは必ず整数値で出力
+- キーは title, cuisine, total_time_min, nutrition, ingredients, instructions の順で出力
 """
 
 def setup_environment() -> None:
@@ -157,64 +169,158 @@ def create_processor() -> GeminiProcessor:
     GeminiProcessor
         設定済みのGeminiProcessorインスタンス
     """
-    schema_tool = {"type": "response_schema", "schema": RESPONSE_SCHEMA}
-
     opts = GeminiOptions(
         temperature=float(os.getenv('GEMINI_TEMPERATURE', '0.3')),
         max_output_tokens=int(os.getenv('GEMINI_MAX_OUTPUT_TOKENS', '10000')),
-        tools=None
-        # tools=[schema_tool]  # スキーマツールを設定
+        # 出力を MealPlan のスキーマに制約する（壊れた JSON や欠けた項目の応答を生成させない）
+        response_schema=GEMINI_RESPONSE_SCHEMA,
+    )
+
+    return GeminiProcessor(
+        options=opts,
+        cache=create_response_cache(),
+        # スキーマに合わない応答はキャッシュしない
+        validator=json_text_validator(validate_meal_plan),
     )
 
-    return GeminiProcessor(options=opts)
+# プロンプトで使う列（テーブルにない列は無視され、1列もなければ全列を読む。None は全列）
+PROMPT_COLUMNS = {
+    "demo": None,
+    "fridge_items": ["name", "quantity", "unit", "expiry_date"],
+    "recipe_ingredients": ["name", "quantity", "unit"],
+    # チラシはビューから各チラシの最新バージョンだけを読む
+    "flyer_current": ["商品", "値段", "特売日"],
+}
+
+# 直近の行だけを読むテーブルと日数（パーティション分割済みのテーブルでは対象のパーティションだけを読む）
+PROMPT_LOOKBACK_DAYS = {
+    "flyer_current": int(os.getenv('FLYER_LOOKBACK_DAYS', '7')),
+}
 
-def load_bigquery_data() -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+def load_bigquery_data(
+    reader: BigQueryReader = None,
+    user_id: str = None,
+    inventory_store: InventoryStore = None
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
-    BigQueryからデータを読み込む
+    BigQueryからデータを読み込む（4テーブルを並列に、必要な列とユーザーの行だけ読む）
+
+    冷蔵庫の中身は在庫スナップショット（inventory_snapshot）の現在値に fridge_items の期限を付けて使う。
+    スナップショットに在庫がなければ fridge_items の在庫で seed してから読み直し、それでもなければ fridge_items を使う
+
+    Parameters
+    ----------
+    reader : BigQueryReader, optional
+        読み込みに使うリーダー, by default None (新しく作成)
+    inventory_store : InventoryStore, optional
+        在庫の読み込みに使うストア, by default None (reader のクライアントで作成)
+    user_id : str, optional
+        ユーザーID, by default None (環境変数から取得)
 
     Returns
     -------
-    tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]
-        (demo, fridge_items, recipe_ingredients)のタプル
+    tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]
+        (demo, fridge_items, recipe_ingredients, flyer)のタプル
     """
     project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
     dataset_name = os.getenv('BIGQUERY_DATASET')
+    user_id = user_id or os.getenv('DEFAULT_USER_ID', 'user_001')
+    reader = reader or create_bigquery_reader()
+    inventory_store = inventory_store or create_inventory_store(reader.client)
 
-    # テーブル名の設定
-    demo_table = f'{project_name}.{dataset_name}.demo'
-    fridge_items_table = f'{project_name}.{dataset_name}.fridge_items'
-    recipe_ingredients_table = f'{project_name}.{dataset_name}.recipe_ingredients'
-    flyer_table = f'{project_name}.{dataset_name}.flyer_data'
-
-    # SQLクエリ
-    demo_query = f"SELECT * FROM `{demo_table}`"
-    fridge_items_query = f"SELECT * FROM `{fridge_items_table}`"
-    recipe_ingredients_query = f"SELECT * FROM `{recipe_ingredients_table}`"
-    flyer_query = f"SELECT * FROM `{flyer_table}`"
-
-    # データの読み込み（pandas_gbqを使用）
-    demo = pandas_gbq.read_gbq(
-        demo_query.replace('\n', ' ').replace('\u3000', ''),
-        project_id=project_name,
-        dialect='standard'
-    )
-    fridge_items = pandas_gbq.read_gbq(
-        fridge_items_query.replace('\n', ' ').replace('\u3000', ''),
-        project_id=project_name,
-        dialect='standard'
-    )
-    recipe_ingredients = pandas_gbq.read_gbq(
-        recipe_ingredients_query.replace('\n', ' ').replace('\u3000', ''),
-        project_id=project_name,
-        dialect='standard'
-    )
-    flyer = pandas_gbq.read_gbq(
-        flyer_query.replace('\n', ' ').replace('\u3000', ''),
-        project_id=project_name,
-        dialect='standard'
+    tables = {
+        f'{project_name}.{dataset_name}.{name}': columns
+        for name, columns in PROMPT_COLUMNS.items()
+    }
+    since_days = {
+        f'{project_name}.{dataset_name}.{name}': days
+        for name, days in PROMPT_LOOKBACK_DAYS.items()
+    }
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        inventory = executor.submit(inventory_store.read, user_id)
+        results = reader.read_many(tables, user_id=user_id, since_days=since_days)
+        current_inventory = inventory.result()
+    demo, fridge_items, recipe_ingredients, flyer = (results[table] for table in tables)
+    if current_inventory.empty and inventory_store.seed(user_id, fridge_items):
+        current_inventory = inventory_store.read(user_id)
+    if not current_inventory.empty:
+        fridge_items = attach_expiry_dates(current_inventory, fridge_items)
+    return demo, fridge_items, recipe_ingredients, flyer
+
+def attach_expiry_dates(inventory: pd.DataFrame, fridge_items: pd.DataFrame) -> pd.DataFrame:
+    """
+    在庫スナップショットに fridge_items の賞味期限（expiry_date）を付ける
+
+    スナップショットは数量だけを持つため、同じ名前の品目の期限を fridge_items から引く
+    （同じ名前が複数あれば最も近い期限。fridge_items にない品目は空）
+    """
+    if not {"name", "expiry_date"} <= set(fridge_items.columns):
+        return inventory
+    expiry = (
+        fridge_items[["name", "expiry_date"]]
+        .assign(_days=days_until(fridge_items["expiry_date"]))
+        .sort_values("_days", kind="stable")
+        .drop_duplicates(subset=["name"])
+        .rename(columns={"name": "ingredient_name"})
+        .drop(columns="_days")
     )
+    return inventory.merge(expiry, on="ingredient_name", how="left")
 
-    return demo, fridge_items, recipe_ingredients, flyer
+# プロンプトに載せる列（先頭の列で重複を除く。レシピの材料は名前だけで足りる）
+PROMPT_CONTEXT_COLUMNS = {
+    "fridge_items": ("name", "quantity", "unit", "expiry_date"),
+    "recipe_ingredients": ("name",),
+    "flyer_current": ("商品", "値段"),
+}
+
+# プロンプトに残す品目数（家庭の条件との関連度と期限・特売日の近さで上位を選ぶ）と、順位付けに使う列
+CONTEXT_TOP_K = {
+    "fridge_items": int(os.getenv('FRIDGE_TOP_K', '30')),
+    "recipe_ingredients": int(os.getenv('RECIPE_INGREDIENTS_TOP_K', '30')),
+    "flyer_current": int(os.getenv('FLYER_TOP_K', '40')),
+}
+RANKING_COLUMNS = {
+    "fridge_items": ("name", "expiry_date"),
+    "recipe_ingredients": ("name", None),
+    "flyer_current": ("商品", "特売日"),
+}
+
+def household_query(demo: pd.DataFrame) -> str:
+    """
+    順位付けに使う問い合わせ文（最新の家庭情報の dietary_style と feeling）
+    """
+    columns = [c for c in ("dietary_style", "feeling") if c in demo.columns]
+    if demo.empty or not columns:
+        return ""
+    if "created_at" in demo.columns:
+        demo = demo.sort_values("created_at")
+    latest = demo[columns].ffill().iloc[-1]
+    return " ".join(str(v) for v in latest.dropna())
+
+def select_context(
+    tables: dict[str, pd.DataFrame],
+    query: str
+) -> dict[str, pd.DataFrame]:
+    """
+    プロンプトに入れる前に、各テーブルを関連度順に並べて上位 CONTEXT_TOP_K 件に絞る
+
+    Parameters
+    ----------
+    tables : dict[str, pd.DataFrame]
+        テーブル名（CONTEXT_TOP_K のキー）と読み込んだデータ
+    query : str
+        household_query で作った問い合わせ文
+
+    Returns
+    -------
+    dict[str, pd.DataFrame]
+        絞り込んだテーブル
+    """
+    selected = {}
+    for table, df in tables.items():
+        name_column, date_column = RANKING_COLUMNS[table]
+        selected[table] = rank_items(df, query, name_column, date_column, top_k=CONTEXT_TOP_K[table])
+    return selected
 
 def generate_menu(processor: GeminiProcessor, human_prompt: str) -> pd.DataFrame:
     """
@@ -266,8 +372,16 @@ def parse_menu_json(raw_json: Union[str, dict]) -> tuple[pd.DataFrame, pd.DataFr
     -------
     tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]
         (header_df, nutrition_df, ingredients_df, instructions_df)のタプル
+
+    Raises
+    ------
+    SchemaValidationError
+        MealPlan のスキーマに合わない場合（DataFrame を作る前に検出する）
     """
     data = raw_json if isinstance(raw_json, dict) else json.loads(raw_json)
+    errors = validate_meal_plan(data)
+    if errors:
+        raise SchemaValidationError(errors)
 
     # ヘッダー情報
     header_df = pd.DataFrame([{
@@ -295,10 +409,12 @@ def save_to_bigquery(
     nutrition_df: pd.DataFrame,
     ingredients_df: pd.DataFrame,
     instructions_df: pd.DataFrame,
-    user_id: str = None
-) -> None:
+    writer: BigQueryBatchWriter,
+    user_id: str = None,
+    idempotency_key: str = None
+) -> str:
     """
-    生成したメニューをBigQueryに保存する
+    生成したメニューをBigQueryに保存する（writer のバッファに追加し、ストリーミング挿入でまとめて書き込む）
 
     Parameters
     ----------
@@ -310,8 +426,17 @@ def save_to_bigquery(
         材料情報
     instructions_df : pd.DataFrame
         調理手順
+    writer : BigQueryBatchWriter
+        書き込みに使うライター
     user_id : str, optional
         ユーザーID, by default None (環境変数から取得)
+    idempotency_key : str, optional
+        冪等キー。約1分以内の同じキーでの再保存は BigQuery 側で重複が排除される（insertId による best effort）, by default None
+
+    Returns
+    -------
+    str
+        保存したメニューのID
     """
     project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
     dataset_name = os.getenv('BIGQUERY_DATASET')
@@ -319,10 +444,11 @@ def save_to_bigquery(
 
     # 現在時刻（UTC）
     now = datetime.now(timezone.utc)
+    menu_id = new_menu_id()
 
     # メニューテーブル用のデータ作成
     menu_data = {
-        "menu_id": [f"menu_{now.strftime('%Y%m%d_%H%M%S')}"],
+        "menu_id": [menu_id],
         "user_id": [user_id],
         "created_at": [now],
         **header_df.iloc[0].to_dict(),
@@ -332,12 +458,12 @@ def save_to_bigquery(
 
     # 材料テーブル用のデータ作成
     ingredients_data = ingredients_df.copy()
-    ingredients_data["menu_id"] = menu_df["menu_id"].iloc[0]
+    ingredients_data["menu_id"] = menu_id
     ingredients_data["created_at"] = now
 
     # 手順テーブル用のデータ作成
     instructions_data = instructions_df.copy()
-    instructions_data["menu_id"] = menu_df["menu_id"].iloc[0]
+    instructions_data["menu_id"] = menu_id
     instructions_data["created_at"] = now
 
     # BigQueryテーブル名
@@ -345,24 +471,38 @@ def save_to_bigquery(
     ingredients_table = f"{project_name}.{dataset_name}.menu_ingredients"
     instructions_table = f"{project_name}.{dataset_name}.menu_instructions"
 
-    # データの保存
-    pandas_gbq.to_gbq(menu_df, menu_table, project_id=project_name, if_exists="append")
-    pandas_gbq.to_gbq(ingredients_data, ingredients_table, project_id=project_name, if_exists="append")
-    pandas_gbq.to_gbq(instructions_data, instructions_table, project_id=project_name, if_exists="append")
+    # データの保存（冪等キーがあれば行ごとの insertId にして再送時の重複を防ぐ）
+    for table, df in [
+        (menu_table, menu_df),
+        (ingredients_table, ingredients_data),
+        (instructions_table, instructions_data),
+    ]:
+        row_ids = row_ids_for_key(idempotency_key, table, len(df)) if idempotency_key else None
+        writer.append_dataframe(table, df, row_ids)
+    return menu_id
 
 def update_inventory(
     ingredients_df: pd.DataFrame,
-    user_id: str = None
+    writer: BigQueryBatchWriter,
+    user_id: str = None,
+    idempotency_key: str = None,
+    inventory_store: InventoryStore = None
 ) -> None:
     """
-    材料在庫を更新する
+    材料在庫を更新する（増減の履歴を追記し、在庫スナップショットにも反映する）
 
     Parameters
     ----------
     ingredients_df : pd.DataFrame
         使用した材料情報
+    writer : BigQueryBatchWriter
+        書き込みに使うライター
     user_id : str, optional
         ユーザーID, by default None (環境変数から取得)
+    idempotency_key : str, optional
+        冪等キー（save_to_bigquery と同じもの）, by default None
+    inventory_store : InventoryStore, optional
+        在庫スナップショットのストア, by default None (スナップショットを更新しない)
     """
     project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
     dataset_name = os.getenv('BIGQUERY_DATASET')
@@ -371,26 +511,19 @@ def update_inventory(
     # 現在時刻（UTC）
     now = datetime.now(timezone.utc)
 
-    # 在庫更新履歴テーブル用のデータ作成
-    inventory_updates = []
-    for _, row in ingredients_df.iterrows():
-        # 数値に変換可能な数量のみ処理
-        try:
-            quantity = float(str(row["quantity"]).replace("g", "").replace("ml", ""))
-            inventory_updates.append({
-                "user_id": user_id,
-                "ingredient_name": row["name"],
-                "quantity_change": -quantity,  # 使用した分を減らす
-                "unit": row["unit"],
-                "created_at": now
-            })
-        except (ValueError, TypeError):
-            continue  # 数値に変換できない場合はスキップ
-
-    if inventory_updates:
-        inventory_df = pd.DataFrame(inventory_updates)
+    # 在庫更新履歴テーブル用のデータ作成（数量・単位を全行まとめて解析し、単位を正規化する。使用した分を減らす）
+    inventory_df = quantity_changes(ingredients_df, user_id, sign=-1).assign(created_at=now)
+
+    if not inventory_df.empty:
         inventory_table = f"{project_name}.{dataset_name}.inventory_updates"
-        pandas_gbq.to_gbq(inventory_df, inventory_table, project_id=project_name, if_exists="append")
+        row_ids = row_ids_for_key(idempotency_key, inventory_table, len(inventory_df)) if idempotency_key else None
+        writer.append_dataframe(inventory_table, inventory_df, row_ids)
+        if inventory_store is not None:
+            try:
+                inventory_store.apply(inventory_df)
+            except Exception as e:
+                # スナップショットは履歴から作り直せるため、失敗しても次回の compact で反映される
+                print(f"在庫スナップショットの更新に失敗しました: {str(e)}")
 
 def main() -> None:
     """
@@ -404,29 +537,37 @@ def main() -> None:
         processor = create_processor()
 
         # BigQueryからデータを読み込む
-        demo, fridge_items, recipe_ingredients, flyer = load_bigquery_data()
-
-        # メニュー生成用のプロンプト作成
-        human_prompt = f"""
-        以下の条件でメニューを生成してください：
-
-        1. 冷蔵庫にある材料：
-        {fridge_items.to_string()}
-
-        2. レシピの材料：
-        {recipe_ingredients.to_string()}
-
-        3. フライヤーのデータ：
-        {flyer.to_string()}
-
-        4. その他の条件：
-        - 調理時間は30分以内
-        - 栄養バランスを考慮
-        - 簡単な手順で作れる料理
-        """
+        reader = create_bigquery_reader()
+        inventory_store = create_inventory_store(reader.client)
+        demo, fridge_items, recipe_ingredients, flyer = load_bigquery_data(reader, inventory_store=inventory_store)
+
+        # 家庭の条件と期限・特売日で品目を順位付けし、上位だけを残す
+        context_tables = select_context({
+            "fridge_items": fridge_items,
+            "recipe_ingredients": recipe_ingredients,
+            "flyer_current": flyer,
+        }, household_query(demo))
+
+        # メニュー生成用のプロンプト作成（必要な列だけを TSV で詰め、トークン予算内に収める）
+        context, report = build_prompt_context([
+            PromptSection("冷蔵庫にある材料", context_tables["fridge_items"], PROMPT_CONTEXT_COLUMNS["fridge_items"]),
+            PromptSection("レシピの材料", context_tables["recipe_ingredients"], PROMPT_CONTEXT_COLUMNS["recipe_ingredients"]),
+            PromptSection("フライヤーのデータ", context_tables["flyer_current"], PROMPT_CONTEXT_COLUMNS["flyer_current"]),
+        ])
+        print(format_report(report))
+
+        human_prompt = f"""以下の条件でメニューを生成してください。材料の一覧はタブ区切りです。
+
+{context}
+
+[その他の条件]
+- 調理時間は30分以内
+- 栄養バランスを考慮
+- 簡単な手順で作れる料理
+"""
 
         # メニュー生成
-        result_df = generate_menu(processor, pd.DataFrame({"prompt": [human_prompt]}))
+        result_df = generate_menu(processor, human_prompt)
 
         # メニューJSONの解析
         header_df, nutrition_df, ingredients_df, instructions_df = parse_menu_json(result_df.loc[0, "output"])
@@ -442,11 +583,13 @@ def main() -> None:
         print("\n調理手順:")
         print(instructions_df)
 
-        # BigQueryに保存
-        save_to_bigquery(header_df, nutrition_df, ingredients_df, instructions_df)
-
-        # 在庫の更新
-        update_inventory(ingredients_df)
+        # BigQueryに保存・在庫の更新（1つのライターでまとめて書き込む）
+        writer = create_bigquery_writer(reader.client)
+        try:
+            save_to_bigquery(header_df, nutrition_df, ingredients_df, instructions_df, writer)
+            update_inventory(ingredients_df, writer, inventory_store=inventory_store)
+        finally:
+            writer.close()
 
     except Exception as e:
         print(f"エラーが発生しました: {str(e)}", file=sys.stderr)
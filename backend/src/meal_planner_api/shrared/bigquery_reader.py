@@ -0,0 +1,132 @@
+# bigquery_reader.py
+import os, threading, pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple
+
+from google.cloud import bigquery
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:  # 未インストールの場合は REST（tabledata.list）で読む
+    bigquery_storage = None
+
+# ─────────────────────────────────────────────
+# 列を絞った BigQuery の並列読み込み
+# ─────────────────────────────────────────────
+class BigQueryReader:
+    """
+    必要な列だけを user_id で絞って読み、結果は BigQuery Storage Read API で Arrow として受け取る。
+    複数のテーブルは read_many で並列に読む
+
+    Notes
+    -----
+    テーブルのスキーマはプロセス内でキャッシュし、存在しない列の指定は無視する
+    （1列も残らない場合は全列を読む）。user_id 列のないテーブルは絞り込まない。
+    since_days を指定したテーブルは、created_at が TIMESTAMP であれば期間で絞り、
+    パーティション分割されたテーブル（bigquery_schema）では対象のパーティションだけを読む
+    """
+
+    def __init__(self, client: bigquery.Client, max_workers: int = 4):
+        self.client = client
+        self.max_workers = max_workers
+        self.bqstorage_client = bigquery_storage.BigQueryReadClient() if bigquery_storage is not None else None
+        self._schemas: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def columns_of(self, table: str) -> Dict[str, str]:
+        """テーブルの列名と型（初回のみメタデータを取得する）"""
+        if table not in self._schemas:
+            types = {field.name: field.field_type for field in self.client.get_table(table).schema}
+            with self._lock:
+                self._schemas[table] = types
+        return self._schemas[table]
+
+    def build_query(
+        self,
+        table: str,
+        columns: Optional[List[str]] = None,
+        user_id: Optional[str] = None,
+        since_days: Optional[int] = None,
+    ) -> Tuple[str, List[bigquery.ScalarQueryParameter]]:
+        """読み込み用の SQL とクエリパラメータを作る"""
+        existing = self.columns_of(table)
+        selected = [c for c in (columns or []) if c in existing]
+        select = ", ".join(f"`{c}`" for c in selected) or "*"
+        conditions: List[str] = []
+        params: List[bigquery.ScalarQueryParameter] = []
+        if user_id and "user_id" in existing:
+            conditions.append("user_id = @user_id")
+            params.append(bigquery.ScalarQueryParameter("user_id", "STRING", user_id))
+        if since_days is not None and existing.get("created_at") == "TIMESTAMP":
+            conditions.append("created_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @since_days DAY)")
+            params.append(bigquery.ScalarQueryParameter("since_days", "INT64", since_days))
+        query = f"SELECT {select} FROM `{table}`"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return query, params
+
+    def read(
+        self,
+        table: str,
+        columns: Optional[List[str]] = None,
+        user_id: Optional[str] = None,
+        since_days: Optional[int] = None,
+    ) -> pd.DataFrame:
+        """
+        テーブルを DataFrame として読み込む
+
+        Parameters
+        ----------
+        table : str
+            読み込むテーブル（project.dataset.table）
+        columns : Optional[List[str]]
+            読み込む列。省略時は全列
+        user_id : Optional[str]
+            指定した場合はそのユーザーの行だけを読む
+        since_days : Optional[int]
+            指定した場合は直近 since_days 日に作成された行だけを読む
+        """
+        query, params = self.build_query(table, columns, user_id, since_days)
+        job = self.client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params))
+        # 結果が1ページに収まらない場合は Storage Read API で Arrow として並列に受け取る
+        arrow = job.result().to_arrow(bqstorage_client=self.bqstorage_client)
+        return arrow.to_pandas()
+
+    def read_many(
+        self,
+        tables: Dict[str, Optional[List[str]]],
+        user_id: Optional[str] = None,
+        since_days: Optional[Dict[str, int]] = None,
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        複数のテーブルを並列に読み込む
+
+        Parameters
+        ----------
+        tables : Dict[str, Optional[List[str]]]
+            テーブル名と読み込む列
+        user_id : Optional[str]
+            指定した場合はそのユーザーの行だけを読む
+        since_days : Optional[Dict[str, int]]
+            テーブルごとの読み込む期間（日数）。含まれないテーブルは全期間を読む
+
+        Returns
+        -------
+        Dict[str, pd.DataFrame]
+            テーブル名ごとの DataFrame
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                table: executor.submit(self.read, table, columns, user_id, (since_days or {}).get(table))
+                for table, columns in tables.items()
+            }
+            return {table: future.result() for table, future in futures.items()}
+
+def create_bigquery_reader(client: Optional[bigquery.Client] = None) -> BigQueryReader:
+    """
+    BigQueryReader を作成する
+
+    BIGQUERY_READER_MAX_WORKERS: 並列に実行するクエリ数（既定 4）
+    """
+    client = client or bigquery.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT"))
+    return BigQueryReader(client, max_workers=int(os.getenv("BIGQUERY_READER_MAX_WORKERS", "4")))
@@ -0,0 +1,292 @@
+# bigquery_schema.py
+"""
+BigQuery のテーブル定義とマイグレーション
+
+各テーブルを created_at（TIMESTAMP）の日単位パーティション・user_id のクラスタリングで作成し、
+読み込み用のビュー（flyer_current など）を作り直す。
+既存のテーブルがパーティション分割されていない場合は、created_at を TIMESTAMP に変換しながら
+新しいテーブルにコピーして入れ替える（元のテーブルは <table>_backup_<日時> として残す）。
+ストリーミングバッファに行が残っているテーブルは名前を変更できないため、
+既存テーブルの移行は書き込み側のサービスを止めてから行うこと。
+
+使い方:
+    python -m shared.bigquery_schema            # マイグレーションを実行
+    python -m shared.bigquery_schema --dry-run  # 実行する DDL を表示するだけ
+
+デプロイ順:
+    マイグレーションは、新しい列に書き込む・新しい列を読むサービスをデプロイする前に実行する。
+    先にサービスをデプロイすると、既存のテーブルにない列を含む行は書き込みで拒否される。
+    - bq_uplode: created_menu / ingredients / instructions に user_id・created_at・idempotency_key を書き込む
+    - image_processor: flyer_data に flyer_id・flyer_date・version を書き込む（if_exists="append" は
+      既存のテーブルにない列があると失敗するため、マイグレーションが先）
+    - menu_generator: flyer_current ビューを読む（ビューはマイグレーションで作られる）。
+      inventory_snapshot の seeded_at に書き込む
+    - menu_image_generate / flyer_image_processor: Demo_Remake を読む。移行前（created_at が STRING）の
+      表でも SAFE.PARSE_TIMESTAMP で読めるため順序は問わないが、created_at のパーティションで
+      読む量を絞れるのはマイグレーションの後
+"""
+import os, sys, argparse
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional, Dict, List, Tuple
+
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+# ─────────────────────────────────────────────
+# テーブル定義
+# ─────────────────────────────────────────────
+PARTITION_COLUMN = "created_at"
+CLUSTER_COLUMNS = ["user_id"]
+
+# created_at が文字列で保存されている既存データの形式（例: 2025-06-01T12:34:56.789+09:00）
+LEGACY_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%E*S%Ez"
+
+@dataclass(frozen=True)
+class TableSpec:
+    name: str
+    columns: Tuple[Tuple[str, str], ...]
+    # False の場合は created_at で分割せず、user_id のクラスタリングだけを行う（状態を持つ小さなテーブル向け）
+    partitioned: bool = True
+
+TABLES: Dict[str, TableSpec] = {spec.name: spec for spec in [
+    TableSpec("created_menu", (
+        ("menu_id", "STRING"),
+        ("user_id", "STRING"),
+        ("created_at", "TIMESTAMP"),
+        ("idempotency_key", "STRING"),
+        ("title", "STRING"),
+        ("total_time_min", "INT64"),
+        ("kcal", "FLOAT64"),
+        ("protein_g", "FLOAT64"),
+        ("fat_g", "FLOAT64"),
+        ("carb_g", "FLOAT64"),
+        ("salt_g", "FLOAT64"),
+        ("fiber_g", "FLOAT64"),
+    )),
+    TableSpec("ingredients", (
+        ("menu_id", "STRING"),
+        ("user_id", "STRING"),
+        ("created_at", "TIMESTAMP"),
+        ("name", "STRING"),
+        ("quantity", "STRING"),
+        ("unit", "STRING"),
+    )),
+    TableSpec("instructions", (
+        ("menu_id", "STRING"),
+        ("user_id", "STRING"),
+        ("created_at", "TIMESTAMP"),
+        ("step", "INT64"),
+        ("text", "STRING"),
+    )),
+    # チラシの抽出結果は追記のみ。同じ flyer_id の再抽出は新しい version として追加する
+    TableSpec("flyer_data", (
+        ("flyer_id", "STRING"),
+        ("flyer_date", "DATE"),
+        ("version", "STRING"),
+        ("user_id", "STRING"),
+        ("created_at", "TIMESTAMP"),
+        ("商品", "STRING"),
+        ("数量", "STRING"),
+        ("値段", "STRING"),
+        ("特売日", "STRING"),
+    )),
+    TableSpec("inventory_updates", (
+        ("user_id", "STRING"),
+        ("created_at", "TIMESTAMP"),
+        ("ingredient_name", "STRING"),
+        ("quantity_change", "FLOAT64"),
+        ("unit", "STRING"),
+    )),
+    # 在庫の現在値（fridge_items の在庫に inventory_updates を積み上げた状態。shared/inventory.py が更新・圧縮する）
+    TableSpec("inventory_snapshot", (
+        ("user_id", "STRING"),
+        ("ingredient_name", "STRING"),
+        ("unit", "STRING"),
+        ("base_quantity", "FLOAT64"),
+        ("quantity", "FLOAT64"),
+        # fridge_items の在庫を入れた日時（ユーザーのいずれかの行にあれば seed 済み）
+        ("seeded_at", "TIMESTAMP"),
+        ("updated_at", "TIMESTAMP"),
+    ), partitioned=False),
+    # 入力フォームの送信先サービスが書き込む。ここに無い列は既存テーブルのものをそのまま残す
+    TableSpec("Demo_Remake", (
+        ("user_id", "STRING"),
+        ("created_at", "TIMESTAMP"),
+        ("gender", "STRING"),
+        ("age", "STRING"),
+        ("dietary_style", "STRING"),
+        ("feeling", "STRING"),
+        ("cooking_time", "STRING"),
+    )),
+]}
+
+# ビュー名と定義（{dataset} はマイグレーション時に project.dataset に置き換える）
+FLYER_CURRENT_DAYS = int(os.getenv("FLYER_CURRENT_DAYS", "14"))
+
+VIEWS: Dict[str, str] = {
+    # 直近 FLYER_CURRENT_DAYS 日に抽出されたチラシごとの最新バージョン。
+    # チラシは世帯で共有するため user_id 列は出さない（BigQueryReader が user_id で絞らないように）
+    "flyer_current": f"""
+        SELECT * EXCEPT (version_rank, user_id)
+        FROM (
+            SELECT *, DENSE_RANK() OVER (PARTITION BY flyer_id ORDER BY version DESC) AS version_rank
+            FROM `{{dataset}}.flyer_data`
+            WHERE created_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {FLYER_CURRENT_DAYS} DAY)
+        )
+        WHERE version_rank = 1
+    """,
+    # 保存したレシピ（冪等キーごとに最初の1件）。insertId の重複排除は約1分の best effort のため、
+    # それより離れた再送で入った重複はここで除く。読み込みは created_menu ではなくこのビューから行う
+    "created_menu_current": """
+        SELECT * EXCEPT (row_rank)
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY COALESCE(idempotency_key, menu_id) ORDER BY created_at, menu_id
+            ) AS row_rank
+            FROM `{dataset}.created_menu`
+        )
+        WHERE row_rank = 1
+    """,
+    # 材料・手順は created_menu_current に残ったレシピのものだけを、同じ行の重複を除いて読む
+    "ingredients_current": """
+        SELECT DISTINCT *
+        FROM `{dataset}.ingredients`
+        WHERE menu_id IN (SELECT menu_id FROM `{dataset}.created_menu_current`)
+    """,
+    "instructions_current": """
+        SELECT DISTINCT *
+        FROM `{dataset}.instructions`
+        WHERE menu_id IN (SELECT menu_id FROM `{dataset}.created_menu_current`)
+    """,
+}
+
+# ─────────────────────────────────────────────
+# マイグレーション
+# ─────────────────────────────────────────────
+def _timestamp_expression(field: Optional[bigquery.SchemaField]) -> str:
+    """既存の created_at 列を TIMESTAMP に変換する式"""
+    if field is None:
+        return "CURRENT_TIMESTAMP()"
+    if field.field_type == "TIMESTAMP":
+        return PARTITION_COLUMN
+    if field.field_type == "DATETIME":
+        return f"TIMESTAMP({PARTITION_COLUMN})"
+    return (
+        f"COALESCE(SAFE.PARSE_TIMESTAMP('{LEGACY_TIMESTAMP_FORMAT}', {PARTITION_COLUMN}),"
+        f" SAFE_CAST({PARTITION_COLUMN} AS TIMESTAMP))"
+    )
+
+def is_partitioned(table: bigquery.Table) -> bool:
+    partitioning = table.time_partitioning
+    return (
+        partitioning is not None
+        and partitioning.field == PARTITION_COLUMN
+        and table.clustering_fields == CLUSTER_COLUMNS
+    )
+
+def plan_migration(client: bigquery.Client, dataset: str, spec: TableSpec) -> List[str]:
+    """
+    1テーブル分のマイグレーションの DDL を作る（最新の状態なら空のリスト）
+
+    Parameters
+    ----------
+    client : bigquery.Client
+        BigQuery クライアント
+    dataset : str
+        データセット（project.dataset）
+    spec : TableSpec
+        テーブル定義
+    """
+    table_id = f"{dataset}.{spec.name}"
+    partition = f"PARTITION BY DATE({PARTITION_COLUMN}) CLUSTER BY {', '.join(CLUSTER_COLUMNS)}"
+    if not spec.partitioned:
+        partition = f"CLUSTER BY {', '.join(CLUSTER_COLUMNS)}"
+    try:
+        table = client.get_table(table_id)
+    except NotFound:
+        columns = ", ".join(f"`{name}` {field_type}" for name, field_type in spec.columns)
+        return [f"CREATE TABLE `{table_id}` ({columns}) {partition}"]
+
+    existing = {field.name: field for field in table.schema}
+    statements = []
+    if spec.partitioned and not is_partitioned(table):
+        # created_at を TIMESTAMP に揃え、無い列（user_id など）は NULL で補ってコピーする
+        select = "*"
+        if PARTITION_COLUMN in existing:
+            select += f" REPLACE ({_timestamp_expression(existing[PARTITION_COLUMN])} AS {PARTITION_COLUMN})"
+        else:
+            select += f", {_timestamp_expression(None)} AS {PARTITION_COLUMN}"
+        for column in CLUSTER_COLUMNS:
+            if column not in existing:
+                select += f", CAST(NULL AS STRING) AS {column}"
+        backup = f"{spec.name}_backup_{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+        statements += [
+            f"CREATE TABLE `{table_id}__migrating` {partition} AS SELECT {select} FROM `{table_id}`",
+            f"ALTER TABLE `{table_id}` RENAME TO `{backup}`",
+            f"ALTER TABLE `{table_id}__migrating` RENAME TO `{spec.name}`",
+        ]
+        existing.setdefault(PARTITION_COLUMN, None)
+        existing.update({column: None for column in CLUSTER_COLUMNS})
+    statements += [
+        f"ALTER TABLE `{table_id}` ADD COLUMN IF NOT EXISTS `{name}` {field_type}"
+        for name, field_type in spec.columns
+        if name not in existing
+    ]
+    return statements
+
+def migrate(
+    client: bigquery.Client,
+    dataset: str,
+    tables: Optional[List[str]] = None,
+    dry_run: bool = False,
+) -> Dict[str, List[str]]:
+    """
+    テーブルをパーティション・クラスタリング付きの定義に揃える
+
+    Parameters
+    ----------
+    client : bigquery.Client
+        BigQuery クライアント
+    dataset : str
+        データセット（project.dataset）
+    tables : Optional[List[str]]
+        対象のテーブル名。省略時は TABLES のすべて
+    dry_run : bool
+        True の場合は DDL を作るだけで実行しない
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        テーブル・ビューごとの DDL
+    """
+    plans = {}
+    for name in tables or list(TABLES):
+        plans[name] = plan_migration(client, dataset, TABLES[name])
+    # ビューはテーブルの列がそろってから作り直す
+    for name, query in VIEWS.items():
+        plans[name] = [f"CREATE OR REPLACE VIEW `{dataset}.{name}` AS {query.format(dataset=dataset).strip()}"]
+    for statements in plans.values():
+        for statement in statements:
+            print(statement)
+            if not dry_run:
+                client.query(statement).result()
+    return plans
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="BigQuery のテーブルをパーティション・クラスタリング付きに移行する")
+    parser.add_argument("--dry-run", action="store_true", help="実行する DDL を表示するだけ")
+    parser.add_argument("--tables", nargs="*", choices=sorted(TABLES), help="対象のテーブル（省略時はすべて）")
+    args = parser.parse_args()
+
+    project_name = os.getenv("GOOGLE_CLOUD_PROJECT")
+    dataset_name = os.getenv("BIGQUERY_DATASET")
+    if not project_name or not dataset_name:
+        print("GOOGLE_CLOUD_PROJECT と BIGQUERY_DATASET を設定してください", file=sys.stderr)
+        sys.exit(1)
+
+    client = bigquery.Client(project=project_name)
+    migrate(client, f"{project_name}.{dataset_name}", args.tables, dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# bigquery_writer.py
+import os, json, time, uuid, secrets, threading, pandas as pd
+from collections import defaultdict
+from typing import Optional, Dict, Any, List
+
+from google.cloud import bigquery
+
+# ─────────────────────────────────────────────
+# 衝突しない時刻順の ID と冪等キー
+# ─────────────────────────────────────────────
+_CROCKFORD32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def encode_ulid(timestamp_ms: int, randomness: int) -> str:
+    """48bit のミリ秒時刻と 80bit の乱数を ULID 形式（Crockford Base32 の26文字）にする"""
+    value = (timestamp_ms << 80) | (randomness & ((1 << 80) - 1))
+    return "".join(_CROCKFORD32[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+class MonotonicUlidGenerator:
+    """
+    ULID を作る。同じミリ秒内では乱数部を1ずつ増やすため、同じプロセスで作った ID は
+    同時刻でも衝突せず、文字列として単調に増える（時計が巻き戻っても前回の値より小さくならない）
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._last_randomness = 0
+
+    def new(self) -> str:
+        timestamp_ms = int(time.time() * 1000)
+        with self._lock:
+            if timestamp_ms <= self._last_ms:
+                timestamp_ms = self._last_ms
+                randomness = self._last_randomness + 1
+                if randomness >= 1 << 80:
+                    timestamp_ms += 1
+                    randomness = secrets.randbits(79)
+            else:
+                # 上位1bit を空けておき、同じミリ秒内で増やしても桁あふれしないようにする
+                randomness = secrets.randbits(79)
+            self._last_ms, self._last_randomness = timestamp_ms, randomness
+        return encode_ulid(timestamp_ms, randomness)
+
+_menu_ids = MonotonicUlidGenerator()
+
+def new_menu_id() -> str:
+    """時刻順に並ぶ一意なメニューID（menu_ + ULID）"""
+    return f"menu_{_menu_ids.new()}"
+
+def row_ids_for_key(idempotency_key: str, table: str, count: int) -> List[str]:
+    """
+    冪等キーから行ごとの insertId を作る。同じキーで同じテーブルに送り直した行は BigQuery 側で重複が排除されるが、
+    insertId による重複排除は約1分以内の再送に対する best effort でしかない。
+    それより離れた再送（クライアントの再試行など）の重複は、読み込み側のビュー
+    （bigquery_schema の created_menu_current など。idempotency_key / menu_id ごとに1件にする）で除く
+    """
+    table_name = table.rsplit(".", 1)[-1]
+    return [f"{idempotency_key}:{table_name}:{i}" for i in range(count)]
+
+# ─────────────────────────────────────────────
+# BigQuery へのバッファ付きストリーミング書き込み
+# ─────────────────────────────────────────────
+def dataframe_to_rows(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    DataFrame を insert_rows_json に渡せる JSON 互換の行リストに変換する
+    （numpy 型・NaN・datetime を JSON の数値 / null / ISO8601 文字列に揃える）
+    """
+    if df.empty:
+        return []
+    return json.loads(df.to_json(orient="records", date_format="iso", force_ascii=False))
+
+class BigQueryWriteError(RuntimeError):
+    """BigQueryBatchWriter が行を書き込めなかった"""
+
+class BigQueryBatchWriter:
+    """
+    テーブルごとに行をバッファし、件数（max_rows）か経過時間（flush_interval_sec）のどちらかに達したら
+    共有クライアントのストリーミング挿入（insertAll）でまとめて書き込む。
+    ロードジョブ（pandas_gbq.to_gbq）と違い1回の書き込みが数十ミリ秒で済み、テーブルごとのロードジョブ数の上限も受けない
+
+    Notes
+    -----
+    バッファはメモリ上にあるため、プロセスが異常終了すると未送信の行は失われる。
+    終了時は必ず close() を呼んで残りを書き出すこと（書き込めなかった行があれば close() が例外を送出する）
+    """
+
+    # insertAll 1リクエストあたりの行数（BigQuery の推奨上限は 500 行）
+    INSERT_CHUNK_ROWS = 500
+
+    def __init__(
+        self,
+        client: bigquery.Client,
+        max_rows: int = 500,
+        flush_interval_sec: float = 1.0,
+    ):
+        self.client = client
+        self.max_rows = max_rows
+        self.flush_interval_sec = flush_interval_sec
+        self._buffers: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._row_ids: Dict[str, List[str]] = defaultdict(list)
+        self._buffered_rows = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.rows_requeued = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self.last_error: Optional[str] = None
+
+    def start(self) -> "BigQueryBatchWriter":
+        """時間経過でフラッシュするバックグラウンドスレッドを開始する"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="bigquery-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def append(
+        self,
+        table: str,
+        rows: List[Dict[str, Any]],
+        row_ids: Optional[List[str]] = None,
+    ) -> None:
+        """
+        行をバッファに追加する（書き込みはバックグラウンドで行われる）
+
+        Parameters
+        ----------
+        table : str
+            書き込み先テーブル（project.dataset.table）
+        rows : List[Dict[str, Any]]
+            JSON 互換の行のリスト
+        row_ids : Optional[List[str]]
+            行ごとの insertId（row_ids_for_key で作る）。省略時は行ごとにランダムな ID を振る
+        """
+        if not rows:
+            return
+        if row_ids is None:
+            row_ids = [uuid.uuid4().hex for _ in rows]
+        elif len(row_ids) != len(rows):
+            raise ValueError("row_ids と rows の件数が一致しません")
+        with self._lock:
+            self._buffers[table].extend(rows)
+            self._row_ids[table].extend(row_ids)
+            self._buffered_rows += len(rows)
+            full = self._buffered_rows >= self.max_rows
+        if full:
+            # 件数に達したら待たずにフラッシュさせる
+            self._wakeup.set()
+
+    def append_dataframe(
+        self,
+        table: str,
+        df: pd.DataFrame,
+        row_ids: Optional[List[str]] = None,
+    ) -> None:
+        self.append(table, dataframe_to_rows(df), row_ids)
+
+    def flush(self) -> int:
+        """
+        バッファ中の行をすべて書き込む
+
+        書き込めなかった行は同じ insertId のままバッファに戻し、次のフラッシュで送り直す
+        （数秒後の再送なので BigQuery の insertId による重複排除が効く）。
+        行の内容が不正（reason=invalid）な行だけは送り直しても成功しないため破棄し、rows_dropped に数える
+
+        Returns
+        -------
+        int
+            バッファに戻した行数
+        """
+        with self._flush_lock:
+            with self._lock:
+                buffers, self._buffers = self._buffers, defaultdict(list)
+                row_ids, self._row_ids = self._row_ids, defaultdict(list)
+                self._buffered_rows = 0
+            requeued = 0
+            for table, rows in buffers.items():
+                ids = row_ids[table]
+                try:
+                    errors = self.insert(table, rows, ids)
+                except Exception as e:
+                    print(f"BigQueryへの書き込みに失敗しました（{table}, {len(rows)}行）: {str(e)}")
+                    with self._lock:
+                        self.last_error = str(e)
+                    self._requeue(table, rows, ids)
+                    requeued += len(rows)
+                    continue
+                retry = [i for i, reasons in errors.items() if "invalid" not in reasons]
+                dropped = len(errors) - len(retry)
+                if dropped:
+                    print(f"BigQueryへの書き込みで不正な行を破棄しました（{table}, {dropped}行）")
+                    with self._lock:
+                        self.rows_dropped += dropped
+                        self.last_error = f"{table}: {dropped}行が不正です"
+                self._requeue(table, [rows[i] for i in retry], [ids[i] for i in retry])
+                requeued += len(retry)
+            if buffers:
+                with self._lock:
+                    self.flushes += 1
+            return requeued
+
+    def _requeue(self, table: str, rows: List[Dict[str, Any]], row_ids: List[str]) -> None:
+        """書き込めなかった行をバッファの先頭に戻す"""
+        if not rows:
+            return
+        with self._lock:
+            self._buffers[table][:0] = rows
+            self._row_ids[table][:0] = row_ids
+            self._buffered_rows += len(rows)
+            self.rows_requeued += len(rows)
+
+    def insert(
+        self,
+        table: str,
+        rows: List[Dict[str, Any]],
+        row_ids: Optional[List[str]] = None,
+    ) -> Dict[int, List[str]]:
+        """
+        バッファを通さずにすぐ書き込む（リクエスト自体が失敗した場合は例外を送出する）
+
+        Parameters
+        ----------
+        table : str
+            書き込み先テーブル（project.dataset.table）
+        rows : List[Dict[str, Any]]
+            JSON 互換の行のリスト
+        row_ids : Optional[List[str]]
+            行ごとの insertId。同じ ID での再送は BigQuery 側で重複が排除される
+
+        Returns
+        -------
+        Dict[int, List[str]]
+            書き込みに失敗した行のインデックス（rows に対する位置）と、その理由（reason）のリスト。
+            reason が invalid の行は内容が不正で、stopped などはほかの行の失敗に巻き込まれただけなので送り直せる
+        """
+        failed: Dict[int, List[str]] = {}
+        for start in range(0, len(rows), self.INSERT_CHUNK_ROWS):
+            chunk = rows[start:start + self.INSERT_CHUNK_ROWS]
+            chunk_ids = row_ids[start:start + self.INSERT_CHUNK_ROWS] if row_ids else None
+            try:
+                errors = self.client.insert_rows_json(table, chunk, row_ids=chunk_ids)
+            except Exception:
+                # 先に成功したチャンクの行も含めて、呼び出し側は全行を送り直す（insertId で重複は排除される）
+                with self._lock:
+                    self.rows_failed += len(rows) - start
+                raise
+            if errors:
+                print(f"BigQueryへの書き込みで一部の行が失敗しました（{table}）: {errors[:3]}")
+                for error in errors:
+                    failed[start + error["index"]] = [e.get("reason", "") for e in error.get("errors", [])]
+            with self._lock:
+                self.rows_failed += len(errors)
+                self.rows_written += len(chunk) - len(errors)
+        return failed
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval_sec)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self, retries: int = 3, retry_interval_sec: float = 1.0) -> None:
+        """
+        バックグラウンドスレッドを止め、残りの行を書き込む
+
+        Raises
+        ------
+        BigQueryWriteError
+            retries 回送り直しても書き込めなかった行や、不正で破棄した行がある場合
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        remaining = self.flush()
+        for attempt in range(retries):
+            if not remaining:
+                break
+            time.sleep(retry_interval_sec * (2 ** attempt))
+            remaining = self.flush()
+        with self._lock:
+            dropped, last_error = self.rows_dropped, self.last_error
+        if remaining or dropped:
+            raise BigQueryWriteError(
+                f"BigQueryに書き込めなかった行があります（未送信 {remaining}行, 破棄 {dropped}行）: {last_error}"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "buffered_rows": self._buffered_rows,
+                "rows_written": self.rows_written,
+                "rows_failed": self.rows_failed,
+                "rows_requeued": self.rows_requeued,
+                "rows_dropped": self.rows_dropped,
+                "flushes": self.flushes,
+                "last_error": self.last_error,
+            }
+
+def create_bigquery_writer(client: Optional[bigquery.Client] = None) -> BigQueryBatchWriter:
+    """
+    環境変数から BigQueryBatchWriter を作成する
+
+    BIGQUERY_WRITER_MAX_ROWS          : この行数たまったらフラッシュ（既定 500）
+    BIGQUERY_WRITER_FLUSH_INTERVAL_SEC: この秒数ごとにフラッシュ（既定 1.0）
+    """
+    client = client or bigquery.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT"))
+    return BigQueryBatchWriter(
+        client,
+        max_rows=int(os.getenv("BIGQUERY_WRITER_MAX_ROWS", "500")),
+        flush_interval_sec=float(os.getenv("BIGQUERY_WRITER_FLUSH_INTERVAL_SEC", "1.0")),
+    )
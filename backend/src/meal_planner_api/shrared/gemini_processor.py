@@ -1,6 +1,8 @@
 # gemini_processor.py
-import os, json, pandas as pd
-from typing import Optional, Dict, Any, List
+import os, json, time, asyncio, threading, hashlib, sqlite3, pandas as pd
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict
 from dotenv import load_dotenv
 from google import generativeai as genai        
@@ -45,9 +47,358 @@ class GeminiOptions:
             presence_penalty   = self.presence_penalty or None,
             frequency_penalty  = self.frequency_penalty or None,
             response_mime_type = self.response_mime_type or None,
-            response_schema    = self.response_schema or None,
+            response_schema    = sdk_response_schema(self.response_schema) or None,
         )
     
+# ─────────────────────────────────────────────
+# 応答スキーマ（Gemini 用への変換と、事前コンパイルした検証）
+# ─────────────────────────────────────────────
+# Gemini の response_schema（OpenAPI のサブセット）が受け付けるキー
+_GEMINI_SCHEMA_KEYS = {"type", "format", "description", "nullable", "enum", "properties", "required", "items"}
+
+def _resolve_ref(schema: Dict[str, Any], root: Dict[str, Any]) -> Dict[str, Any]:
+    """"#/$defs/name" 形式の $ref をたどる"""
+    while "$ref" in schema:
+        node: Any = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            node = node[part]
+        schema = node
+    return schema
+
+def to_gemini_schema(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    JSON Schema を GeminiOptions.response_schema に渡せる形にする
+    （$ref を展開し、$schema / title / additionalProperties / minimum などの未対応のキーを除く）
+
+    Gemini は response_schema のキーを名前順で出力するため、properties の定義順を
+    propertyOrdering として付ける（ストリーミングで title から順に届くように）
+    """
+    root = root or schema
+    schema = _resolve_ref(schema, root)
+    converted: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key not in _GEMINI_SCHEMA_KEYS:
+            continue
+        if key == "properties":
+            value = {name: to_gemini_schema(prop, root) for name, prop in value.items()}
+            converted["propertyOrdering"] = list(value)
+        elif key == "items":
+            value = to_gemini_schema(value, root)
+        converted[key] = value
+    return converted
+
+def sdk_response_schema(schema: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    to_gemini_schema の結果を google-generativeai の protos.Schema が受け付ける形にする。
+    propertyOrdering は SDK の property_ordering に読み替え、それが無い版の SDK では除く
+    （その場合キーの順序は SYSTEM_PROMPT の指示だけに頼る）
+    """
+    if not isinstance(schema, dict):
+        return schema
+    protos = getattr(genai, "protos", None)
+    supported = protos is not None and "property_ordering" in protos.Schema.meta.fields
+    converted: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key == "propertyOrdering":
+            if supported:
+                converted["property_ordering"] = value
+            continue
+        if key == "properties":
+            value = {name: sdk_response_schema(prop) for name, prop in value.items()}
+        elif key == "items":
+            value = sdk_response_schema(value)
+        converted[key] = value
+    return converted
+
+class SchemaValidationError(ValueError):
+    """応答がスキーマに合わない（errors に場所ごとのメッセージを持つ）"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors[:5]))
+        self.errors = errors
+
+_JSON_TYPES: Dict[str, Tuple[type, ...]] = {
+    "object": (dict,),
+    "array": (list,),
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+}
+
+def compile_validator(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Callable[[Any], List[str]]:
+    """
+    JSON Schema（type / properties / required / additionalProperties / items / minItems / minimum / enum / $ref）を
+    検証関数に変換する。スキーマの解釈は1回だけで、検証は値をたどるだけになる
+
+    Returns
+    -------
+    Callable[[Any], List[str]]
+        値を受け取り、エラーメッセージ（"$.nutrition.kcal: ..." の形式）のリストを返す関数。空なら妥当
+    """
+    root = root or schema
+    schema = _resolve_ref(schema, root)
+    checks: List[Callable[[Any, str, List[str]], bool]] = []
+
+    if "type" in schema:
+        expected = schema["type"]
+        types = _JSON_TYPES[expected]
+
+        def check_type(value: Any, path: str, errors: List[str]) -> bool:
+            # bool は int のサブクラスなので数値としては扱わない
+            if not isinstance(value, types) or (isinstance(value, bool) and expected != "boolean"):
+                errors.append(f"{path}: {expected} ではありません（{type(value).__name__}）")
+                return False
+            return True
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+
+        def check_enum(value: Any, path: str, errors: List[str]) -> bool:
+            if value not in allowed:
+                errors.append(f"{path}: {allowed} のいずれでもありません")
+            return True
+        checks.append(check_enum)
+
+    if "minimum" in schema:
+        minimum = schema["minimum"]
+
+        def check_minimum(value: Any, path: str, errors: List[str]) -> bool:
+            if isinstance(value, (int, float)) and value < minimum:
+                errors.append(f"{path}: {minimum} 未満です")
+            return True
+        checks.append(check_minimum)
+
+    if "properties" in schema or "required" in schema:
+        properties = {name: compile_validator(prop, root) for name, prop in schema.get("properties", {}).items()}
+        required = schema.get("required", [])
+        closed = schema.get("additionalProperties", True) is False
+
+        def check_object(value: Any, path: str, errors: List[str]) -> bool:
+            if not isinstance(value, dict):
+                return True
+            errors.extend(f"{path}.{name}: ありません" for name in required if name not in value)
+            for name, item in value.items():
+                if name in properties:
+                    errors.extend(properties[name](item, f"{path}.{name}"))
+                elif closed:
+                    errors.append(f"{path}.{name}: 定義にない項目です")
+            return True
+        checks.append(check_object)
+
+    if "items" in schema or "minItems" in schema:
+        item_validator = compile_validator(schema["items"], root) if "items" in schema else None
+        min_items = schema.get("minItems", 0)
+
+        def check_array(value: Any, path: str, errors: List[str]) -> bool:
+            if not isinstance(value, list):
+                return True
+            if len(value) < min_items:
+                errors.append(f"{path}: 要素が {min_items} 個未満です")
+            if item_validator is not None:
+                for i, item in enumerate(value):
+                    errors.extend(item_validator(item, f"{path}[{i}]"))
+            return True
+        checks.append(check_array)
+
+    def validate(value: Any, path: str = "$") -> List[str]:
+        errors: List[str] = []
+        for check in checks:
+            # 型が違う場合はそれ以降の検査をしない
+            if not check(value, path, errors):
+                break
+        return errors
+    return validate
+
+def json_text_validator(validate: Callable[[Any], List[str]]) -> Callable[[str], List[str]]:
+    """応答テキストを JSON として読んでから validate で検証する関数を返す（GeminiProcessor の validator 用）"""
+    def validate_text(text: str) -> List[str]:
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            return [f"$: JSON として読めません: {e}"]
+        return validate(data)
+    return validate_text
+
+# ─────────────────────────────────────────────
+# 応答キャッシュ（内容アドレス + LRU + TTL）
+# ─────────────────────────────────────────────
+def make_cache_key(
+    model_name: str,
+    options: Dict[str, Any],
+    system_prompt: Any,
+    human_prompt: Any,
+) -> str:
+    """(モデル名, 生成設定, system-prompt, human-prompt) の SHA-256 をキーにする"""
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "options": options,
+            "system": None if pd.isna(system_prompt) else str(system_prompt),
+            "human": str(human_prompt),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """プロセス内 LRU + TTL キャッシュ"""
+
+    def __init__(self, max_entries: int = 1024, ttl_sec: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            created_at, value = entry
+            if time.time() - created_at > self.ttl_sec:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class SQLiteCacheBackend:
+    """ローカルディスク（SQLite）上の LRU + TTL キャッシュ"""
+
+    # get / set がディスク I/O を伴う（非同期の呼び出し元ではスレッドで実行する）
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl_sec: float = 86400):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_sec:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            # 期限切れと、上限を超えた古いアクセス順のエントリを削除
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_sec,)
+            )
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                " SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+
+class ResponseCache:
+    """バックエンドを差し替え可能なキャッシュ。ヒット/ミス数を数える"""
+
+    def __init__(self, backend: Any):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self.backend.set(key, value)
+
+    async def get_async(self, key: str) -> Optional[str]:
+        """get の asyncio 版（ディスクを読むバックエンドはスレッドで実行し、イベントループを止めない）"""
+        if getattr(self.backend, "blocking", False):
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def set_async(self, key: str, value: str) -> None:
+        """set の asyncio 版"""
+        if getattr(self.backend, "blocking", False):
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """
+    環境変数からキャッシュを作成する
+
+    GEMINI_CACHE_BACKEND      : none（既定）/ memory / sqlite
+                                生成結果は毎回異なるため、同じ入力に同じ応答を返してよいデプロイでだけ明示的に有効にする
+    GEMINI_CACHE_PATH         : sqlite のファイルパス（既定: gemini_cache.sqlite3）
+    GEMINI_CACHE_MAX_ENTRIES  : 最大エントリ数（既定: 1024）
+    GEMINI_CACHE_TTL_SEC      : 有効期限秒（既定: 3600）
+    """
+    backend_name = os.getenv("GEMINI_CACHE_BACKEND", "none").lower()
+    max_entries = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "1024"))
+    ttl_sec = float(os.getenv("GEMINI_CACHE_TTL_SEC", "3600"))
+    if backend_name == "none":
+        return None
+    if backend_name == "sqlite":
+        path = os.getenv("GEMINI_CACHE_PATH", "gemini_cache.sqlite3")
+        return ResponseCache(SQLiteCacheBackend(path, max_entries=max_entries, ttl_sec=ttl_sec))
+    if backend_name == "memory":
+        return ResponseCache(MemoryCacheBackend(max_entries=max_entries, ttl_sec=ttl_sec))
+    raise ValueError(f"GEMINI_CACHE_BACKEND が不正です: {backend_name}")
+
+
 # ─────────────────────────────────────────────
 # 2. メインクラス
 # ─────────────────────────────────────────────
@@ -58,6 +409,8 @@ class GeminiProcessor:
         model_name: str = "models/gemini-2.5-flash-preview-05-20",
         options: GeminiOptions = GeminiOptions(),  
         project_id: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        validator: Optional[Callable[[str], List[str]]] = None,
     ):
         load_dotenv()
         api_key = os.getenv(api_key_env)
@@ -65,15 +418,103 @@ class GeminiProcessor:
             raise ValueError(f"{api_key_env} が設定されていません")
         genai.configure(api_key=api_key)
 
-        self.model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=options.to_generation_config(),
-            safety_settings=options.safety_settings,
-            system_instruction=options.system_instruction,
-            tools=options.tools,
-        )
+        self.model_name = model_name
         self.options = options
         self.project_id = project_id
+        self.cache = cache
+        # 応答テキストの検証（エラーのリストを返す）。エラーのある応答はキャッシュせず、キャッシュから返しもしない
+        self.validator = validator
+        # system_instruction ごとの GenerativeModel キャッシュ（行ごとの system-prompt で増え続けないよう、
+        # GEMINI_MODEL_CACHE_SIZE 個を超えたら最も長く使われていないものから捨てる）
+        self._models: "OrderedDict[Optional[str], genai.GenerativeModel]" = OrderedDict()
+        self._models_max = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "32"))
+        self._models_lock = threading.Lock()
+        self.model = self._get_model(options.system_instruction)
+    def _get_model(self, system_instruction: Optional[str]) -> genai.GenerativeModel:
+        """
+        system_instruction ごとに GenerativeModel を1度だけ生成して使い回す。
+        system-prompt を会話履歴ではなく system_instruction として渡すことで、
+        1行あたり generate_content 1回で済むようにする。
+        """
+        with self._models_lock:
+            model = self._models.get(system_instruction)
+            if model is None:
+                model = genai.GenerativeModel(
+                    model_name=self.model_name,
+                    generation_config=self.options.to_generation_config(),
+                    safety_settings=self.options.safety_settings,
+                    system_instruction=system_instruction,
+                    tools=self.options.tools,
+                )
+                self._models[system_instruction] = model
+                if len(self._models) > self._models_max:
+                    self._models.popitem(last=False)
+            else:
+                self._models.move_to_end(system_instruction)
+            return model
+
+    # ────────────────────────
+    # 1行分の Gemini 呼び出し
+    # ────────────────────────
+    def _select_model(self, system_prompt: Any) -> genai.GenerativeModel:
+        # 行に専用 system-prompt があれば system_instruction として上書き
+        if pd.notna(system_prompt) and system_prompt:
+            return self._get_model(str(system_prompt))
+        return self.model
+
+    def _cache_key(self, system_prompt: Any, human_prompt: Any) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return make_cache_key(self.model_name, asdict(self.options), system_prompt, human_prompt)
+
+    def _cacheable(self, text: str, log: bool = True) -> bool:
+        """validator を通る応答だけをキャッシュする（壊れた応答を同じプロンプトに返し続けないように）"""
+        if self.validator is None:
+            return True
+        errors = self.validator(text)
+        if errors and log:
+            print(f"応答がスキーマに合わないためキャッシュしません: {'; '.join(errors[:3])}")
+        return not errors
+
+    def _call_row(self, system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+        """
+        1行分のプロンプトで Gemini を呼び出し、(出力テキスト, 所要秒数) を返す。
+        例外は行単位で {"error": ...} の JSON 文字列に変換する。
+        """
+        start = time.perf_counter()
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                return cached, time.perf_counter() - start
+        try:
+            reply = self._select_model(system_prompt).generate_content(str(human_prompt))
+            text = reply.text
+            # エラー応答・スキーマに合わない応答はキャッシュしない
+            if cache_key is not None and self._cacheable(text):
+                self.cache.set(cache_key, text)
+        except Exception as e:
+            text = json.dumps({"error": str(e)})
+        return text, time.perf_counter() - start
+
+    async def _call_row_async(self, system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+        """_call_row の asyncio 版（generate_content_async を使用）"""
+        start = time.perf_counter()
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                return cached, time.perf_counter() - start
+        try:
+            model = self._select_model(system_prompt)
+            reply = await model.generate_content_async(str(human_prompt))
+            text = reply.text
+            if cache_key is not None and self._cacheable(text):
+                await self.cache.set_async(cache_key, text)
+        except Exception as e:
+            text = json.dumps({"error": str(e)})
+        return text, time.perf_counter() - start
+
     # ────────────────────────
     # DataFrame → Gemini 呼び出し
     # ────────────────────────
@@ -83,25 +524,94 @@ class GeminiProcessor:
         system_prompt_col: str = "systemprompt",
         human_prompt_col: str = "humanprompt",
         output_col: str = "output",
+        max_concurrency: int = 1,
+        latency_col: Optional[str] = "latency_sec",
     ) -> pd.DataFrame:
+        """
+        DataFrame の各行を Gemini に投げ、結果を output_col に格納する
+
+        Parameters
+        ----------
+        max_concurrency : int
+            同時に投げるリクエスト数。1 以下なら従来どおり逐次実行
+        latency_col : Optional[str]
+            行ごとの所要秒数を格納するカラム名。None なら出力しない
+        """
+
+        if not {system_prompt_col, human_prompt_col}.issubset(df.columns):
+            raise ValueError("必要なカラムがありません")
+
+        res = df.copy()
+        rows = list(zip(res[system_prompt_col], res[human_prompt_col]))
+
+        if max_concurrency <= 1 or len(rows) <= 1:
+            results = [self._call_row(sp, hp) for sp, hp in rows]
+        else:
+            # executor.map は入力順で結果を返すので行順はそのまま保たれる
+            with ThreadPoolExecutor(max_workers=min(max_concurrency, len(rows))) as executor:
+                results = list(executor.map(lambda r: self._call_row(*r), rows))
+
+        res[output_col] = [text for text, _ in results]
+        if latency_col:
+            res[latency_col] = [latency for _, latency in results]
+        return res
+
+    async def process_dataframe_async(
+        self,
+        df: pd.DataFrame,
+        system_prompt_col: str = "systemprompt",
+        human_prompt_col: str = "humanprompt",
+        output_col: str = "output",
+        max_concurrency: int = 8,
+        latency_col: Optional[str] = "latency_sec",
+    ) -> pd.DataFrame:
+        """
+        process_dataframe の asyncio 版。スレッドを占有せず、
+        Semaphore で同時実行数を max_concurrency に抑えて待ち合わせる
+        """
 
         if not {system_prompt_col, human_prompt_col}.issubset(df.columns):
             raise ValueError("必要なカラムがありません")
 
         res = df.copy()
-        res[output_col] = None
-
-        for idx, row in res.iterrows():
-            try:
-                chat = self.model.start_chat(history=[])
-                # 行に専用 system-prompt があれば上書き
-                if pd.notna(row[system_prompt_col]):
-                    chat.send_message(row[system_prompt_col])
-                reply = chat.send_message(str(row[human_prompt_col]))
-                res.at[idx, output_col] = reply.text
-            except Exception as e:
-                res.at[idx, output_col] = json.dumps({"error": str(e)})
+        rows = list(zip(res[system_prompt_col], res[human_prompt_col]))
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run(system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+            async with semaphore:
+                return await self._call_row_async(system_prompt, human_prompt)
+
+        # gather は入力順で結果を返すので行順はそのまま保たれる
+        results = await asyncio.gather(*(run(sp, hp) for sp, hp in rows))
+
+        res[output_col] = [text for text, _ in results]
+        if latency_col:
+            res[latency_col] = [latency for _, latency in results]
         return res
+
+    async def stream_text_async(self, system_prompt: Any, human_prompt: Any) -> AsyncIterator[str]:
+        """
+        generate_content_async(stream=True) の出力をチャンクごとに返す。
+        キャッシュヒット時は全文を1チャンクで返す。例外は呼び出し側に伝播する
+        """
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                yield cached
+                return
+        model = self._select_model(system_prompt)
+        response = await model.generate_content_async(str(human_prompt), stream=True)
+        chunks = []
+        async for chunk in response:
+            # finish_reason だけのチャンクなど、テキストを持たないものは読み飛ばす
+            if not chunk.parts:
+                continue
+            chunks.append(chunk.text)
+            yield chunk.text
+        text = "".join(chunks)
+        if cache_key is not None and self._cacheable(text):
+            await self.cache.set_async(cache_key, text)
     
 # ─────────────────────────────────────────────
 # 3. 画像読み込み
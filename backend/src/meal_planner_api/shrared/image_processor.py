@@ -1,6 +1,7 @@
 # gemini_processor.py
-import os, json, pandas as pd
+import os, re, json, uuid, base64, hashlib, asyncio, unicodedata, pandas as pd
 from typing import Optional, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict
 from dotenv import load_dotenv
 from google import generativeai as genai        
@@ -11,13 +12,11 @@ from PIL import Image
 from io import BytesIO
 import firebase_admin
 from firebase_admin import credentials, storage
+from google.api_core.exceptions import NotFound
 
 import pandas_gbq 
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 
-# ─────────────────────────────────────────────
-# 1. モデル向けパラメータを "全部入り" で保持する dataclass
-# ─────────────────────────────────────────────
 # ─────────────────────────────────────────────
 # 1. モデル向けパラメータを "全部入り" で保持する dataclass
 # ─────────────────────────────────────────────
@@ -53,6 +52,104 @@ class GeminiOptions_image:
             frequency_penalty=self.frequency_penalty or None,
         )
     
+# ─────────────────────────────────────────────
+# チラシ画像の前処理（縮小・タイル分割）と結果のマージ
+# ─────────────────────────────────────────────
+def normalize_image_size(image: Image.Image, max_edge: int) -> Image.Image:
+    """長辺が max_edge を超える場合、縦横比を保って縮小する"""
+    if max(image.size) <= max_edge:
+        return image
+    scale = max_edge / max(image.size)
+    new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(new_size, Image.LANCZOS)
+
+def split_into_tiles(image: Image.Image, rows: int, cols: int, overlap: float = 0.1) -> list:
+    """
+    画像を rows × cols のタイルに分割する。
+    境界上の商品が切れないよう、各タイルを上下左右に overlap（タイル幅に対する割合）だけ広げる
+    """
+    if rows <= 1 and cols <= 1:
+        return [image]
+    width, height = image.size
+    tile_w = width / cols
+    tile_h = height / rows
+    pad_x = int(tile_w * overlap)
+    pad_y = int(tile_h * overlap)
+    tiles = []
+    for r in range(rows):
+        for c in range(cols):
+            box = (
+                max(0, int(c * tile_w) - pad_x),
+                max(0, int(r * tile_h) - pad_y),
+                min(width, int((c + 1) * tile_w) + pad_x),
+                min(height, int((r + 1) * tile_h) + pad_y),
+            )
+            tiles.append(image.crop(box))
+    return tiles
+
+def merge_flyer_items(item_lists: list) -> list:
+    """
+    タイルごとの商品リストを結合する。
+    重なり部分で二重に読まれた商品（商品名と値段が同じもの）は1件にまとめ、
+    片方にしかない項目（数量・特売日など）は補完する
+    """
+    def norm(value: Any) -> str:
+        return re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(value or ""))).lower()
+
+    merged: Dict[tuple, dict] = {}
+    for items in item_lists:
+        for item in items:
+            key = (norm(item.get("商品")), norm(item.get("値段")))
+            if not key[0]:
+                continue
+            if key not in merged:
+                merged[key] = dict(item)
+                continue
+            for field, value in item.items():
+                if value and not merged[key].get(field):
+                    merged[key][field] = value
+    return list(merged.values())
+
+# ─────────────────────────────────────────────
+# チラシ OCR 結果のキャッシュ（画像の内容ハッシュ単位）
+# ─────────────────────────────────────────────
+# OCR 結果（JSON）を保存するバケット内のプレフィックス
+OCR_CACHE_PREFIX = os.getenv("FLYER_OCR_CACHE_PREFIX", "flyer_ocr_cache/")
+
+def blob_content_hash(blob) -> Optional[str]:
+    """GCS のメタデータ（MD5、なければ CRC32C）から画像内容のハッシュを返す。ダウンロードは不要"""
+    for value in (blob.md5_hash, blob.crc32c):
+        if value:
+            return base64.b64decode(value).hex()
+    return None
+
+# ─────────────────────────────────────────────
+# 最新チラシのインデックス
+#   チラシは flyers/YYYY-MM-DD/<epoch_ms>.jpg（UTC日付）にアップロードされ、
+#   アップロード時に flyers/latest.json へ最新のパスが書き込まれる
+# ─────────────────────────────────────────────
+FLYER_PREFIX = os.getenv("FLYER_PREFIX", "flyers/")
+FLYER_INDEX_PATH = f"{FLYER_PREFIX}latest.json"
+# インデックスがない場合に遡って探索する日付プレフィックスの日数
+FLYER_INDEX_LOOKBACK_DAYS = int(os.getenv("FLYER_INDEX_LOOKBACK_DAYS", "7"))
+
+def flyer_date_prefix(date_str: str) -> str:
+    """日付（YYYY-MM-DD形式）に対応するチラシのプレフィックスを返す"""
+    return f"{FLYER_PREFIX}{date_str}/"
+
+def flyer_identity(blob) -> tuple:
+    """
+    チラシ画像の Blob から (flyer_id, チラシの日付) を返す。
+    flyer_id は画像のパスで、店舗ごと・日付ごとに別のチラシとして扱う
+    """
+    match = re.match(rf"{re.escape(FLYER_PREFIX)}(\d{{4}}-\d{{2}}-\d{{2}})/", blob.name)
+    if match:
+        return blob.name, datetime.strptime(match.group(1), "%Y-%m-%d").date()
+    return blob.name, (blob.time_created or datetime.now(timezone.utc)).date()
+
+# flyer_data に保存する商品情報の列
+FLYER_ITEM_COLUMNS = ["商品", "数量", "値段", "特売日"]
+
 # ─────────────────────────────────────────────
 # 2. メインクラス
 # ─────────────────────────────────────────────
@@ -114,8 +211,15 @@ class ImageProcessor:
             generation_config=options.to_generation_config(),
             safety_settings=self.safety_settings,
         )
+        self.model_name = model_name
         self.options = options
         self.project_id = project_id
+        # OCR 前処理の設定（長辺の上限・タイル分割数・タイルの重なり・JPEG品質）
+        self.max_edge = int(os.getenv("FLYER_MAX_EDGE", "2048"))
+        self.tile_rows = int(os.getenv("FLYER_TILE_ROWS", "2"))
+        self.tile_cols = int(os.getenv("FLYER_TILE_COLS", "2"))
+        self.tile_overlap = float(os.getenv("FLYER_TILE_OVERLAP", "0.1"))
+        self.jpeg_quality = int(os.getenv("FLYER_JPEG_QUALITY", "85"))
         self.prompt = """
 画像から商品情報を抽出してください。チラシに記載されている商品情報を以下の形式で出力してください：
 
@@ -138,16 +242,16 @@ class ImageProcessor:
     # ─────────────────────────────────────────────
     # 1. 画像取得関連のメソッド
     # ─────────────────────────────────────────────
-    def get_latest_image_path(self, prefix: str = "", target_date: str = None) -> Optional[str]:
+    def _scan_latest_blob(self, prefix: str = "", target_date: str = None):
         """
-        FireStorageから最新の画像ファイルのパスを取得する
+        プレフィックス配下を走査して最新の画像ファイルの Blob を取得する（件数に比例して遅くなる）
 
         Args:
             prefix (str): 検索対象のフォルダパス（例: "images/"）
             target_date (str): 対象日付（YYYY-MM-DD形式）。指定しない場合は最新の画像を返す
 
         Returns:
-            Optional[str]: 最新の画像ファイルのパス。見つからない場合はNone
+            Optional[Blob]: 最新の画像ファイルの Blob（md5_hash 等のメタデータ付き）。見つからない場合はNone
         """
         try:
             # 指定されたパスのファイルをリスト化
@@ -170,13 +274,88 @@ class ImageProcessor:
                         latest_blob = blob
                         latest_time = blob.updated
             
-            if latest_blob:
-                return latest_blob.name
-            
-            return None
+            return latest_blob
         except Exception as e:
             print(f"Error getting latest image path from FireStorage: {e}")
             return None
+
+    def get_latest_image_path(self, prefix: str = "", target_date: str = None) -> Optional[str]:
+        """
+        FireStorageから最新の画像ファイルのパスを取得する
+
+        Args:
+            prefix (str): 検索対象のフォルダパス（例: "images/"）
+            target_date (str): 対象日付（YYYY-MM-DD形式）。指定しない場合は最新の画像を返す
+
+        Returns:
+            Optional[str]: 最新の画像ファイルのパス。見つからない場合はNone
+        """
+        latest_blob = self.get_latest_blob(prefix, target_date)
+        return latest_blob.name if latest_blob else None
+
+    def read_flyer_index(self):
+        """
+        インデックス（flyers/latest.json）から最新のチラシの Blob を取得する
+
+        Returns:
+            Optional[Blob]: 最新のチラシの Blob。インデックスがない・指す先が存在しない場合はNone
+        """
+        try:
+            index = json.loads(self.bucket.blob(FLYER_INDEX_PATH).download_as_text())
+            return self.bucket.get_blob(index["path"])
+        except NotFound:
+            return None
+        except Exception as e:
+            print(f"チラシのインデックスの読み込みに失敗しました: {str(e)}")
+            return None
+
+    def write_flyer_index(self, blob) -> None:
+        """最新のチラシとして blob をインデックスに書き込む"""
+        try:
+            index = {
+                "path": blob.name,
+                "updated": blob.updated.isoformat() if blob.updated else None,
+            }
+            self.bucket.blob(FLYER_INDEX_PATH).upload_from_string(
+                json.dumps(index, ensure_ascii=False),
+                content_type="application/json",
+            )
+        except Exception as e:
+            print(f"チラシのインデックスの保存に失敗しました: {str(e)}")
+
+    def get_latest_blob(self, prefix: str = "", target_date: str = None):
+        """
+        最新のチラシ画像の Blob を取得する。
+        prefix を指定しない場合はインデックスを1回読むだけで済み、バケット内の件数に依存しない
+
+        Args:
+            prefix (str): 検索対象のフォルダパス。指定した場合はその配下を走査する
+            target_date (str): 対象日付（YYYY-MM-DD形式）。指定した場合はその日付のプレフィックスのみ走査する
+
+        Returns:
+            Optional[Blob]: 最新の画像ファイルの Blob。見つからない場合はNone
+        """
+        if target_date:
+            return self._scan_latest_blob(flyer_date_prefix(target_date))
+        if prefix:
+            return self._scan_latest_blob(prefix)
+
+        blob = self.read_flyer_index()
+        if blob is not None:
+            return blob
+
+        # インデックスがない場合は日付プレフィックスを新しい順に探索し、
+        # それでも見つからなければ日付なしの旧形式のアップロードを走査する
+        today = datetime.now(timezone.utc).date()
+        for days in range(FLYER_INDEX_LOOKBACK_DAYS):
+            blob = self._scan_latest_blob(flyer_date_prefix(f"{today - timedelta(days=days):%Y-%m-%d}"))
+            if blob is not None:
+                break
+        else:
+            blob = self._scan_latest_blob(FLYER_PREFIX)
+        if blob is not None:
+            self.write_flyer_index(blob)
+        return blob
     def get_today_latest_image_path(self) -> Optional[str]:
         """
         当日の最新の画像ファイルのパスを取得する
@@ -184,9 +363,8 @@ class ImageProcessor:
         Returns:
             Optional[str]: 当日の最新の画像ファイルのパス。見つからない場合はNone
         """
-        from datetime import datetime
-        today = datetime.now().strftime('%Y-%m-%d')
-        return self.get_latest_image_path(prefix="flyers/", target_date=today)
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        return self.get_latest_image_path(target_date=today)
 
     def get_today_latest_image(self) -> Optional[Image.Image]:
         """
@@ -242,142 +420,359 @@ class ImageProcessor:
     # ─────────────────────────────────────────────
     # 2. 画像処理関連のメソッド
     # ─────────────────────────────────────────────
-    def pil_image_to_gemini_part(self, image: Image.Image) -> dict:
+    def pil_image_to_gemini_part(self, image: Image.Image, quality: Optional[int] = None) -> dict:
         """
         PIL Image を Gemini に渡せるバイナリ形式に変換
 
         Args:
             image (Image.Image): 変換する画像
+            quality (Optional[int]): JPEG品質。指定しない場合は self.jpeg_quality
 
         Returns:
             dict: Gemini APIに渡すための形式に変換された画像データ
         """
         buf = BytesIO()
-        image.save(buf, format='JPEG')
+        image.save(buf, format='JPEG', quality=quality or self.jpeg_quality, optimize=True)
         byte_data = buf.getvalue()
         return {
             "mime_type": "image/jpeg",
             "data": byte_data
         }
-    
+
+    def prepare_flyer_parts(self, image: Image.Image) -> list:
+        """
+        チラシ画像を OCR 向けに前処理し、Gemini に渡すタイルのリストを返す
+        （長辺を max_edge に縮小 → 重なりありのタイルに分割 → JPEG化）
+
+        Args:
+            image (Image.Image): チラシ画像
+
+        Returns:
+            list: タイルごとの Gemini 用画像データ
+        """
+        image = normalize_image_size(image, self.max_edge)
+        tiles = split_into_tiles(image, self.tile_rows, self.tile_cols, self.tile_overlap)
+        return [self.pil_image_to_gemini_part(tile) for tile in tiles]
+
+    # ─────────────────────────────────────────────
+    # OCR 結果キャッシュ関連のメソッド
+    # ─────────────────────────────────────────────
+    def _ocr_cache_path(self, content_hash: str, prompt: str) -> str:
+        # 同じ画像でもモデル・プロンプト・前処理設定が変われば結果が変わるため、キーに含める
+        settings = json.dumps(
+            [self.model_name, prompt, self.max_edge, self.tile_rows, self.tile_cols, self.tile_overlap, self.jpeg_quality],
+            ensure_ascii=False,
+        )
+        fingerprint = hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+        return f"{OCR_CACHE_PREFIX}{content_hash}_{fingerprint}.json"
+
+    def load_cached_ocr(self, content_hash: str, prompt: str) -> Optional[dict]:
+        """
+        画像の内容ハッシュに対応する OCR 結果をキャッシュから取得する
+
+        Returns:
+            Optional[dict]: items（商品情報のリスト）と、その結果を保存した flyer_id・version。
+                キャッシュがない場合はNone
+        """
+        try:
+            text = self.bucket.blob(self._ocr_cache_path(content_hash, prompt)).download_as_text()
+            cached = json.loads(text)
+            # 商品情報のリストだけを保存していた形式は、保存済みのバージョンが分からないものとして扱う
+            if isinstance(cached, list):
+                return {"items": cached, "flyer_id": None, "version": None}
+            return cached
+        except NotFound:
+            return None
+        except Exception as e:
+            print(f"OCRキャッシュの読み込みに失敗しました: {str(e)}")
+            return None
+
+    def save_cached_ocr(
+        self, content_hash: str, prompt: str, items: list, flyer: Optional[tuple], version: str
+    ) -> None:
+        """OCR 結果を、flyer_data に保存した flyer_id・version と一緒に画像の内容ハッシュをキーにキャッシュへ保存する"""
+        entry = {"items": items, "flyer_id": flyer[0] if flyer else None, "version": version}
+        try:
+            self.bucket.blob(self._ocr_cache_path(content_hash, prompt)).upload_from_string(
+                json.dumps(entry, ensure_ascii=False),
+                content_type="application/json",
+            )
+        except Exception as e:
+            print(f"OCRキャッシュの保存に失敗しました: {str(e)}")
+
+    def _resolve_latest_flyer(self, prompt: str) -> tuple:
+        """
+        最新のチラシを特定し、OCR 結果のキャッシュを引く。
+        キャッシュに当たった場合は画像のダウンロード・デコードを行わない
+
+        Returns:
+            tuple: ((flyer_id, チラシの日付) or None, 内容ハッシュ, キャッシュ（load_cached_ocr の戻り値） or None, 画像 or None)
+        """
+        blob = self.get_latest_blob()
+        if blob is None:
+            return None, None, None, None
+        flyer = flyer_identity(blob)
+        content_hash = blob_content_hash(blob)
+        if content_hash:
+            cached = self.load_cached_ocr(content_hash, prompt)
+            if cached is not None:
+                print(f"OCRキャッシュを使用します: {blob.name}")
+                return flyer, content_hash, cached, None
+        return flyer, content_hash, None, self.get_image_from_storage(blob.name)
+
     # ─────────────────────────────────────────────
     # 3. 画像認識関連のメソッド
     # ─────────────────────────────────────────────
+    def _recognition_config(self) -> GenerationConfig:
+        # より決定論的な出力のために温度を下げる
+        return GenerationConfig(
+            temperature=0.1,
+            top_p=1,
+            top_k=1,
+            max_output_tokens=65535,
+            candidate_count=1
+        )
+
+    def _parse_recognition_response(self, response) -> Optional[list]:
+        """
+        Gemini の応答を検証し、商品情報のリストにパースする
+
+        Args:
+            response: generate_content(_async) の戻り値
+
+        Returns:
+            Optional[list]: 抽出した商品情報のリスト。失敗時はNone
+        """
+        try:
+            # レスポンスを処理する前に待機
+            if hasattr(response, 'resolve'):
+                response.resolve()
+
+            # レスポンスの検証
+            if not response.candidates:
+                print("応答が空でした")
+                return None
+
+            # finish_reasonのチェック
+            if hasattr(response.candidates[0], 'finish_reason'):
+                finish_reason = response.candidates[0].finish_reason
+                if finish_reason == 2:  # SAFETY
+                    print(f"安全性チェックにより応答が制限されました（finish_reason: {finish_reason}）")
+                    return None
+
+            # レスポンスの内容を確認
+            if not hasattr(response, 'text'):
+                print("応答にテキストが含まれていません")
+                if hasattr(response, 'prompt_feedback'):
+                    print("Prompt Feedback:", response.prompt_feedback)
+                return None
+
+            response_text = response.text
+            if not response_text:
+                print("応答テキストが空です")
+                return None
+
+            # JSONとしてパース
+            try:
+                # 余分なテキストを削除してJSONを抽出
+                json_text = response_text
+                if "```json" in json_text:
+                    json_text = json_text.split("```json")[1]
+                if "```" in json_text:
+                    json_text = json_text.split("```")[0]
+                json_text = json_text.strip()
+                items = json.loads(json_text)
+            except json.JSONDecodeError as e:
+                print(f"JSONのパースに失敗しました: {str(e)}")
+                print("Response text was:", response_text)
+                return None
+
+            # レスポンスの構造を確認
+            if not isinstance(items, list):
+                print("レスポンスが配列形式ではありません")
+                return None
+
+            # 各オブジェクトの構造を確認
+            required_keys = ["商品", "数量", "値段", "特売日"]
+            for item in items:
+                if not all(key in item for key in required_keys):
+                    print("商品情報に必要なキーが含まれていません")
+                    print("Received keys:", list(item.keys()))
+                    return None
+
+            return items
+
+        except Exception as e:
+            print(f"API呼び出し中にエラーが発生しました: {str(e)}")
+            print("Response details:", response)
+            return None
+
+    def _save_cached_items(self, cached: dict, flyer: Optional[tuple], content_hash: str, prompt: str) -> Optional[list]:
+        """
+        キャッシュに当たった商品情報を flyer_data に保存する。
+        同じ flyer_id でキャッシュと同じ内容のバージョンがすでに保存済みなら追記しない
+
+        Returns:
+            Optional[list]: 商品情報のリスト。保存に失敗した場合はNone
+        """
+        items = cached["items"]
+        if flyer and cached.get("version") and cached.get("flyer_id") == flyer[0]:
+            return items
+        version = self._save_flyer_items(items, flyer)
+        if version is None:
+            return None
+        self.save_cached_ocr(content_hash, prompt, items, flyer, version)
+        return items
+
+    def _save_flyer_items(self, items: list, flyer: Optional[tuple] = None) -> Optional[str]:
+        """
+        商品情報を BigQuery の flyer_data に新しいバージョンとして追記する。
+        テーブルを作り直さないため、複数のチラシを同時に処理しても競合せず、
+        読み込み側は flyer_current ビューで各チラシの最新バージョンだけを参照する
+
+        Args:
+            items (list): 商品情報のリスト
+            flyer (Optional[tuple]): (flyer_id, チラシの日付)。省略時は新しい flyer_id を振る
+
+        Returns:
+            Optional[str]: 保存したバージョン。保存に失敗した場合はNone
+        """
+        now = datetime.now(timezone.utc)
+        flyer_id, flyer_date = flyer or (f"direct/{uuid.uuid4().hex}", now.date())
+        # バージョンは保存時刻の順に並ぶ文字列（同時刻の保存は後ろの乱数で区別する）
+        version = f"{now:%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+
+        # DataFrameに変換（flyer_data の列に揃える）
+        df = pd.DataFrame(items).reindex(columns=FLYER_ITEM_COLUMNS)
+        df = df.apply(lambda column: column.map(lambda value: None if pd.isna(value) else str(value)))
+        df.insert(0, "flyer_id", flyer_id)
+        df.insert(1, "flyer_date", flyer_date)
+        df.insert(2, "version", version)
+        df.insert(3, "created_at", now)
+
+        # Bigqueryに保存
+        try:
+            project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
+            dataset_name = os.getenv('BIGQUERY_DATASET')
+            flyer_table = f"{project_name}.{dataset_name}.flyer_data"
+            # データの保存（追記のみ）
+            pandas_gbq.to_gbq(df, flyer_table, project_id=project_name, if_exists="append")
+        except Exception as e:
+            print(f"Bigqueryに保存中にエラーが発生しました: {str(e)}")
+            return None
+        return version
+
+    def _recognize_tile(self, image_part: dict, prompt: str) -> Optional[list]:
+        try:
+            response = self.model.generate_content(
+                contents=[
+                    image_part,
+                    prompt
+                ],
+                generation_config=self._recognition_config(),
+                stream=False  # ストリーミングを無効化
+            )
+        except Exception as e:
+            print(f"API呼び出し中にエラーが発生しました: {str(e)}")
+            return None
+        return self._parse_recognition_response(response)
+
+    async def _recognize_tile_async(self, image_part: dict, prompt: str) -> Optional[list]:
+        try:
+            response = await self.model.generate_content_async(
+                contents=[
+                    image_part,
+                    prompt
+                ],
+                generation_config=self._recognition_config(),
+            )
+        except Exception as e:
+            print(f"API呼び出し中にエラーが発生しました: {str(e)}")
+            return None
+        return self._parse_recognition_response(response)
+
+    def _merge_tile_results(self, tile_results: list) -> Optional[list]:
+        """タイルごとの結果をマージする。全タイル失敗なら None"""
+        succeeded = [items for items in tile_results if items is not None]
+        if not succeeded:
+            return None
+        if len(succeeded) < len(tile_results):
+            print(f"{len(tile_results) - len(succeeded)}/{len(tile_results)} タイルの認識に失敗しました")
+        items = merge_flyer_items(succeeded)
+        self.response = items
+        return items
+
     def Image_recognition(self, prompt: str = "", image: Optional[Image.Image] = None) -> Optional[dict]:
         if not prompt:
             prompt = self.prompt
 
+        flyer, content_hash = None, None
         if image is None:
-            image = self.get_latest_image()
+            flyer, content_hash, cached, image = self._resolve_latest_flyer(prompt)
+            if cached is not None:
+                self.response = cached["items"]
+                return self._save_cached_items(cached, flyer, content_hash, prompt)
             if image is None:
                 print("画像の取得に失敗しました")
                 return None
 
         try:
-            # 画像をGemini用のフォーマットに変換
-            image_part = self.pil_image_to_gemini_part(image)
-
-            # generation_configを更新
-            generation_config = GenerationConfig(
-                temperature=0.1,  # より決定論的な出力のために温度を下げる
-                top_p=1,
-                top_k=1,
-                max_output_tokens=65535,
-                candidate_count=1
-            )
+            # 画像を縮小・タイル分割して Gemini 用のフォーマットに変換
+            image_parts = self.prepare_flyer_parts(image)
 
-            try:
-                response = self.model.generate_content(
-                    contents=[
-                        image_part,
-                        prompt
-                    ],
-                    generation_config=generation_config,
-                    stream=False  # ストリーミングを無効化
-                )
-
-                # レスポンスを処理する前に待機
-                if hasattr(response, 'resolve'):
-                    response.resolve()
-
-                # レスポンスの検証
-                if not response.candidates:
-                    print("応答が空でした")
-                    return None
+            # タイルごとに並列で認識
+            with ThreadPoolExecutor(max_workers=len(image_parts)) as executor:
+                tile_results = list(executor.map(lambda part: self._recognize_tile(part, prompt), image_parts))
 
-                # finish_reasonのチェック
-                if hasattr(response.candidates[0], 'finish_reason'):
-                    finish_reason = response.candidates[0].finish_reason
-                    if finish_reason == 2:  # SAFETY
-                        print(f"安全性チェックにより応答が制限されました（finish_reason: {finish_reason}）")
-                        return None
-
-                # レスポンスの内容を確認
-                if not hasattr(response, 'text'):
-                    print("応答にテキストが含まれていません")
-                    if hasattr(response, 'prompt_feedback'):
-                        print("Prompt Feedback:", response.prompt_feedback)
-                    return None
+            items = self._merge_tile_results(tile_results)
+            if items is None:
+                return None
+            version = self._save_flyer_items(items, flyer)
+            if version is None:
+                return None
+            # 一部タイルが失敗した不完全な結果はキャッシュしない
+            if content_hash and all(r is not None for r in tile_results):
+                self.save_cached_ocr(content_hash, prompt, items, flyer, version)
+            return items
 
-                response_text = response.text
-                if not response_text:
-                    print("応答テキストが空です")
-                    return None
+        except Exception as e:
+            print(f"画像認識中にエラーが発生しました: {str(e)}")
+            return None
 
-            #    print("API Response:", response_text)  # デバッグ用
-
-                # JSONとしてパース
-                try:
-                    # 余分なテキストを削除してJSONを抽出
-                    json_text = response_text
-                    if "```json" in json_text:
-                        json_text = json_text.split("```json")[1]
-                    if "```" in json_text:
-                        json_text = json_text.split("```")[0]
-                    json_text = json_text.strip()
-
-#                    print("Cleaned JSON text:", json_text[:100] + "...") # デバッグ用に最初の100文字を表示
-                    self.response = json.loads(json_text)
-#                    print("Successfully parsed JSON with", len(self.response), "items") # デバッグ用
-                except json.JSONDecodeError as e:
-                    print(f"JSONのパースに失敗しました: {str(e)}")
-                    print("Response text was:", response_text)
-                    return None
+    async def Image_recognition_async(self, prompt: str = "", image: Optional[Image.Image] = None) -> Optional[dict]:
+        """
+        Image_recognition の asyncio 版。
+        Gemini 呼び出しは generate_content_async、Storage / BigQuery / PIL は同期APIのためスレッドで実行する
+        """
+        if not prompt:
+            prompt = self.prompt
 
-                # レスポンスの構造を確認
-                if not isinstance(self.response, list):
-                    print("レスポンスが配列形式ではありません")
-                    return None
+        flyer, content_hash = None, None
+        if image is None:
+            flyer, content_hash, cached, image = await asyncio.to_thread(self._resolve_latest_flyer, prompt)
+            if cached is not None:
+                self.response = cached["items"]
+                return await asyncio.to_thread(self._save_cached_items, cached, flyer, content_hash, prompt)
+            if image is None:
+                print("画像の取得に失敗しました")
+                return None
 
-                # 各オブジェクトの構造を確認
-                required_keys = ["商品", "数量", "値段", "特売日"]
-                for item in self.response:
-                    if not all(key in item for key in required_keys):
-                        print("商品情報に必要なキーが含まれていません")
-                        print("Received keys:", list(item.keys()))
-                        return None
-
-                # DataFrameに変換
-                df = pd.DataFrame(self.response)
-
-                # Bigqueryに保存
-                try:
-                    project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
-                    dataset_name = os.getenv('BIGQUERY_DATASET')
-                    flyer_table = f"{project_name}.{dataset_name}.flyer_data"
-                    # データの保存
-                    pandas_gbq.to_gbq(df, flyer_table, project_id=project_name, if_exists="replace")
-                except Exception as e:
-                    print(f"Bigqueryに保存中にエラーが発生しました: {str(e)}")
-                    return None
+        try:
+            image_parts = await asyncio.to_thread(self.prepare_flyer_parts, image)
 
-                return self.response
+            tile_results = await asyncio.gather(
+                *(self._recognize_tile_async(part, prompt) for part in image_parts)
+            )
 
-            except Exception as e:
-                print(f"API呼び出し中にエラーが発生しました: {str(e)}")
-                if 'response' in locals():
-                    print("Response details:", response)
+            items = self._merge_tile_results(list(tile_results))
+            if items is None:
+                return None
+            version = await asyncio.to_thread(self._save_flyer_items, items, flyer)
+            if version is None:
                 return None
+            if content_hash and all(r is not None for r in tile_results):
+                await asyncio.to_thread(self.save_cached_ocr, content_hash, prompt, items, flyer, version)
+            return items
 
         except Exception as e:
             print(f"画像認識中にエラーが発生しました: {str(e)}")
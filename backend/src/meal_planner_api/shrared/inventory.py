@@ -0,0 +1,309 @@
+# inventory.py
+import os, re, sys, argparse, pandas as pd
+from typing import Optional, Dict, Tuple
+
+from google.cloud import bigquery
+
+# ─────────────────────────────────────────────
+# 材料の数量・単位の解析
+# ─────────────────────────────────────────────
+# 単位 → (正規化後の単位, 係数)。大さじ・小さじ・カップは ml に換算する
+UNIT_TABLE: Dict[str, Tuple[str, float]] = {
+    "大さじ": ("ml", 15.0),
+    "小さじ": ("ml", 5.0),
+    "カップ": ("ml", 200.0),
+    "ml": ("ml", 1.0),
+    "cc": ("ml", 1.0),
+    "l": ("ml", 1000.0),
+    "g": ("g", 1.0),
+    "kg": ("g", 1000.0),
+    "個": ("個", 1.0),
+    "本": ("本", 1.0),
+    "枚": ("枚", 1.0),
+}
+
+# 長い単位から照合する（kg を g より先に、など）
+_UNITS = "|".join(re.escape(unit) for unit in sorted(UNIT_TABLE, key=len, reverse=True))
+
+# 「大さじ1.5」「1/2個」「1と1/2カップ」「約200g」などから単位と数値を取り出す
+QUANTITY_PATTERN = (
+    rf"(?P<pre_unit>{_UNITS})?\s*"
+    r"(?P<number>\d+(?:\.\d+)?(?![\d./])(?:\s*と\s*\d+/\d+)?|\d+/\d+)\s*"
+    rf"(?P<post_unit>(?:{_UNITS})(?![a-z]))?"
+)
+NUMBER_PATTERN = r"^(?P<whole>\d+(?:\.\d+)?(?![\d./]))?\s*と?\s*(?:(?P<num>\d+)/(?P<den>\d+))?$"
+
+def parse_quantities(quantity: pd.Series, unit: Optional[pd.Series] = None) -> pd.DataFrame:
+    """
+    数量と単位の列をまとめて解析し、正規化した数値と単位を返す
+
+    Parameters
+    ----------
+    quantity : pd.Series
+        数量（"大さじ1.5"、"1/2"、"200g"、200 など）
+    unit : Optional[pd.Series]
+        単位の列（数量に単位が含まれない場合に使う）
+
+    Returns
+    -------
+    pd.DataFrame
+        amount（正規化した単位での数値。解析できない「少々」などは NaN）と unit の列を持つ、
+        quantity と同じインデックスの DataFrame
+    """
+    raw_unit = unit.fillna("").astype(str).str.strip() if unit is not None else pd.Series("", index=quantity.index)
+    text = (
+        (quantity.fillna("").astype(str) + " " + raw_unit)
+        .str.normalize("NFKC")
+        .str.replace("⁄", "/", regex=False)  # ½ などは NFKC で 1⁄2 になる
+        .str.lower()
+    )
+    parts = text.str.extract(QUANTITY_PATTERN)
+    number = parts["number"].str.extract(NUMBER_PATTERN)
+
+    whole = pd.to_numeric(number["whole"], errors="coerce")
+    fraction = pd.to_numeric(number["num"], errors="coerce") / pd.to_numeric(number["den"], errors="coerce")
+    value = whole.fillna(0) + fraction.fillna(0)
+    value = value.where(whole.notna() | fraction.notna())
+
+    matched_unit = parts["pre_unit"].fillna(parts["post_unit"])
+    factor = matched_unit.map(lambda u: UNIT_TABLE[u][1], na_action="ignore").fillna(1.0)
+    # 表にない単位（パック・束など）は単位の列をそのまま使う
+    normalized_unit = matched_unit.map(lambda u: UNIT_TABLE[u][0], na_action="ignore").fillna(raw_unit)
+
+    return pd.DataFrame({"amount": value * factor, "unit": normalized_unit}, index=quantity.index)
+
+def quantity_changes(items: pd.DataFrame, user_id: str, sign: float = 1.0) -> pd.DataFrame:
+    """
+    材料の一覧を在庫の増減にする（数量・単位は parse_quantities で正規化する）
+
+    Parameters
+    ----------
+    items : pd.DataFrame
+        name, quantity, unit の列を持つ材料（unit は無くてもよい）
+    user_id : str
+        ユーザーID
+    sign : float
+        増減の向き（使用した分は -1、在庫に加える分は 1）
+
+    Returns
+    -------
+    pd.DataFrame
+        user_id, ingredient_name, quantity_change, unit の列。「少々」「適量」など数値にできない行は除く
+    """
+    parsed = parse_quantities(items["quantity"], items.get("unit"))
+    parsed_rows = parsed["amount"].notna() & items["name"].notna()
+    if not parsed_rows.all():
+        skipped = items.loc[~parsed_rows, "name"].tolist()
+        print(f"数量を解析できなかった材料をスキップしました: {skipped}")
+    return pd.DataFrame({
+        "user_id": user_id,
+        "ingredient_name": items.loc[parsed_rows, "name"],
+        "quantity_change": sign * parsed.loc[parsed_rows, "amount"],
+        "unit": parsed.loc[parsed_rows, "unit"],
+    })
+
+# ─────────────────────────────────────────────
+# 在庫の現在値（inventory_updates の積み上げ）
+# ─────────────────────────────────────────────
+class InventoryStore:
+    """
+    fridge_items の在庫に inventory_updates（増減の履歴）を積み上げた現在の在庫を inventory_snapshot に保持する。
+
+    - seed: ユーザーの fridge_items の在庫を base_quantity に入れる（ユーザーごとに1回）
+    - apply: 増減を書き込むたびにスナップショットへ MERGE で反映する
+    - read: ユーザーの現在の在庫を1クエリで読む（履歴の件数に依存しない）
+    - compact: retain_days より古い履歴を base_quantity に畳み込んで削除し、
+      スナップショットを「base_quantity + 残りの履歴」で作り直す
+
+    Notes
+    -----
+    数量はすべて parse_quantities で正規化した単位（g・ml・個など）で持つ。
+    在庫を加える場合も quantity_changes(..., sign=1) で増減にしてから履歴と apply に渡す。
+    正は base_quantity（seed した在庫と畳み込んだ履歴）と inventory_updates の履歴で、quantity はそのキャッシュ。
+    apply の失敗や再送による二重反映があっても、次の compact で作り直される
+    """
+
+    def __init__(self, client: bigquery.Client, dataset: str):
+        self.client = client
+        self.snapshot_table = f"{dataset}.inventory_snapshot"
+        self.updates_table = f"{dataset}.inventory_updates"
+
+    def seed(self, user_id: str, fridge_items: pd.DataFrame) -> bool:
+        """
+        fridge_items の在庫を単位を正規化してスナップショットの base_quantity に入れる
+
+        すでに seed 済みのユーザーには何もしない（seeded_at の有無で判定し、同時に呼ばれた場合は
+        トランザクションの競合でどちらかが失敗する）。seed より前に apply された使用分は、
+        同じ品目・単位の行に在庫が足される
+
+        Parameters
+        ----------
+        fridge_items : pd.DataFrame
+            name, quantity, unit の列を持つ冷蔵庫の中身
+
+        Returns
+        -------
+        bool
+            在庫を入れる対象があったか
+        """
+        if fridge_items.empty or not {"name", "quantity"} <= set(fridge_items.columns):
+            return False
+        stock = quantity_changes(fridge_items, user_id)
+        if stock.empty:
+            return False
+        stock = stock.groupby(["ingredient_name", "unit"], as_index=False)["quantity_change"].sum()
+        rows = [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("ingredient_name", "STRING", row.ingredient_name),
+                bigquery.ScalarQueryParameter("unit", "STRING", row.unit),
+                bigquery.ScalarQueryParameter("amount", "FLOAT64", float(row.quantity_change)),
+            )
+            for row in stock.itertuples(index=False)
+        ]
+        script = f"""
+            BEGIN TRANSACTION;
+            IF NOT EXISTS (
+                SELECT 1 FROM `{self.snapshot_table}` WHERE user_id = @user_id AND seeded_at IS NOT NULL
+            ) THEN
+                MERGE `{self.snapshot_table}` AS t
+                USING UNNEST(@stock) AS s
+                ON t.user_id = @user_id AND t.ingredient_name = s.ingredient_name AND t.unit = s.unit
+                WHEN MATCHED THEN
+                    UPDATE SET base_quantity = t.base_quantity + s.amount, quantity = t.quantity + s.amount,
+                               seeded_at = CURRENT_TIMESTAMP(), updated_at = CURRENT_TIMESTAMP()
+                WHEN NOT MATCHED THEN
+                    INSERT (user_id, ingredient_name, unit, base_quantity, quantity, seeded_at, updated_at)
+                    VALUES (@user_id, s.ingredient_name, s.unit, s.amount, s.amount, CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP());
+            END IF;
+            COMMIT TRANSACTION;
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("user_id", "STRING", user_id),
+                bigquery.ArrayQueryParameter("stock", "STRUCT", rows),
+            ]
+        )
+        self.client.query(script, job_config=job_config).result()
+        return True
+
+    def apply(self, inventory_df: pd.DataFrame) -> None:
+        """
+        増減をスナップショットに反映する
+
+        Parameters
+        ----------
+        inventory_df : pd.DataFrame
+            user_id, ingredient_name, quantity_change, unit の列を持つ増減
+        """
+        if inventory_df.empty:
+            return
+        deltas = (
+            inventory_df.assign(unit=inventory_df["unit"].fillna(""))
+            .groupby(["user_id", "ingredient_name", "unit"], as_index=False)["quantity_change"]
+            .sum()
+        )
+        rows = [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("user_id", "STRING", row.user_id),
+                bigquery.ScalarQueryParameter("ingredient_name", "STRING", row.ingredient_name),
+                bigquery.ScalarQueryParameter("unit", "STRING", row.unit),
+                bigquery.ScalarQueryParameter("delta", "FLOAT64", float(row.quantity_change)),
+            )
+            for row in deltas.itertuples(index=False)
+        ]
+        query = f"""
+            MERGE `{self.snapshot_table}` AS t
+            USING UNNEST(@deltas) AS s
+            ON t.user_id = s.user_id AND t.ingredient_name = s.ingredient_name AND t.unit = s.unit
+            WHEN MATCHED THEN
+                UPDATE SET quantity = t.quantity + s.delta, updated_at = CURRENT_TIMESTAMP()
+            WHEN NOT MATCHED THEN
+                INSERT (user_id, ingredient_name, unit, base_quantity, quantity, updated_at)
+                VALUES (s.user_id, s.ingredient_name, s.unit, 0, s.delta, CURRENT_TIMESTAMP())
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("deltas", "STRUCT", rows)]
+        )
+        self.client.query(query, job_config=job_config).result()
+
+    def read(self, user_id: str) -> pd.DataFrame:
+        """
+        ユーザーの現在の在庫（数量が残っているもの）を読む
+
+        Returns
+        -------
+        pd.DataFrame
+            ingredient_name, quantity, unit の列
+        """
+        query = f"""
+            SELECT ingredient_name, quantity, unit
+            FROM `{self.snapshot_table}`
+            WHERE user_id = @user_id AND quantity > 0
+            ORDER BY ingredient_name
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("user_id", "STRING", user_id)]
+        )
+        return self.client.query(query, job_config=job_config).result().to_dataframe()
+
+    def compact(self, retain_days: int = 30) -> None:
+        """
+        retain_days より古い履歴を base_quantity に畳み込んで削除し、スナップショットを作り直す
+        （1つのトランザクションで行う。同時に apply された場合はどちらかが失敗し、apply 側は次回の compact で反映される）
+        """
+        script = f"""
+            DECLARE cutoff TIMESTAMP DEFAULT TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @retain_days DAY);
+            BEGIN TRANSACTION;
+            CREATE TEMP TABLE folded AS
+            SELECT
+                user_id, ingredient_name, unit,
+                SUM(IF(is_base OR created_at < cutoff, quantity, 0)) AS base_quantity,
+                SUM(quantity) AS quantity,
+                MAX(seeded_at) AS seeded_at
+            FROM (
+                SELECT user_id, ingredient_name, unit, base_quantity AS quantity,
+                       TRUE AS is_base, CAST(NULL AS TIMESTAMP) AS created_at, seeded_at
+                FROM `{self.snapshot_table}`
+                UNION ALL
+                SELECT user_id, ingredient_name, IFNULL(unit, ''), quantity_change, FALSE, created_at,
+                       CAST(NULL AS TIMESTAMP)
+                FROM `{self.updates_table}`
+            )
+            GROUP BY user_id, ingredient_name, unit;
+            DELETE FROM `{self.snapshot_table}` WHERE TRUE;
+            INSERT INTO `{self.snapshot_table}` (user_id, ingredient_name, unit, base_quantity, quantity, seeded_at, updated_at)
+            SELECT user_id, ingredient_name, unit, base_quantity, quantity, seeded_at, CURRENT_TIMESTAMP() FROM folded;
+            DELETE FROM `{self.updates_table}` WHERE created_at < cutoff;
+            COMMIT TRANSACTION;
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("retain_days", "INT64", retain_days)]
+        )
+        self.client.query(script, job_config=job_config).result()
+
+def create_inventory_store(client: Optional[bigquery.Client] = None) -> InventoryStore:
+    """環境変数（GOOGLE_CLOUD_PROJECT / BIGQUERY_DATASET）から InventoryStore を作成する"""
+    project_name = os.getenv("GOOGLE_CLOUD_PROJECT")
+    dataset_name = os.getenv("BIGQUERY_DATASET")
+    client = client or bigquery.Client(project=project_name)
+    return InventoryStore(client, f"{project_name}.{dataset_name}")
+
+def main() -> None:
+    """
+    在庫履歴の圧縮（Cloud Scheduler などから定期的に実行する）
+
+        python -m shared.inventory --compact --retain-days 30
+    """
+    parser = argparse.ArgumentParser(description="在庫スナップショットの管理")
+    parser.add_argument("--compact", action="store_true", help="古い履歴をスナップショットに畳み込んで削除する")
+    parser.add_argument("--retain-days", type=int, default=int(os.getenv("INVENTORY_RETAIN_DAYS", "30")))
+    args = parser.parse_args()
+    if not args.compact:
+        parser.print_help()
+        sys.exit(1)
+    create_inventory_store().compact(args.retain_days)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# prompt_context.py
+import os, re, math, pandas as pd
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional, Dict, Any, List, Tuple
+
+# ─────────────────────────────────────────────
+# トークン数の見積もり
+# ─────────────────────────────────────────────
+# ひらがな・カタカナ・漢字・全角記号は1文字ほぼ1トークン、それ以外（英数字・記号）は約4文字で1トークン
+_WIDE_CHARS = re.compile(r"[　-ヿ㐀-䶿一-鿿豈-﫿＀-￯]")
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数をローカルで見積もる（API の count_tokens を呼ばない概算）
+    """
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    narrow = len(text) - wide
+    return wide + (narrow + 3) // 4
+
+# テーブルごとに列名が違うものをプロンプト上でそろえる
+COLUMN_ALIASES = {"ingredient_name": "name"}
+
+# ─────────────────────────────────────────────
+# 関連度による品目の絞り込み
+# ─────────────────────────────────────────────
+# 期限・特売日の近さの重み（名前の類似度は 0〜1、期限の近さは当日 1・翌日 0.5・… の 0〜1）
+DATE_WEIGHT = 0.5
+
+def char_ngrams(text: pd.Series, sizes: Tuple[int, ...] = (1, 2)) -> pd.DataFrame:
+    """
+    文字 n-gram を (row, gram) の縦長の表にする（NFKC・小文字・空白除去のあとで切り出す）
+
+    Returns
+    -------
+    pd.DataFrame
+        row（text のインデックスの位置）と gram の列
+    """
+    normalized = text.fillna("").astype(str).str.normalize("NFKC").str.lower().str.replace(r"\s+", "", regex=True)
+    grams = normalized.map(
+        lambda s: [s[i:i + n] for n in sizes for i in range(len(s) - n + 1)]
+    )
+    exploded = pd.DataFrame({"row": range(len(text)), "gram": grams.to_numpy()}).explode("gram")
+    return exploded.dropna(subset=["gram"])
+
+def similarity_scores(names: pd.Series, query: str) -> pd.Series:
+    """
+    品目名と問い合わせ文の文字 n-gram TF-IDF のコサイン類似度
+
+    IDF は品目名の集合から求めるため、多くの品目に共通する文字（「産」「入」など）は重みが小さくなる
+    """
+    scores = pd.Series(0.0, index=names.index)
+    if names.empty or not query:
+        return scores
+    items = char_ngrams(names)
+    query_grams = char_ngrams(pd.Series([query]))
+    if items.empty or query_grams.empty:
+        return scores
+
+    document_frequency = items.drop_duplicates()["gram"].value_counts()
+    idf = ((len(names) + 1) / (document_frequency + 1)).map(math.log) + 1
+
+    item_weights = items.groupby(["row", "gram"]).size().rename("weight").reset_index()
+    item_weights["weight"] *= item_weights["gram"].map(idf).to_numpy()
+    query_weights = query_grams.groupby("gram").size() * idf.reindex(query_grams["gram"].unique()).fillna(0)
+    query_norm = math.sqrt((query_weights ** 2).sum())
+    if query_norm == 0:
+        return scores
+
+    item_norms = item_weights.groupby("row")["weight"].apply(lambda w: math.sqrt((w ** 2).sum()))
+    item_weights["dot"] = item_weights["weight"] * item_weights["gram"].map(query_weights).fillna(0).to_numpy()
+    dots = item_weights.groupby("row")["dot"].sum()
+    cosine = (dots / (item_norms * query_norm)).reindex(range(len(names))).fillna(0)
+    return pd.Series(cosine.to_numpy(), index=names.index)
+
+def days_until(values: pd.Series, today: Optional[date] = None) -> pd.Series:
+    """
+    期限・特売日の列から今日までの日数を求める（「2025-06-01」「6/1まで」「6月1日」などを読む。読めないものは NaN）
+    """
+    today = today or date.today()
+    text = values.astype(object).where(values.notna(), "").astype(str).str.normalize("NFKC")
+    parts = text.str.extract(r"(?:(?P<year>\d{4})[-/年])?(?P<month>\d{1,2})[-/月](?P<day>\d{1,2})")
+    parts = parts.apply(pd.to_numeric).astype("float64")
+    dates = pd.to_datetime(parts.assign(year=parts["year"].fillna(today.year)), errors="coerce")
+    return (dates - pd.Timestamp(today)).dt.days.set_axis(values.index)
+
+def rank_items(
+    df: pd.DataFrame,
+    query: str,
+    name_column: str = "name",
+    date_column: Optional[str] = None,
+    top_k: Optional[int] = None,
+    today: Optional[date] = None,
+) -> pd.DataFrame:
+    """
+    品目を家庭の条件（食事スタイル・気分）との関連度と期限・特売日の近さで並べ、上位 top_k 件を返す
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        品目の表（冷蔵庫・チラシなど）
+    query : str
+        問い合わせ文（dietary_style と feeling をつなげたもの）
+    name_column : str
+        品目名の列（COLUMN_ALIASES の別名でもよい）
+    date_column : Optional[str]
+        期限・特売日の列。近いものほど上位にする（過ぎたもの・読めないものは加点しない）
+    top_k : Optional[int]
+        残す品目数。None の場合は全件を並べ替えるだけ
+    today : Optional[date]
+        基準日（省略時は今日）
+
+    Returns
+    -------
+    pd.DataFrame
+        スコアの高い順に並べ、品目名の重複を除いた表（同点は元の並び順）
+    """
+    df = df.rename(columns=COLUMN_ALIASES)
+    name_column = COLUMN_ALIASES.get(name_column, name_column)
+    if df.empty or name_column not in df.columns:
+        return df.head(top_k) if top_k is not None else df
+
+    score = similarity_scores(df[name_column], query)
+    if date_column is not None and date_column in df.columns:
+        days = days_until(df[date_column], today)
+        score += DATE_WEIGHT * (1 / (1 + days.where(days >= 0))).fillna(0)
+
+    ranked = df.assign(_score=score.to_numpy()).sort_values("_score", ascending=False, kind="stable")
+    ranked = ranked.drop_duplicates(subset=[name_column]).drop(columns="_score")
+    return ranked.head(top_k) if top_k is not None else ranked
+
+# ─────────────────────────────────────────────
+# テーブルの詰めた直列化
+# ─────────────────────────────────────────────
+@dataclass(frozen=True)
+class PromptSection:
+    title: str
+    df: pd.DataFrame
+    # 出力する列（テーブルにない列は無視する）。先頭の列で重複を除く
+    columns: Tuple[str, ...]
+
+def _format_column(series: pd.Series) -> pd.Series:
+    """1列を文字列にする（200.0 → 200、NaN → 空、タブ・改行は空白に）"""
+    if pd.api.types.is_numeric_dtype(series):
+        text = series.map(lambda v: f"{v:g}", na_action="ignore")
+    else:
+        text = series.astype("string")
+    return text.fillna("").astype(str).str.replace(r"[\t\r\n]+", " ", regex=True).str.strip()
+
+def serialize_rows(df: pd.DataFrame, columns: Tuple[str, ...]) -> Tuple[str, List[str]]:
+    """
+    DataFrame を「ヘッダー1行 + 1行1品目」の TSV にする（インデックスや桁そろえの空白は出さない）
+
+    Returns
+    -------
+    Tuple[str, List[str]]
+        (ヘッダー行, 品目ごとの行)。品目は先頭の列（名前）で重複を除き、元の並び順を保つ
+    """
+    df = df.rename(columns=COLUMN_ALIASES)
+    selected = [c for c in columns if c in df.columns]
+    if df.empty or not selected:
+        return "\t".join(selected), []
+    text = pd.DataFrame({c: _format_column(df[c]) for c in selected})
+    key = text[selected[0]]
+    text = text[(key != "") & ~key.duplicated()]
+    lines = text[selected].agg("\t".join, axis=1) if len(selected) > 1 else text[selected[0]]
+    return "\t".join(selected), lines.tolist()
+
+def build_prompt_context(
+    sections: List[PromptSection],
+    token_budget: Optional[int] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    複数のテーブルをトークン予算内に収まる TSV のプロンプト文にまとめる
+
+    各セクションの行は並び順を優先度とみなし、予算に達するまでセクションを順番に1行ずつ追加する
+    （大きなテーブルが予算を使い切って他のセクションが空になることはない）
+
+    Parameters
+    ----------
+    sections : List[PromptSection]
+        プロンプトに入れるテーブル
+    token_budget : Optional[int]
+        プロンプト文のトークン数の上限（見積もり）。None の場合は PROMPT_TOKEN_BUDGET（既定 2000）
+
+    Returns
+    -------
+    Tuple[str, Dict[str, Any]]
+        (プロンプト文, レポート)。レポートはセクションごとの rows_total / rows_kept / tokens と、
+        全体の tokens / token_budget
+    """
+    if token_budget is None:
+        token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+
+    serialized = [serialize_rows(section.df, section.columns) for section in sections]
+    heads = [f"[{section.title}]\n{header}" for section, (header, _) in zip(sections, serialized)]
+    used = sum(estimate_tokens(head) + 1 for head in heads)
+    kept: List[List[str]] = [[] for _ in sections]
+
+    position = 0
+    remaining = [lines for _, lines in serialized]
+    while any(position < len(lines) for lines in remaining) and used < token_budget:
+        for i, lines in enumerate(remaining):
+            if position >= len(lines):
+                continue
+            cost = estimate_tokens(lines[position]) + 1
+            if used + cost > token_budget:
+                # 予算を超える行は入れず、以降のセクションも同じ位置で打ち切る
+                used = token_budget
+                break
+            kept[i].append(lines[position])
+            used += cost
+        position += 1
+
+    blocks = ["\n".join([head] + lines) for head, lines in zip(heads, kept)]
+    text = "\n\n".join(blocks)
+    report = {
+        "sections": {
+            section.title: {
+                "rows_total": len(lines),
+                "rows_kept": len(kept_lines),
+                "tokens": estimate_tokens(block),
+            }
+            for section, (_, lines), kept_lines, block in zip(sections, serialized, kept, blocks)
+        },
+        "tokens": estimate_tokens(text),
+        "token_budget": token_budget,
+    }
+    return text, report
+
+def format_report(report: Dict[str, Any]) -> str:
+    """build_prompt_context のレポートを1行ずつの表示にする"""
+    lines = [f"プロンプトのトークン数（見積もり）: {report['tokens']} / {report['token_budget']}"]
+    for title, section in report["sections"].items():
+        lines.append(
+            f"  {title}: {section['rows_kept']}/{section['rows_total']}行, {section['tokens']}トークン"
+        )
+    return "\n".join(lines)
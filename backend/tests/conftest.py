@@ -0,0 +1,37 @@
+# conftest.py
+"""
+テスト共通の設定
+
+共有モジュールはサービスから `shared.` として読み込まれる（リポジトリ上のディレクトリ名は shrared）ため、
+同じ名前で import できるようにする。Cloud Run サービスの単一ファイルはパスから読み込む
+"""
+import sys, types, importlib.util
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+SHARED_DIR = REPO_ROOT / "backend" / "src" / "meal_planner_api" / "shrared"
+
+if "shared" not in sys.modules:
+    shared = types.ModuleType("shared")
+    shared.__path__ = [str(SHARED_DIR)]
+    sys.modules["shared"] = shared
+
+# MenuStreamParser を持つサービス（同じ実装をそれぞれのファイルに持つ）
+SERVICE_FILES = {
+    "menu_image_generate": REPO_ROOT / "backend" / "cloudrun" / "menu_image_generate" / "menu_image_generate.py",
+    "temp_build_app": REPO_ROOT / "temp-build" / "app" / "app.py",
+}
+
+def load_service(name: str) -> types.ModuleType:
+    """サービスの単一ファイルをモジュールとして読み込む（依存パッケージが無ければテストをスキップ）"""
+    for module in ("dotenv", "fastapi", "pandas"):
+        pytest.importorskip(module)
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, SERVICE_FILES[name])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,23 @@
+# test_gemini_model_cache.py
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("google.generativeai")
+pytest.importorskip("firebase_admin")
+from shared.gemini_processor import GeminiOptions, GeminiProcessor
+
+@pytest.fixture
+def processor(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test-key")
+    monkeypatch.setenv("GEMINI_MODEL_CACHE_SIZE", "2")
+    return GeminiProcessor(options=GeminiOptions(system_instruction="default"))
+
+def test_model_cache_evicts_least_recently_used(processor):
+    first = processor._get_model("a")
+    processor._get_model("b")
+    # "a" を使い直すと、次に捨てられるのは "b"
+    assert processor._get_model("a") is first
+    processor._get_model("c")
+    assert list(processor._models) == ["a", "c"]
+    # 既定の system_instruction のモデルは捨てられても self.model として残る
+    assert processor._select_model(None) is processor.model
@@ -0,0 +1,94 @@
+# test_gemini_schema.py
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("google.generativeai")
+pytest.importorskip("firebase_admin")
+from shared.gemini_processor import compile_validator, json_text_validator, to_gemini_schema
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "total_time_min": {"type": "integer", "minimum": 0},
+        "nutrition": {"$ref": "#/$defs/nutrition"},
+        "ingredients": {"type": "array", "items": {"$ref": "#/$defs/ingredient"}},
+        "instructions": {"type": "array", "items": {"type": "string"}, "minItems": 1},
+    },
+    "required": ["title", "total_time_min", "nutrition", "ingredients", "instructions"],
+    "additionalProperties": False,
+    "$defs": {
+        "nutrition": {
+            "type": "object",
+            "properties": {"kcal": {"type": "number", "minimum": 0}, "salt_g": {"type": "number", "minimum": 0}},
+            "required": ["kcal", "salt_g"],
+            "additionalProperties": False,
+        },
+        "ingredient": {
+            "type": "object",
+            "properties": {"name": {"type": "string"}, "quantity": {"type": "string"}},
+            "required": ["name", "quantity"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+VALID = {
+    "title": "鮭の塩麹焼き",
+    "total_time_min": 25,
+    "nutrition": {"kcal": 560, "salt_g": 2.5},
+    "ingredients": [{"name": "鮭", "quantity": "2"}],
+    "instructions": ["焼く"],
+}
+
+@pytest.fixture(scope="module")
+def validate():
+    return compile_validator(SCHEMA)
+
+def test_valid_document_has_no_errors(validate):
+    assert validate(VALID) == []
+
+@pytest.mark.parametrize(
+    "patch, expected",
+    [
+        ({"nutrition": {"salt_g": 1}}, ["$.nutrition.kcal: ありません"]),
+        ({"nutrition": {"kcal": -1, "salt_g": 1}}, ["$.nutrition.kcal: 0 未満です"]),
+        ({"nutrition": {"kcal": True, "salt_g": 1}}, ["$.nutrition.kcal: number ではありません（bool）"]),
+        ({"nutrition": {"kcal": 1, "salt_g": 1, "fiber_g": 1}}, ["$.nutrition.fiber_g: 定義にない項目です"]),
+        (
+            {"ingredients": [{"name": "鮭", "quantity": "2"}, {"name": "塩", "quantity": 1}]},
+            ["$.ingredients[1].quantity: string ではありません（int）"],
+        ),
+        ({"ingredients": [{"name": "鮭"}]}, ["$.ingredients[0].quantity: ありません"]),
+        ({"instructions": []}, ["$.instructions: 要素が 1 個未満です"]),
+        ({"total_time_min": 2.5}, ["$.total_time_min: integer ではありません（float）"]),
+    ],
+)
+def test_nested_errors_report_their_path(validate, patch, expected):
+    assert validate({**VALID, **patch}) == expected
+
+def test_type_error_stops_checks_below_it(validate):
+    assert validate({**VALID, "nutrition": []}) == ["$.nutrition: object ではありません（list）"]
+
+def test_collects_every_error(validate):
+    document = {"title": 1, "nutrition": {"kcal": -1}, "ingredients": [], "instructions": ["a"], "notes": ""}
+    assert sorted(validate(document)) == sorted([
+        "$.total_time_min: ありません",
+        "$.title: string ではありません（int）",
+        "$.nutrition.salt_g: ありません",
+        "$.nutrition.kcal: 0 未満です",
+        "$.notes: 定義にない項目です",
+    ])
+
+def test_json_text_validator_reports_broken_json(validate):
+    validate_text = json_text_validator(validate)
+    assert validate_text('{"title": ') != []
+    assert validate_text('{"title": ')[0].startswith("$: JSON として読めません")
+
+def test_gemini_schema_expands_refs_and_keeps_property_order():
+    converted = to_gemini_schema(SCHEMA)
+    assert converted["propertyOrdering"] == ["title", "total_time_min", "nutrition", "ingredients", "instructions"]
+    assert converted["properties"]["nutrition"]["propertyOrdering"] == ["kcal", "salt_g"]
+    assert converted["properties"]["ingredients"]["items"]["required"] == ["name", "quantity"]
+    assert "$defs" not in converted and "additionalProperties" not in converted
+    assert "minimum" not in converted["properties"]["total_time_min"]
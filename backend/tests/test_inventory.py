@@ -0,0 +1,108 @@
+# test_inventory.py
+import math
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")
+from shared.inventory import parse_quantities
+
+@pytest.mark.parametrize(
+    "quantity, unit, amount, normalized_unit",
+    [
+        ("1と1/2カップ", "", 300.0, "ml"),
+        ("約200g", "", 200.0, "g"),
+        ("大さじ1.5", "", 22.5, "ml"),
+        ("1/2個", "", 0.5, "個"),
+        ("½カップ", "", 100.0, "ml"),
+        ("1kg", "", 1000.0, "g"),
+        ("200", "g", 200.0, "g"),
+        ("2パック", "パック", 2.0, "パック"),
+    ],
+)
+def test_parse_quantities(quantity, unit, amount, normalized_unit):
+    parsed = parse_quantities(pd.Series([quantity]), pd.Series([unit]))
+    assert parsed.loc[0, "amount"] == pytest.approx(amount)
+    assert parsed.loc[0, "unit"] == normalized_unit
+
+def test_unparsable_quantity_is_nan_and_keeps_index():
+    parsed = parse_quantities(pd.Series(["少々", None], index=[10, 11]))
+    assert list(parsed.index) == [10, 11]
+    assert parsed["amount"].map(math.isnan).all()
+
+# ─────────────────────────────────────────────
+# InventoryStore（スナップショット表をメモリ上の辞書で置き換える）
+# ─────────────────────────────────────────────
+class SnapshotClient:
+    """seed / apply / read が送るクエリパラメータを MERGE・SELECT と同じ規則で snapshot に反映する"""
+
+    def __init__(self):
+        self.snapshot = {}
+        self.rows = None
+
+    def query(self, query, job_config=None):
+        params = {p.name: p for p in job_config.query_parameters}
+        user_id = params["user_id"].value if "user_id" in params else None
+        if "stock" in params:
+            if not any(row["seeded"] for (uid, _, _), row in self.snapshot.items() if uid == user_id):
+                for struct in params["stock"].values:
+                    s = struct.struct_values
+                    row = self.snapshot.setdefault(
+                        (user_id, s["ingredient_name"], s["unit"]), {"base": 0.0, "quantity": 0.0, "seeded": False}
+                    )
+                    row.update(base=row["base"] + s["amount"], quantity=row["quantity"] + s["amount"], seeded=True)
+        elif "deltas" in params:
+            for struct in params["deltas"].values:
+                s = struct.struct_values
+                row = self.snapshot.setdefault(
+                    (s["user_id"], s["ingredient_name"], s["unit"]), {"base": 0.0, "quantity": 0.0, "seeded": False}
+                )
+                row["quantity"] += s["delta"]
+        else:
+            self.rows = pd.DataFrame(
+                [
+                    {"ingredient_name": name, "quantity": row["quantity"], "unit": unit}
+                    for (uid, name, unit), row in sorted(self.snapshot.items())
+                    if uid == user_id and row["quantity"] > 0
+                ],
+                columns=["ingredient_name", "quantity", "unit"],
+            )
+        return self
+
+    def result(self):
+        return self
+
+    def to_dataframe(self):
+        return self.rows
+
+@pytest.fixture
+def store():
+    from shared.inventory import InventoryStore
+    return InventoryStore(SnapshotClient(), "project.dataset")
+
+FRIDGE = pd.DataFrame({
+    "name": ["鶏もも肉", "牛乳", "卵", "塩"],
+    "quantity": ["1", "1", "6", "少々"],
+    "unit": ["kg", "l", "個", ""],
+})
+
+def test_read_returns_stock_after_usage(store):
+    from shared.inventory import quantity_changes
+    used = pd.DataFrame({"name": ["鶏もも肉", "牛乳", "卵"], "quantity": ["200g", "1カップ", "6"], "unit": ["", "", "個"]})
+    # seed 前の使用分（負の数量だけ）は在庫として読まれない
+    store.apply(quantity_changes(used, "u1", sign=-1))
+    assert store.read("u1").empty
+
+    assert store.seed("u1", FRIDGE)
+    inventory = store.read("u1")
+    # fridge_items の kg・l も使用分と同じ g・ml にそろえて積み上げる（使い切った卵は出ない）
+    assert inventory.to_dict("records") == [
+        {"ingredient_name": "牛乳", "quantity": 800.0, "unit": "ml"},
+        {"ingredient_name": "鶏もも肉", "quantity": 800.0, "unit": "g"},
+    ]
+
+def test_seed_is_applied_once_per_user(store):
+    store.seed("u1", FRIDGE)
+    store.seed("u1", FRIDGE)
+    assert store.read("u1")["quantity"].tolist() == [6.0, 1000.0, 1000.0]
+    assert store.read("u2").empty
@@ -0,0 +1,71 @@
+# test_menu_stream_parser.py
+import json
+
+import pytest
+
+from conftest import SERVICE_FILES, load_service
+
+MENU = {
+    "title": "\"特製\" 鮭の塩麹焼き {和風}, 改",
+    "cuisine": "和食",
+    "total_time_min": 25,
+    "nutrition": {"kcal": 560, "protein_g": 30, "fat_g": 20, "carb_g": 45, "salt_g": 2.5},
+    "ingredients": [
+        {"name": "鮭", "quantity": "2", "unit": "切れ"},
+        {"name": "塩麹", "quantity": "大さじ1.5", "unit": ""},
+    ],
+    "instructions": ["鮭に塩麹を塗る", "「焼く」→ 裏返す\\ 5分"],
+}
+RAW = json.dumps(MENU, ensure_ascii=False, indent=2)
+
+@pytest.fixture(params=sorted(SERVICE_FILES))
+def parser_class(request):
+    return load_service(request.param).MenuStreamParser
+
+def feed_all(parser, chunks):
+    completed = []
+    for chunk in chunks:
+        completed.extend(parser.feed(chunk))
+    return completed
+
+def test_whole_document_yields_fields_in_order(parser_class):
+    parser = parser_class()
+    completed = parser.feed(RAW)
+    assert [key for key, _ in completed] == list(MENU)
+    assert parser.fields == MENU
+
+def test_escaped_quotes_and_delimiters_inside_strings(parser_class):
+    parser = parser_class()
+    parser.feed('{"title": "\\"特製\\" {カレー}, [辛口]", "cuisine": "洋食"')
+    assert parser.fields == {"title": "\"特製\" {カレー}, [辛口]"}
+    parser.feed("}")
+    assert parser.fields["cuisine"] == "洋食"
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_any_chunk_size_gives_same_fields(parser_class, size):
+    parser = parser_class()
+    completed = feed_all(parser, [RAW[i:i + size] for i in range(0, len(RAW), size)])
+    assert [key for key, _ in completed] == list(MENU)
+    assert parser.fields == MENU
+
+def test_chunk_boundary_inside_key(parser_class):
+    parser = parser_class()
+    assert parser.feed('{"tot') == []
+    assert parser.feed('al_time_min": 2') == []
+    assert parser.feed('5, "ti') == [("total_time_min", 25)]
+    assert parser.feed('tle": "丼"}') == [("title", "丼")]
+
+def test_chunk_boundary_after_escape(parser_class):
+    parser = parser_class()
+    parser.feed('{"title": "a\\')
+    parser.feed('"b", "cuisine": "x"}')
+    assert parser.fields == {"title": 'a"b', "cuisine": "x"}
+
+def test_nested_value_is_not_emitted_until_closed(parser_class):
+    parser = parser_class()
+    assert parser.feed('{"nutrition": {"kcal": 560, "fat_g": 2') == []
+    assert parser.feed("0}") == []
+    assert parser.feed(', "title": "t"}') == [
+        ("nutrition", {"kcal": 560, "fat_g": 20}),
+        ("title", "t"),
+    ]
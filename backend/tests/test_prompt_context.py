@@ -0,0 +1,84 @@
+# test_prompt_context.py
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from shared.prompt_context import (
+    PromptSection, build_prompt_context, days_until, estimate_tokens, rank_items, serialize_rows
+)
+
+TODAY = date(2026, 10, 18)
+
+# ─────────────────────────────────────────────
+# rank_items
+# ─────────────────────────────────────────────
+@pytest.fixture
+def fridge():
+    return pd.DataFrame({
+        "ingredient_name": ["牛乳", "鮭の切り身", "鮭の切り身", "豚こま肉", "キャベツ", "ヨーグルト"],
+        "expiry_date": ["2026-10-30", "10/25", "10/19", None, "10月19日", "10/1"],
+    })
+
+def test_days_until_reads_several_formats():
+    days = days_until(pd.Series(["2026-10-20", "10/19", "10月18日", "期限なし", None]), TODAY)
+    assert days.tolist()[:3] == [2, 1, 0]
+    assert days.iloc[3:].isna().all()
+
+def test_rank_items_orders_by_relevance_and_expiry(fridge):
+    ranked = rank_items(fridge, "和食 鮭", "ingredient_name", "expiry_date", today=TODAY)
+    # 名前の別名（ingredient_name → name）でそろえ、重複は最もスコアの高い行を残す
+    assert ranked["name"].tolist() == ["鮭の切り身", "キャベツ", "牛乳", "豚こま肉", "ヨーグルト"]
+    assert ranked.iloc[0]["expiry_date"] == "10/19"
+
+def test_rank_items_does_not_boost_past_dates(fridge):
+    ranked = rank_items(fridge, "", "ingredient_name", "expiry_date", today=TODAY)
+    assert ranked["name"].tolist().index("ヨーグルト") > ranked["name"].tolist().index("牛乳")
+
+def test_rank_items_top_k(fridge):
+    ranked = rank_items(fridge, "和食 鮭", "ingredient_name", "expiry_date", top_k=2, today=TODAY)
+    assert ranked["name"].tolist() == ["鮭の切り身", "キャベツ"]
+
+def test_rank_items_without_name_column_keeps_order(fridge):
+    ranked = rank_items(fridge, "鮭", "商品", top_k=3)
+    assert ranked["name"].tolist() == fridge["ingredient_name"].head(3).tolist()
+
+# ─────────────────────────────────────────────
+# build_prompt_context
+# ─────────────────────────────────────────────
+@pytest.fixture
+def sections():
+    fridge = pd.DataFrame({"name": [f"食材{i}" for i in range(20)], "quantity": [200.0] * 20})
+    flyer = pd.DataFrame({"商品": [f"特売{i}" for i in range(20)]})
+    return [
+        PromptSection("冷蔵庫", fridge, ("name", "quantity", "unit")),
+        PromptSection("チラシ", flyer, ("商品",)),
+    ]
+
+def test_serialize_rows_formats_numbers_and_skips_missing_columns(sections):
+    header, lines = serialize_rows(sections[0].df.head(2), sections[0].columns)
+    assert header == "name\tquantity"
+    assert lines == ["食材0\t200", "食材1\t200"]
+
+def test_large_budget_keeps_every_row(sections):
+    text, report = build_prompt_context(sections, token_budget=10_000)
+    assert [s["rows_kept"] for s in report["sections"].values()] == [20, 20]
+    assert report["tokens"] == estimate_tokens(text)
+
+@pytest.mark.parametrize("budget", [30, 45, 60, 100])
+def test_budget_cuts_rows_round_robin(sections, budget):
+    text, report = build_prompt_context(sections, token_budget=budget)
+    kept = [s["rows_kept"] for s in report["sections"].values()]
+    assert report["tokens"] <= budget
+    assert sum(kept) < 40
+    # 1つのセクションが予算を使い切らず、どちらも同じ位置まで（差は1行以内）入る
+    assert min(kept) >= 1
+    assert max(kept) - min(kept) <= 1
+    # 残すのは各セクションの先頭（優先度の高い）行
+    assert "食材0\t200" in text and "特売0" in text
+    assert f"食材{max(kept)}\t" not in text
+
+def test_budget_smaller_than_headers_keeps_no_rows(sections):
+    text, report = build_prompt_context(sections, token_budget=5)
+    assert [s["rows_kept"] for s in report["sections"].values()] == [0, 0]
+    assert text == "[冷蔵庫]\nname\tquantity\n\n[チラシ]\n商品"
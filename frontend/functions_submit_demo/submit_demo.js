@@ -15,12 +15,6 @@ const bigquery = new BigQuery();
 const datasetId = 'meal_planner';
 const tableId = 'Demo_Remake';
 
-// ランダムな16文字の英数字を生成する関数
-function generateRandomId(length = 16) {
-  const chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789';
-  return Array.from({ length }, () => chars[Math.floor(Math.random() * chars.length)]).join('');
-}
-
 // 🌐 CORS（クロスオリジンリクエスト）を許可するミドルウェア
 app.use((req, res, next) => {
   res.setHeader('Access-Control-Allow-Origin', '*'); // 必要に応じてドメインを制限可能
@@ -52,7 +46,7 @@ app.post('/submit', async (req, res) => {
     // 各 gender ごとにレコードを作成
     for (let i = 0; i < genders.length; i++) {
       const row = {
-        user_id: generateRandomId(), // ✅ 毎回ユニークなID
+        user_id: data.user_id || null, // Firebase の uid（メニュー生成APIはこの user_id の世帯だけを読む）
         name: null,
         age: ages[i] || null, // 同じ長さでなければ null
         gender: genders[i],
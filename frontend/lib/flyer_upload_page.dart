@@ -5,6 +5,7 @@ import 'package:image_picker/image_picker.dart';
 import 'dart:convert';
 import 'package:http/http.dart' as http;
 import 'package:firebase_storage/firebase_storage.dart';
+import 'package:firebase_auth/firebase_auth.dart';
 import 'package:google_fonts/google_fonts.dart';
 
 import 'recipe_suggestions_page.dart';
@@ -40,8 +41,11 @@ class _FlyerUploadPageState extends State<FlyerUploadPage> {
     List<String> downloadUrls = [];
 
     for (final image in images) {
-      final fileName = '${DateTime.now().millisecondsSinceEpoch}.jpg';
-      final ref = storage.ref().child('flyers/$fileName');
+      // flyers/YYYY-MM-DD/<epoch_ms>.jpg（UTC日付）に日付ごとに分けて保存する
+      final now = DateTime.now().toUtc();
+      final date = now.toIso8601String().substring(0, 10);
+      final fileName = '${now.millisecondsSinceEpoch}.jpg';
+      final ref = storage.ref().child('flyers/$date/$fileName');
       try {
         debugPrint('アップロード中: ${image.name}');
         if (kIsWeb) {
@@ -52,6 +56,7 @@ class _FlyerUploadPageState extends State<FlyerUploadPage> {
           );
           final url = await uploadTask.ref.getDownloadURL();
           downloadUrls.add(url);
+          await _updateLatestFlyerIndex(storage, ref.fullPath);
           debugPrint('アップロード成功: $url');
         }
       } on FirebaseException catch (e) {
@@ -63,12 +68,34 @@ class _FlyerUploadPageState extends State<FlyerUploadPage> {
     return downloadUrls;
   }
 
+  /// 最新チラシのインデックス（flyers/latest.json）を更新する
+  /// バックエンドはバケットを走査せず、このファイルから最新のチラシを特定する
+  Future<void> _updateLatestFlyerIndex(FirebaseStorage storage, String path) async {
+    await storage.ref().child('flyers/latest.json').putString(
+      jsonEncode({
+        'path': path,
+        'updated': DateTime.now().toUtc().toIso8601String(),
+      }),
+      metadata: SettableMetadata(contentType: 'application/json'),
+    );
+  }
+
+  /// メニュー生成APIに渡すヘッダー（世帯はログイン中ユーザーの ID トークンでサーバー側が決める）
+  Future<Map<String, String>> _authHeaders() async {
+    final auth = FirebaseAuth.instance;
+    final user = auth.currentUser ?? (await auth.signInAnonymously()).user!;
+    return {
+      'Content-Type': 'application/json',
+      'Authorization': 'Bearer ${await user.getIdToken()}',
+    };
+  }
+
   /// 画像あり: チラシ情報アリAPI
   Future<Map<String, dynamic>?> _fetchRecipeWithFlyer(List<String> flyerUrls) async {
     try {
       final response = await http.post(
         Uri.parse('https://flyer-menu-generate-418875428443.asia-northeast1.run.app/generate_menu_from_flyer'),
-        headers: {'Content-Type': 'application/json'},
+        headers: await _authHeaders(),
         body: jsonEncode({'flyer_urls': flyerUrls}),
       );
       if (response.statusCode == 200) {
@@ -89,7 +116,7 @@ class _FlyerUploadPageState extends State<FlyerUploadPage> {
     try {
       final response = await http.post(
         Uri.parse('https://non-flyer-menu-generate-418875428443.asia-northeast1.run.app/generate_with_image'),
-        headers: {'Content-Type': 'application/json'},
+        headers: await _authHeaders(),
         body: jsonEncode({'prompt': '（ここに適宜フォームの内容など渡す）'}),
       );
       if (response.statusCode == 200) {
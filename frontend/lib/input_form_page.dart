@@ -1,4 +1,5 @@
 import 'package:flutter/material.dart';
+import 'package:firebase_auth/firebase_auth.dart';
 import 'package:multi_select_flutter/multi_select_flutter.dart';
 import 'flyer_upload_page.dart';
 import 'package:http/http.dart' as http;
@@ -317,8 +318,46 @@ class _InputFormPageState extends State<InputFormPage> {
     );
   }
 
+  /// ログイン中のユーザー（未ログインなら匿名ログインする）。uid を世帯の user_id として使う
+  Future<User> _currentUser() async {
+    final auth = FirebaseAuth.instance;
+    return auth.currentUser ?? (await auth.signInAnonymously()).user!;
+  }
+
+  Future<void> _invalidateDemographics(User user) async {
+    final idToken = await user.getIdToken();
+    const urls = [
+      'https://flyer-menu-generate-418875428443.asia-northeast1.run.app/invalidate_demographics',
+      'https://non-flyer-menu-generate-418875428443.asia-northeast1.run.app/invalidate_demographics',
+    ];
+    await Future.wait(urls.map((url) async {
+      try {
+        await http.post(
+          Uri.parse(url),
+          headers: {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer $idToken',
+          },
+          body: jsonEncode({'user_id': user.uid}),
+        );
+      } catch (e) {
+        debugPrint('キャッシュ破棄エラー: $e');
+      }
+    }));
+  }
+
   Future<void> _submitForm() async {
+    final User user;
+    try {
+      user = await _currentUser();
+    } catch (e) {
+      ScaffoldMessenger.of(context).showSnackBar(
+        SnackBar(content: Text('ログインに失敗しました', style: GoogleFonts.mPlusRounded1c())),
+      );
+      return;
+    }
     final data = {
+      'user_id': user.uid,
       'genders': genders,
       'ages': ages,
       'preferences': selectedPreference,
@@ -334,6 +373,8 @@ class _InputFormPageState extends State<InputFormPage> {
       );
 
       if (response.statusCode == 200) {
+        // メニュー生成APIにキャッシュ中の古いプロフィールを破棄させる（失敗してもTTLで更新される）
+        await _invalidateDemographics(user);
         Navigator.push(
           context,
           MaterialPageRoute(builder: (_) => const FlyerUploadPage()),
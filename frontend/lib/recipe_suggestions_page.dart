@@ -19,6 +19,10 @@ class RecipeDetailPage extends StatelessWidget {
     final nutrition = (recipe["nutrition"] as List?)?.isNotEmpty == true ? recipe["nutrition"][0] : {};
     final ingredients = (recipe["ingredients"] as List?) ?? [];
     final instructions = (recipe["instructions"] as List?) ?? [];
+    // 画像はストレージのURLで返る（カードは thumb、タップで full）。旧レスポンス（image_base64）にも対応
+    final image = recipe['image'];
+    final String? imageUrl = _variantUrl(image, 'thumb');
+    final String? fullImageUrl = _variantUrl(image, 'full');
     final imageBase64 = recipe['image_base64'];
     Uint8List? imageBytes;
     if (imageBase64 != null && imageBase64 is String && imageBase64.isNotEmpty) {
@@ -92,7 +96,7 @@ class RecipeDetailPage extends StatelessWidget {
                       const SizedBox(width: 32),
                       SizedBox(
                         width: 380,
-                        child: _buildImageCard(imageBytes),
+                        child: _buildImageCard(context, imageBytes, imageUrl, fullImageUrl),
                       ),
                     ],
                   ),
@@ -258,7 +262,31 @@ class RecipeDetailPage extends StatelessWidget {
         }).toList(),
       );
 
-  static Widget _buildImageCard(Uint8List? imageBytes) => Container(
+  // variants[label] の WebP → JPEG → 原寸 の順でURLを選ぶ
+  static String? _variantUrl(dynamic image, String label) {
+    if (image is! Map) return null;
+    final variants = image['variants'];
+    final variant = variants is Map ? variants[label] : null;
+    for (final candidate in [
+      variant is Map ? variant['webp'] : null,
+      variant is Map ? variant['jpg'] : null,
+      image,
+    ]) {
+      if (candidate is Map && candidate['url'] is String && (candidate['url'] as String).isNotEmpty) {
+        return candidate['url'] as String;
+      }
+    }
+    return null;
+  }
+
+  static void _showFullImage(BuildContext context, String url) => showDialog(
+        context: context,
+        builder: (_) => Dialog(
+          child: InteractiveViewer(child: Image.network(url, fit: BoxFit.contain)),
+        ),
+      );
+
+  static Widget _buildImageCard(BuildContext context, Uint8List? imageBytes, String? imageUrl, String? fullImageUrl) => Container(
         width: 380,
         height: 380,
         decoration: BoxDecoration(
@@ -272,7 +300,15 @@ class RecipeDetailPage extends StatelessWidget {
             )
           ],
         ),
-        child: imageBytes != null
+        child: imageUrl != null
+            ? GestureDetector(
+                onTap: () => _showFullImage(context, fullImageUrl ?? imageUrl),
+                child: ClipRRect(
+                  borderRadius: BorderRadius.circular(20),
+                  child: Image.network(imageUrl, fit: BoxFit.cover, width: 380, height: 380),
+                ),
+              )
+            : imageBytes != null
             ? ClipRRect(
                 borderRadius: BorderRadius.circular(20),
                 child: Image.memory(imageBytes, fit: BoxFit.cover, width: 380, height: 380),
@@ -2,29 +2,54 @@
 メニュージェネレーター（単一ファイル版）
 Gemini APIを使用して、ユーザーの条件に合わせた料理メニューを自動生成するツリプトです。
 """
+from __future__ import annotations
 
-import os
-import sys
-import json
-import pandas as pd
-import pandas_gbq 
-from datetime import datetime, timezone
-from dotenv import load_dotenv
-# from shared.gemini_processor import GeminiOptions, GeminiProcessor
-
-
-import os, json, pandas as pd
-from typing import Optional, Dict, Any, List
+import os, json, time, asyncio, threading, hashlib, sqlite3
+import importlib
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict
 from dotenv import load_dotenv
-from google import generativeai as genai        
-from google.generativeai import GenerationConfig  
 import logging
 
 # ロギングの設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ─────────────────────────────────────────────
+# 重いモジュールの遅延インポート（コールドスタート短縮）
+# ─────────────────────────────────────────────
+# モジュール読み込みの開始時刻（起動レポート用）
+MODULE_LOAD_STARTED = time.perf_counter()
+
+class LazyModule:
+    """
+    Gemini SDK・pandas・firebase_admin などの import を初回の属性アクセスまで遅らせるプロキシ。
+    コンテナ起動時には読み込まず、lifespan のバックグラウンド warmup か最初のメニュー生成で読み込む
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+
+    def load(self) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.load(), attr)
+
+pd = LazyModule("pandas")
+pandas_gbq = LazyModule("pandas_gbq")
+genai = LazyModule("google.generativeai")
+firebase_admin = LazyModule("firebase_admin")
+google_auth = LazyModule("google.auth")
+bigquery = LazyModule("google.cloud.bigquery")
+# バックグラウンド warmup で先に読み込んでおくモジュール
+LAZY_MODULES = [pd, pandas_gbq, genai, firebase_admin, google_auth, bigquery]
+
 # ─────────────────────────────────────────────
 # 1. モデル向けパラメータを "全部入り" で保持する dataclass
 # ─────────────────────────────────────────────
@@ -47,8 +72,8 @@ class GeminiOptions:
     response_mime_type: Optional[str] = "application/json"
     response_schema: Optional[Dict[str, Any]] = None
 
-    def to_generation_config(self) -> GenerationConfig:
-        return GenerationConfig(
+    def to_generation_config(self) -> genai.GenerationConfig:
+        return genai.GenerationConfig(
             temperature        = self.temperature,
             top_p              = self.top_p,
             top_k              = self.top_k,
@@ -58,9 +83,358 @@ class GeminiOptions:
             presence_penalty   = self.presence_penalty or None,
             frequency_penalty  = self.frequency_penalty or None,
             response_mime_type = self.response_mime_type or None,
-            response_schema    = self.response_schema or None,
+            response_schema    = sdk_response_schema(self.response_schema) or None,
         )
     
+# ─────────────────────────────────────────────
+# 応答スキーマ（Gemini 用への変換と、事前コンパイルした検証）
+# ─────────────────────────────────────────────
+# Gemini の response_schema（OpenAPI のサブセット）が受け付けるキー
+_GEMINI_SCHEMA_KEYS = {"type", "format", "description", "nullable", "enum", "properties", "required", "items"}
+
+def _resolve_ref(schema: Dict[str, Any], root: Dict[str, Any]) -> Dict[str, Any]:
+    """"#/$defs/name" 形式の $ref をたどる"""
+    while "$ref" in schema:
+        node: Any = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            node = node[part]
+        schema = node
+    return schema
+
+def to_gemini_schema(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    JSON Schema を GeminiOptions.response_schema に渡せる形にする
+    （$ref を展開し、$schema / title / additionalProperties / minimum などの未対応のキーを除く）
+
+    Gemini は response_schema のキーを名前順で出力するため、properties の定義順を
+    propertyOrdering として付ける（ストリーミングで title から順に届くように）
+    """
+    root = root or schema
+    schema = _resolve_ref(schema, root)
+    converted: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key not in _GEMINI_SCHEMA_KEYS:
+            continue
+        if key == "properties":
+            value = {name: to_gemini_schema(prop, root) for name, prop in value.items()}
+            converted["propertyOrdering"] = list(value)
+        elif key == "items":
+            value = to_gemini_schema(value, root)
+        converted[key] = value
+    return converted
+
+def sdk_response_schema(schema: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    to_gemini_schema の結果を google-generativeai の protos.Schema が受け付ける形にする。
+    propertyOrdering は SDK の property_ordering に読み替え、それが無い版の SDK では除く
+    （その場合キーの順序は SYSTEM_PROMPT の指示だけに頼る）
+    """
+    if not isinstance(schema, dict):
+        return schema
+    protos = getattr(genai, "protos", None)
+    supported = protos is not None and "property_ordering" in protos.Schema.meta.fields
+    converted: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key == "propertyOrdering":
+            if supported:
+                converted["property_ordering"] = value
+            continue
+        if key == "properties":
+            value = {name: sdk_response_schema(prop) for name, prop in value.items()}
+        elif key == "items":
+            value = sdk_response_schema(value)
+        converted[key] = value
+    return converted
+
+class SchemaValidationError(ValueError):
+    """応答がスキーマに合わない（errors に場所ごとのメッセージを持つ）"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors[:5]))
+        self.errors = errors
+
+_JSON_TYPES: Dict[str, Tuple[type, ...]] = {
+    "object": (dict,),
+    "array": (list,),
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+}
+
+def compile_validator(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Callable[[Any], List[str]]:
+    """
+    JSON Schema（type / properties / required / additionalProperties / items / minItems / minimum / enum / $ref）を
+    検証関数に変換する。スキーマの解釈は1回だけで、検証は値をたどるだけになる
+
+    Returns
+    -------
+    Callable[[Any], List[str]]
+        値を受け取り、エラーメッセージ（"$.nutrition.kcal: ..." の形式）のリストを返す関数。空なら妥当
+    """
+    root = root or schema
+    schema = _resolve_ref(schema, root)
+    checks: List[Callable[[Any, str, List[str]], bool]] = []
+
+    if "type" in schema:
+        expected = schema["type"]
+        types = _JSON_TYPES[expected]
+
+        def check_type(value: Any, path: str, errors: List[str]) -> bool:
+            # bool は int のサブクラスなので数値としては扱わない
+            if not isinstance(value, types) or (isinstance(value, bool) and expected != "boolean"):
+                errors.append(f"{path}: {expected} ではありません（{type(value).__name__}）")
+                return False
+            return True
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+
+        def check_enum(value: Any, path: str, errors: List[str]) -> bool:
+            if value not in allowed:
+                errors.append(f"{path}: {allowed} のいずれでもありません")
+            return True
+        checks.append(check_enum)
+
+    if "minimum" in schema:
+        minimum = schema["minimum"]
+
+        def check_minimum(value: Any, path: str, errors: List[str]) -> bool:
+            if isinstance(value, (int, float)) and value < minimum:
+                errors.append(f"{path}: {minimum} 未満です")
+            return True
+        checks.append(check_minimum)
+
+    if "properties" in schema or "required" in schema:
+        properties = {name: compile_validator(prop, root) for name, prop in schema.get("properties", {}).items()}
+        required = schema.get("required", [])
+        closed = schema.get("additionalProperties", True) is False
+
+        def check_object(value: Any, path: str, errors: List[str]) -> bool:
+            if not isinstance(value, dict):
+                return True
+            errors.extend(f"{path}.{name}: ありません" for name in required if name not in value)
+            for name, item in value.items():
+                if name in properties:
+                    errors.extend(properties[name](item, f"{path}.{name}"))
+                elif closed:
+                    errors.append(f"{path}.{name}: 定義にない項目です")
+            return True
+        checks.append(check_object)
+
+    if "items" in schema or "minItems" in schema:
+        item_validator = compile_validator(schema["items"], root) if "items" in schema else None
+        min_items = schema.get("minItems", 0)
+
+        def check_array(value: Any, path: str, errors: List[str]) -> bool:
+            if not isinstance(value, list):
+                return True
+            if len(value) < min_items:
+                errors.append(f"{path}: 要素が {min_items} 個未満です")
+            if item_validator is not None:
+                for i, item in enumerate(value):
+                    errors.extend(item_validator(item, f"{path}[{i}]"))
+            return True
+        checks.append(check_array)
+
+    def validate(value: Any, path: str = "$") -> List[str]:
+        errors: List[str] = []
+        for check in checks:
+            # 型が違う場合はそれ以降の検査をしない
+            if not check(value, path, errors):
+                break
+        return errors
+    return validate
+
+def json_text_validator(validate: Callable[[Any], List[str]]) -> Callable[[str], List[str]]:
+    """応答テキストを JSON として読んでから validate で検証する関数を返す（GeminiProcessor の validator 用）"""
+    def validate_text(text: str) -> List[str]:
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            return [f"$: JSON として読めません: {e}"]
+        return validate(data)
+    return validate_text
+
+# ─────────────────────────────────────────────
+# 応答キャッシュ（内容アドレス + LRU + TTL）
+# ─────────────────────────────────────────────
+def make_cache_key(
+    model_name: str,
+    options: Dict[str, Any],
+    system_prompt: Any,
+    human_prompt: Any,
+) -> str:
+    """(モデル名, 生成設定, system-prompt, human-prompt) の SHA-256 をキーにする"""
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "options": options,
+            "system": None if pd.isna(system_prompt) else str(system_prompt),
+            "human": str(human_prompt),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """プロセス内 LRU + TTL キャッシュ"""
+
+    def __init__(self, max_entries: int = 1024, ttl_sec: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            created_at, value = entry
+            if time.time() - created_at > self.ttl_sec:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class SQLiteCacheBackend:
+    """ローカルディスク（SQLite）上の LRU + TTL キャッシュ"""
+
+    # get / set がディスク I/O を伴う（非同期の呼び出し元ではスレッドで実行する）
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl_sec: float = 86400):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_sec:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            # 期限切れと、上限を超えた古いアクセス順のエントリを削除
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_sec,)
+            )
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                " SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+
+class ResponseCache:
+    """バックエンドを差し替え可能なキャッシュ。ヒット/ミス数を数える"""
+
+    def __init__(self, backend: Any):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self.backend.set(key, value)
+
+    async def get_async(self, key: str) -> Optional[str]:
+        """get の asyncio 版（ディスクを読むバックエンドはスレッドで実行し、イベントループを止めない）"""
+        if getattr(self.backend, "blocking", False):
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def set_async(self, key: str, value: str) -> None:
+        """set の asyncio 版"""
+        if getattr(self.backend, "blocking", False):
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """
+    環境変数からキャッシュを作成する
+
+    GEMINI_CACHE_BACKEND      : none（既定）/ memory / sqlite
+                                生成結果は毎回異なるため、同じ入力に同じ応答を返してよいデプロイでだけ明示的に有効にする
+    GEMINI_CACHE_PATH         : sqlite のファイルパス（既定: gemini_cache.sqlite3）
+    GEMINI_CACHE_MAX_ENTRIES  : 最大エントリ数（既定: 1024）
+    GEMINI_CACHE_TTL_SEC      : 有効期限秒（既定: 3600）
+    """
+    backend_name = os.getenv("GEMINI_CACHE_BACKEND", "none").lower()
+    max_entries = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "1024"))
+    ttl_sec = float(os.getenv("GEMINI_CACHE_TTL_SEC", "3600"))
+    if backend_name == "none":
+        return None
+    if backend_name == "sqlite":
+        path = os.getenv("GEMINI_CACHE_PATH", "gemini_cache.sqlite3")
+        return ResponseCache(SQLiteCacheBackend(path, max_entries=max_entries, ttl_sec=ttl_sec))
+    if backend_name == "memory":
+        return ResponseCache(MemoryCacheBackend(max_entries=max_entries, ttl_sec=ttl_sec))
+    raise ValueError(f"GEMINI_CACHE_BACKEND が不正です: {backend_name}")
+
+
 # ─────────────────────────────────────────────
 # 2. メインクラス
 # ─────────────────────────────────────────────
@@ -72,6 +446,8 @@ class GeminiProcessor:
         model_name: str = "models/gemini-2.5-flash-preview-05-20",
         options: GeminiOptions = GeminiOptions(),  
         project_id: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        validator: Optional[Callable[[str], List[str]]] = None,
     ):
         load_dotenv()
         api_key = os.getenv(api_key_env)
@@ -79,15 +455,103 @@ class GeminiProcessor:
             raise ValueError(f"{api_key_env} が設定されていません")
         genai.configure(api_key=api_key)
 
-        self.model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=options.to_generation_config(),
-            safety_settings=options.safety_settings,
-            system_instruction=options.system_instruction,
-            tools=options.tools,
-        )
+        self.model_name = model_name
         self.options = options
         self.project_id = project_id
+        self.cache = cache
+        # 応答テキストの検証（エラーのリストを返す）。エラーのある応答はキャッシュせず、キャッシュから返しもしない
+        self.validator = validator
+        # system_instruction ごとの GenerativeModel キャッシュ（行ごとの system-prompt で増え続けないよう、
+        # GEMINI_MODEL_CACHE_SIZE 個を超えたら最も長く使われていないものから捨てる）
+        self._models: "OrderedDict[Optional[str], genai.GenerativeModel]" = OrderedDict()
+        self._models_max = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "32"))
+        self._models_lock = threading.Lock()
+        self.model = self._get_model(options.system_instruction)
+
+    def _get_model(self, system_instruction: Optional[str]) -> genai.GenerativeModel:
+        """
+        system_instruction ごとに GenerativeModel を1度だけ生成して使い回す。
+        system-prompt を会話履歴ではなく system_instruction として渡すことで、
+        1行あたり generate_content 1回で済むようにする。
+        """
+        with self._models_lock:
+            model = self._models.get(system_instruction)
+            if model is None:
+                model = genai.GenerativeModel(
+                    model_name=self.model_name,
+                    generation_config=self.options.to_generation_config(),
+                    safety_settings=self.options.safety_settings,
+                    system_instruction=system_instruction,
+                    tools=self.options.tools,
+                )
+                self._models[system_instruction] = model
+                if len(self._models) > self._models_max:
+                    self._models.popitem(last=False)
+            else:
+                self._models.move_to_end(system_instruction)
+            return model
+
+    # ────────────────────────
+    # 1行分の Gemini 呼び出し
+    # ────────────────────────
+    def _select_model(self, system_prompt: Any) -> genai.GenerativeModel:
+        # 行に専用 system-prompt があれば system_instruction として上書き
+        if pd.notna(system_prompt) and system_prompt:
+            return self._get_model(str(system_prompt))
+        return self.model
+
+    def _cache_key(self, system_prompt: Any, human_prompt: Any) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return make_cache_key(self.model_name, asdict(self.options), system_prompt, human_prompt)
+
+    def _cacheable(self, text: str, log: bool = True) -> bool:
+        """validator を通る応答だけをキャッシュする（壊れた応答を同じプロンプトに返し続けないように）"""
+        if self.validator is None:
+            return True
+        errors = self.validator(text)
+        if errors and log:
+            print(f"応答がスキーマに合わないためキャッシュしません: {'; '.join(errors[:3])}")
+        return not errors
+
+    def _call_row(self, system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+        """
+        1行分のプロンプトで Gemini を呼び出し、(出力テキスト, 所要秒数) を返す。
+        例外は行単位で {"error": ...} の JSON 文字列に変換する。
+        """
+        start = time.perf_counter()
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                return cached, time.perf_counter() - start
+        try:
+            reply = self._select_model(system_prompt).generate_content(str(human_prompt))
+            text = reply.text
+            # エラー応答・スキーマに合わない応答はキャッシュしない
+            if cache_key is not None and self._cacheable(text):
+                self.cache.set(cache_key, text)
+        except Exception as e:
+            text = json.dumps({"error": str(e)})
+        return text, time.perf_counter() - start
+
+    async def _call_row_async(self, system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+        """_call_row の asyncio 版（generate_content_async を使用）"""
+        start = time.perf_counter()
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                return cached, time.perf_counter() - start
+        try:
+            model = self._select_model(system_prompt)
+            reply = await model.generate_content_async(str(human_prompt))
+            text = reply.text
+            if cache_key is not None and self._cacheable(text):
+                await self.cache.set_async(cache_key, text)
+        except Exception as e:
+            text = json.dumps({"error": str(e)})
+        return text, time.perf_counter() - start
 
     # ────────────────────────
     # DataFrame → Gemini 呼び出し
@@ -98,26 +562,95 @@ class GeminiProcessor:
         system_prompt_col: str = "systemprompt",
         human_prompt_col: str = "humanprompt",
         output_col: str = "output",
+        max_concurrency: int = 1,
+        latency_col: Optional[str] = "latency_sec",
     ) -> pd.DataFrame:
+        """
+        DataFrame の各行を Gemini に投げ、結果を output_col に格納する
+
+        Parameters
+        ----------
+        max_concurrency : int
+            同時に投げるリクエスト数。1 以下なら従来どおり逐次実行
+        latency_col : Optional[str]
+            行ごとの所要秒数を格納するカラム名。None なら出力しない
+        """
 
         if not {system_prompt_col, human_prompt_col}.issubset(df.columns):
             raise ValueError("必要なカラムがありません")
 
         res = df.copy()
-        res[output_col] = None
+        rows = list(zip(res[system_prompt_col], res[human_prompt_col]))
+
+        if max_concurrency <= 1 or len(rows) <= 1:
+            results = [self._call_row(sp, hp) for sp, hp in rows]
+        else:
+            # executor.map は入力順で結果を返すので行順はそのまま保たれる
+            with ThreadPoolExecutor(max_workers=min(max_concurrency, len(rows))) as executor:
+                results = list(executor.map(lambda r: self._call_row(*r), rows))
+
+        res[output_col] = [text for text, _ in results]
+        if latency_col:
+            res[latency_col] = [latency for _, latency in results]
+        return res
 
-        for idx, row in res.iterrows():
-            try:
-                chat = self.model.start_chat(history=[])
-                # 行に専用 system-prompt があれば上書き
-                if pd.notna(row[system_prompt_col]):
-                    chat.send_message(row[system_prompt_col])
-                reply = chat.send_message(str(row[human_prompt_col]))
-                res.at[idx, output_col] = reply.text
-            except Exception as e:
-                res.at[idx, output_col] = json.dumps({"error": str(e)})
+    async def process_dataframe_async(
+        self,
+        df: pd.DataFrame,
+        system_prompt_col: str = "systemprompt",
+        human_prompt_col: str = "humanprompt",
+        output_col: str = "output",
+        max_concurrency: int = 8,
+        latency_col: Optional[str] = "latency_sec",
+    ) -> pd.DataFrame:
+        """
+        process_dataframe の asyncio 版。スレッドを占有せず、
+        Semaphore で同時実行数を max_concurrency に抑えて待ち合わせる
+        """
+
+        if not {system_prompt_col, human_prompt_col}.issubset(df.columns):
+            raise ValueError("必要なカラムがありません")
+
+        res = df.copy()
+        rows = list(zip(res[system_prompt_col], res[human_prompt_col]))
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run(system_prompt: Any, human_prompt: Any) -> Tuple[str, float]:
+            async with semaphore:
+                return await self._call_row_async(system_prompt, human_prompt)
+
+        # gather は入力順で結果を返すので行順はそのまま保たれる
+        results = await asyncio.gather(*(run(sp, hp) for sp, hp in rows))
+
+        res[output_col] = [text for text, _ in results]
+        if latency_col:
+            res[latency_col] = [latency for _, latency in results]
         return res
 
+    async def stream_text_async(self, system_prompt: Any, human_prompt: Any) -> AsyncIterator[str]:
+        """
+        generate_content_async(stream=True) の出力をチャンクごとに返す。
+        キャッシュヒット時は全文を1チャンクで返す。例外は呼び出し側に伝播する
+        """
+        cache_key = self._cache_key(system_prompt, human_prompt)
+        if cache_key is not None:
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None and self._cacheable(cached, log=False):
+                yield cached
+                return
+        model = self._select_model(system_prompt)
+        response = await model.generate_content_async(str(human_prompt), stream=True)
+        chunks = []
+        async for chunk in response:
+            # finish_reason だけのチャンクなど、テキストを持たないものは読み飛ばす
+            if not chunk.parts:
+                continue
+            chunks.append(chunk.text)
+            yield chunk.text
+        text = "".join(chunks)
+        if cache_key is not None and self._cacheable(text):
+            await self.cache.set_async(cache_key, text)
+
 
 # スキーマ定義
 RESPONSE_SCHEMA = {
@@ -180,6 +713,10 @@ RESPONSE_SCHEMA = {
     }
 }
 
+# Gemini に渡す形（$ref を展開したもの）と、parse_menu_json で使う検証関数（どちらも読み込み時に1回だけ作る）
+GEMINI_RESPONSE_SCHEMA = to_gemini_schema(RESPONSE_SCHEMA)
+validate_meal_plan = compile_validator(RESPONSE_SCHEMA)
+
 # システムプロンプト
 SYSTEM_PROMPT = """
 あなたは「パーソナル栄養プランナーAI」です。
@@ -208,10 +745,6 @@ SYSTEM_PROMPT = """
         "carb_g": 45,      // 数値（g）
         "salt_g": 2.5      // 数値（g）
     }},
-    "instructions": [
-        "手順1",
-        "手順2"
-    ],
     "ingredients": [
         {{
             "name": "鶏胸肉",
@@ -228,6 +761,10 @@ SYSTEM_PROMPT = """
             "quantity": "100",
             "unit": "g"
         }}
+    ],
+    "instructions": [
+        "手順1",
+        "手順2"
     ]
 }}
 
@@ -235,6 +772,7 @@ SYSTEM_PROMPT = """
 - nutritionの値は必ず数値型で出力（単位は含めない）
 - ingredientsは必ずオブジェクトの配列として出力
 - total_time_minは必ず整数値で出力
+- キーは title, cuisine, total_time_min, nutrition, ingredients, instructions の順で出力
 """
 
 def setup_environment() -> None:
@@ -263,64 +801,141 @@ def create_processor() -> GeminiProcessor:
     GeminiProcessor
         設定済みのGeminiProcessorインスタンス
     """
-    schema_tool = {"type": "response_schema", "schema": RESPONSE_SCHEMA}
-
     opts = GeminiOptions(
         temperature=float(os.getenv('GEMINI_TEMPERATURE', '0.3')),
         max_output_tokens=int(os.getenv('GEMINI_MAX_OUTPUT_TOKENS', '10000')),
-        tools=None
-        # tools=[schema_tool]  # スキーマツールを設定
+        # 出力を MealPlan のスキーマに制約する（壊れた JSON や欠けた項目の応答を生成させない）
+        response_schema=GEMINI_RESPONSE_SCHEMA,
+    )
+
+    return GeminiProcessor(
+        options=opts,
+        cache=create_response_cache(),
+        # スキーマに合わない応答はキャッシュしない
+        validator=json_text_validator(validate_meal_plan),
     )
 
-    return GeminiProcessor(options=opts)
+# デモグラ情報を探す期間（日数）。この期間に無ければ全期間から探す
+DEMOGRAPHICS_LOOKBACK_DAYS = int(os.getenv("DEMOGRAPHICS_LOOKBACK_DAYS", "30"))
 
-def load_bigquery_data() -> pd.DataFrame:
+def load_bigquery_data(user_id: Optional[str] = None) -> pd.DataFrame:
     """
-    BigQueryからデータを読み込む
+    BigQueryから世帯のデモグラ情報（最新の created_at の全員分）を読み込む
+
+    Parameters
+    ----------
+    user_id : Optional[str]
+        世帯のユーザーID。user_id 列のある表ではこのユーザーの行を読み、
+        無ければ user_id の無い移行前の行から探す（ほかのユーザーの行は返さない）
 
     Returns
     -------
-    tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]
-        (demo, fridge_items, recipe_ingredients)のタプル
+    pd.DataFrame
+        demo の最新の created_at の行
     """
     project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
     dataset_name = os.getenv('BIGQUERY_DATASET')
 
     # テーブル名の設定
     demo_table = f'{project_name}.{dataset_name}.demo'
-    # fridge_items_table = f'{project_name}.{dataset_name}.fridge_items'
-    # recipe_ingredients_table = f'{project_name}.{dataset_name}.recipe_ingredients'
-
-    # サブクエリで最新のcreated_atだけ取得
-    demo_query = f"""
-        SELECT *
-        FROM `{demo_table}`
-        WHERE created_at = (
-            SELECT MAX(created_at)
-            FROM `{demo_table}`
-        )
-    """
-    # fridge_items_query = f"SELECT * FROM `{fridge_items_table}`"
-    # recipe_ingredients_query = f"SELECT * FROM `{recipe_ingredients_table}`"
 
-    # データの読み込み（pandas_gbqを使用）
-    demo = pandas_gbq.read_gbq(
-        demo_query.replace('\n', ' ').replace('\u3000', ''),
-        project_id=project_name,
-        dialect='standard'
+    # 列と型（移行前の表には user_id 列が無い）
+    columns = {field.name: field.field_type for field in registry.get("bigquery").get_table(demo_table).schema}
+    # 移行前の表では created_at が ISO 8601 の STRING のため、読める値だけを TIMESTAMP にして比べる
+    if columns.get("created_at") == "TIMESTAMP":
+        created_at = "created_at"
+    else:
+        created_at = "SAFE.PARSE_TIMESTAMP('%Y-%m-%dT%H:%M:%E*S%Ez', created_at)"
+    periods = (
+        f"{created_at} >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {DEMOGRAPHICS_LOOKBACK_DAYS} DAY)",
+        f"{created_at} IS NOT NULL",
     )
-    # fridge_items = pandas_gbq.read_gbq(
-    #     fridge_items_query.replace('\n', ' ').replace('\u3000', ''),
-    #     project_id=project_name,
-    #     dialect='standard'
-    # )
-    # recipe_ingredients = pandas_gbq.read_gbq(
-    #     recipe_ingredients_query.replace('\n', ' ').replace('\u3000', ''),
-    #     project_id=project_name,
-    #     dialect='standard'
-    # )
-
-    return demo #  ,fridge_items, recipe_ingredients
+
+    def read(where: str, configuration: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+        # サブクエリで最新のcreated_atだけ取得（created_at のパーティションで直近だけを読み、見つからなければ全期間から探す）
+        for period in periods:
+            demo = pandas_gbq.read_gbq(
+                f"SELECT * FROM `{demo_table}` WHERE {where} AND {period} AND {created_at} = "
+                f"(SELECT MAX({created_at}) FROM `{demo_table}` WHERE {where} AND {period})",
+                project_id=project_name,
+                dialect='standard',
+                configuration=configuration,
+            )
+            if not demo.empty:
+                break
+        return demo
+
+    if user_id is None or "user_id" not in columns:
+        return read("TRUE")
+    demo = read("user_id = @user_id", {"query": {"parameterMode": "NAMED", "queryParameters": [{
+        "name": "user_id",
+        "parameterType": {"type": "STRING"},
+        "parameterValue": {"value": user_id},
+    }]}})
+    if demo.empty:
+        demo = read("user_id IS NULL")
+    return demo
+
+# ─────────────────────────────────────────────
+# デモグラ情報のキャッシュ
+# ─────────────────────────────────────────────
+class DemographicsCache:
+    """
+    世帯のデモグラ情報（load_bigquery_data(user_id) の結果）を user_id ごとに TTL 付きでメモリに保持する。
+    入力フォームが新しいプロフィールを書き込んだら /invalidate_demographics で破棄する
+
+    Notes
+    -----
+    キャッシュはインスタンスごとに持つため、破棄の通知が届かなかったインスタンスでも
+    ttl_sec を過ぎれば読み直される
+    """
+
+    def __init__(self, loader: Callable[[str], pd.DataFrame], ttl_sec: float = 300):
+        self.loader = loader
+        self.ttl_sec = ttl_sec
+        self._entries: Dict[str, Tuple[float, pd.DataFrame]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str) -> pd.DataFrame:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_sec:
+                self.hits += 1
+                return entry[1].copy()
+            self.misses += 1
+            generation = self._generation
+        demo = self.loader(user_id)
+        with self._lock:
+            # 読み込み中に破棄された場合は古いプロフィールの可能性があるため保存しない
+            if generation == self._generation:
+                self._entries[user_id] = (time.monotonic(), demo)
+        return demo.copy()
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        """user_id のキャッシュを破棄する（省略時はすべて）"""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+# DEMOGRAPHICS_CACHE_TTL_SEC: キャッシュの有効秒数（既定 300、0 でキャッシュしない）
+demographics_cache = DemographicsCache(
+    load_bigquery_data,
+    ttl_sec=float(os.getenv("DEMOGRAPHICS_CACHE_TTL_SEC", "300")),
+)
+
+def get_demographics(user_id: Optional[str] = None) -> pd.DataFrame:
+    """デモグラ情報をキャッシュ経由で取得する"""
+    return demographics_cache.get(user_id or os.getenv("DEFAULT_USER_ID", "user_001"))
 
 def generate_menu(processor: GeminiProcessor, human_prompt: str) -> pd.DataFrame:
     """
@@ -354,6 +969,85 @@ def generate_menu(processor: GeminiProcessor, human_prompt: str) -> pd.DataFrame
 
     return result_df
 
+async def generate_menu_async(processor: GeminiProcessor, human_prompt: str) -> pd.DataFrame:
+    """
+    generate_menu の asyncio 版（イベントループをブロックしない）
+    """
+    df = pd.DataFrame({
+        "human_prompt": [human_prompt],
+        "system_prompt": [SYSTEM_PROMPT]
+    })
+    return await processor.process_dataframe_async(
+        df,
+        human_prompt_col="human_prompt",
+        system_prompt_col="system_prompt",
+        output_col="output"
+    )
+
+class MenuStreamParser:
+    """
+    ストリーミング中のメニューJSONを少しずつ受け取り、
+    値が確定したトップレベルのフィールド（title, nutrition, ingredients ...）を順に取り出す
+    """
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key: Optional[str] = None
+        self._key_start: Optional[int] = None
+        self._value_start: Optional[int] = None
+
+    def _finish_value(self, end: int, completed: List[Tuple[str, Any]]) -> None:
+        if self._key is not None and self._value_start is not None:
+            try:
+                value = json.loads(self.buffer[self._value_start:end])
+            except json.JSONDecodeError:
+                value = None
+            if value is not None:
+                self.fields[self._key] = value
+                completed.append((self._key, value))
+        self._key = None
+        self._value_start = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """チャンクを追加し、新たに確定した (キー, 値) のリストを返す"""
+        self.buffer += chunk
+        completed: List[Tuple[str, Any]] = []
+        for i in range(self._pos, len(self.buffer)):
+            ch = self.buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(self.buffer[self._key_start:i + 1])
+                        self._key_start = None
+                continue
+            if ch == '"':
+                self._in_string = True
+                # トップレベルで値を待っていない文字列はキー
+                if self._depth == 1 and self._key is None:
+                    self._key_start = i
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 1:
+                    self._finish_value(i, completed)
+                self._depth -= 1
+            elif ch == ":" and self._depth == 1 and self._key is not None:
+                self._value_start = i + 1
+            elif ch == "," and self._depth == 1:
+                self._finish_value(i, completed)
+        self._pos = len(self.buffer)
+        return completed
+
 def parse_menu_json(raw_json: str | dict) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     メニューJSONを
@@ -372,8 +1066,16 @@ def parse_menu_json(raw_json: str | dict) -> tuple[pd.DataFrame, pd.DataFrame, p
     -------
     tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]
         (header_df, nutrition_df, ingredients_df, instructions_df)のタプル
+
+    Raises
+    ------
+    SchemaValidationError
+        MealPlan のスキーマに合わない場合（DataFrame を作る前に検出する）
     """
     data = raw_json if isinstance(raw_json, dict) else json.loads(raw_json)
+    errors = validate_meal_plan(data)
+    if errors:
+        raise SchemaValidationError(errors)
 
     # ヘッダー情報
     header_df = pd.DataFrame([{
@@ -396,114 +1098,98 @@ def parse_menu_json(raw_json: str | dict) -> tuple[pd.DataFrame, pd.DataFrame, p
 
     return header_df, nutrition_df, ingredients_df, instructions_df
 
-def save_to_bigquery(
-    header_df: pd.DataFrame,
-    nutrition_df: pd.DataFrame,
-    ingredients_df: pd.DataFrame,
-    instructions_df: pd.DataFrame,
-    user_id: str = None
-) -> None:
-    """
-    生成したメニューをBigQueryに保存する
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse, JSONResponse
+from pydantic import BaseModel
+from fastapi.middleware.cors import CORSMiddleware
 
-    Parameters
-    ----------
-    header_df : pd.DataFrame
-        メニュー基本情報
-    nutrition_df : pd.DataFrame
-        栄養情報
-    ingredients_df : pd.DataFrame
-        材料情報
-    instructions_df : pd.DataFrame
-        調理手順
-    user_id : str, optional
-        ユーザーID, by default None (環境変数から取得)
+# ─────────────────────────────────────────────
+# プロセス共有のクライアント
+# ─────────────────────────────────────────────
+class ClientRegistry:
     """
-    project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
-    dataset_name = os.getenv('BIGQUERY_DATASET')
-    user_id = user_id or os.getenv('DEFAULT_USER_ID', 'user_001')
-
-    # 現在時刻（UTC）
-    now = datetime.now(timezone.utc)
-
-    # メニューテーブル用のデータ作成
-    menu_data = {
-        "menu_id": [f"menu_{now.strftime('%Y%m%d_%H%M%S')}"],
-        "user_id": [user_id],
-        "created_at": [now],
-        **header_df.iloc[0].to_dict(),
-        **nutrition_df.iloc[0].to_dict()
-    }
-    menu_df = pd.DataFrame(menu_data)
-
-    # 材料テーブル用のデータ作成
-    ingredients_data = ingredients_df.copy()
-    ingredients_data["menu_id"] = menu_df["menu_id"].iloc[0]
-    ingredients_data["created_at"] = now
-
-    # 手順テーブル用のデータ作成
-    instructions_data = instructions_df.copy()
-    instructions_data["menu_id"] = menu_df["menu_id"].iloc[0]
-    instructions_data["created_at"] = now
-
-    # BigQueryテーブル名
-    menu_table = f"{project_name}.{dataset_name}.menus"
-    ingredients_table = f"{project_name}.{dataset_name}.menu_ingredients"
-    instructions_table = f"{project_name}.{dataset_name}.menu_instructions"
-
-    # データの保存
-    pandas_gbq.to_gbq(menu_df, menu_table, project_id=project_name, if_exists="append")
-    pandas_gbq.to_gbq(ingredients_data, ingredients_table, project_id=project_name, if_exists="append")
-    pandas_gbq.to_gbq(instructions_data, instructions_table, project_id=project_name, if_exists="append")
-
-def update_inventory(
-    ingredients_df: pd.DataFrame,
-    user_id: str = None
-) -> None:
+    メニュー生成の GeminiProcessor と BigQuery クライアントをプロセス内で1つずつ保持する。
+    起動時（lifespan）に warmup し、/readyz で状態を返す
     """
-    材料在庫を更新する
 
-    Parameters
-    ----------
-    ingredients_df : pd.DataFrame
-        使用した材料情報
-    user_id : str, optional
-        ユーザーID, by default None (環境変数から取得)
-    """
-    project_name = os.getenv('GOOGLE_CLOUD_PROJECT')
-    dataset_name = os.getenv('BIGQUERY_DATASET')
-    user_id = user_id or os.getenv('DEFAULT_USER_ID', 'user_001')
-
-    # 現在時刻（UTC）
-    now = datetime.now(timezone.utc)
-
-    # 在庫更新履歴テーブル用のデータ作成
-    inventory_updates = []
-    for _, row in ingredients_df.iterrows():
-        # 数値に変換可能な数量のみ処理
-        try:
-            quantity = float(str(row["quantity"]).replace("g", "").replace("ml", ""))
-            inventory_updates.append({
-                "user_id": user_id,
-                "ingredient_name": row["name"],
-                "quantity_change": -quantity,  # 使用した分を減らす
-                "unit": row["unit"],
-                "created_at": now
-            })
-        except (ValueError, TypeError):
-            continue  # 数値に変換できない場合はスキップ
-
-    if inventory_updates:
-        inventory_df = pd.DataFrame(inventory_updates)
-        inventory_table = f"{project_name}.{dataset_name}.inventory_updates"
-        pandas_gbq.to_gbq(inventory_df, inventory_table, project_id=project_name, if_exists="append")
+    def __init__(self) -> None:
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+        self.errors: Dict[str, str] = {}
+        self.timings: Dict[str, float] = {}
+        self.ready = False
+        self.warmed_up = False
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        self._factories[name] = factory
+
+    def get(self, name: str) -> Any:
+        if name not in self._instances:
+            with self._lock:
+                if name not in self._instances:
+                    self._instances[name] = self._factories[name]()
+        return self._instances[name]
+
+    def warmup(self) -> None:
+        """登録済みのクライアントをすべて生成する（失敗したものは errors に記録し、次回の get で再試行）"""
+        for name in self._factories:
+            started = time.perf_counter()
+            try:
+                self.get(name)
+                self.errors.pop(name, None)
+            except Exception as e:
+                print(f"{name} の初期化に失敗しました: {str(e)}")
+                self.errors[name] = str(e)
+            self.timings[name] = round(time.perf_counter() - started, 3)
+        self.ready = not self.errors
+        self.warmed_up = True
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "clients": sorted(self._instances), "errors": self.errors}
+
+def create_bigquery_client() -> bigquery.Client:
+    """BigQuery クライアントを生成し、pandas_gbq も同じ認証情報を使うよう設定する"""
+    credentials, default_project = google_auth.default(
+        scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    project = os.getenv("GOOGLE_CLOUD_PROJECT") or default_project
+    # pandas_gbq の呼び出しごとに行われる認証情報の探索を省く
+    pandas_gbq.context.credentials = credentials
+    pandas_gbq.context.project = project
+    return bigquery.Client(project=project, credentials=credentials)
 
+setup_environment()
+registry = ClientRegistry()
+registry.register("processor", create_processor)
+registry.register("bigquery", create_bigquery_client)
+
+
+def warmup() -> None:
+    """重いモジュールの読み込みとクライアント生成を行い、所要時間を起動レポートとして出力する"""
+    started = time.perf_counter()
+    for module in LAZY_MODULES:
+        module_started = time.perf_counter()
+        module.load()
+        registry.timings[f"import:{module._name}"] = round(time.perf_counter() - module_started, 3)
+    registry.warmup()
+    print(json.dumps({
+        "startup_report": {
+            "module_load_sec": round(MODULE_LOADED - MODULE_LOAD_STARTED, 3),
+            "warmup_sec": round(time.perf_counter() - started, 3),
+            "breakdown_sec": registry.timings,
+        }
+    }, ensure_ascii=False))
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from fastapi.middleware.cors import CORSMiddleware
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warmup はバックグラウンドで行い、ポートの待ち受けを先に始める（準備状況は /readyz で確認）
+    warmup_task = asyncio.create_task(asyncio.to_thread(warmup))
+    yield
+    warmup_task.cancel()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -512,36 +1198,83 @@ app.add_middleware(
     allow_headers=["*"],
 ) # テスト用のCORSを許可
 
-setup_environment()
-processor = create_processor()
 
 class MenuRequest(BaseModel):
     prompt: str
 
-@app.post("/generate")
-def generate_menu_endpoint(req: MenuRequest):
+# ─────────────────────────────────────────────
+# 呼び出し元の認証（Firebase ID トークン）
+# ─────────────────────────────────────────────
+# ID トークンの検証専用の Firebase アプリ名（Storage 用の既定アプリの設定には触れない）
+ID_TOKEN_APP = "id-token-verifier"
+_id_token_app_lock = threading.Lock()
+
+def verify_firebase_user(authorization: Optional[str]) -> str:
     """
-    メイン処理
+    Authorization: Bearer <Firebase ID トークン> を検証して uid を返す（無い・不正な場合は 401）
     """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Firebase の ID トークンが必要です")
+    from firebase_admin import auth
+    with _id_token_app_lock:
+        try:
+            verifier = firebase_admin.get_app(ID_TOKEN_APP)
+        except ValueError:
+            verifier = firebase_admin.initialize_app(
+                options={"projectId": os.getenv("FIREBASE_PROJECT_ID") or os.getenv("GOOGLE_CLOUD_PROJECT")},
+                name=ID_TOKEN_APP,
+            )
     try:
-        # データ読み込み
-        demo = load_bigquery_data()
-        num_people = len(demo)
-
-        # ユーザーごとの属性まとめ
-        people_desc = []
-        for _, row in demo.iterrows():
-            dstyle = row.get("dietary_style", "")
-            gender = row.get("gender", "")
-            age = row.get("age", "")
-            line = f"・性別: {gender}、年齢: {age}"
-            if pd.notna(dstyle) and dstyle:
-                line += f"、食事スタイル: {dstyle}"
-            people_desc.append(line)
-        people_block = "\n".join(people_desc)
-
-        # プロンプト生成
-        human_prompt = f"""
+        return auth.verify_id_token(authorization[len("Bearer "):], app=verifier)["uid"]
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"ID トークンの検証に失敗しました: {e}")
+
+class InvalidateDemographicsRequest(BaseModel):
+    user_id: Optional[str] = None
+
+@app.post("/invalidate_demographics")
+async def invalidate_demographics(
+    req: InvalidateDemographicsRequest,
+    authorization: Optional[str] = Header(None),
+):
+    """
+    入力フォームが新しいプロフィールを書き込んだときに呼ぶ。
+    ID トークンのユーザーのキャッシュだけを破棄する（ほかのユーザーの user_id を指定した場合は 403）
+    """
+    user_id = await asyncio.to_thread(verify_firebase_user, authorization)
+    if req.user_id is not None and req.user_id != user_id:
+        raise HTTPException(status_code=403, detail="ほかのユーザーのキャッシュは破棄できません")
+    demographics_cache.invalidate(user_id)
+    return {"result": "ok", "cache": demographics_cache.stats()}
+
+@app.get("/readyz")
+async def readyz():
+    """レディネスプローブ。warmup 中は 503、初期化に失敗したクライアントがあれば再試行する"""
+    if registry.warmed_up and not registry.ready:
+        await asyncio.to_thread(registry.warmup)
+    status = registry.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+def build_human_prompt(demo: pd.DataFrame) -> str:
+    """
+    デモグラ情報からメニュー生成用のプロンプトを作成する
+    """
+    num_people = len(demo)
+
+    # ユーザーごとの属性まとめ
+    people_desc = []
+    for _, row in demo.iterrows():
+        dstyle = row.get("dietary_style", "")
+        gender = row.get("gender", "")
+        age = row.get("age", "")
+        line = f"・性別: {gender}、年齢: {age}"
+        if pd.notna(dstyle) and dstyle:
+            line += f"、食事スタイル: {dstyle}"
+        people_desc.append(line)
+    people_block = "\n".join(people_desc)
+
+    # プロンプト生成
+    return f"""
         以下の条件で {num_people}人分のメニューを生成してください：
         ## 対象者の情報
         {people_block}
@@ -551,8 +1284,25 @@ def generate_menu_endpoint(req: MenuRequest):
         - 栄養バランスを考慮
         """
 
+def sse_event(event: str, data: Any) -> str:
+    """Server-Sent Events の1イベント分の文字列を作る"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.post("/generate")
+async def generate_menu_endpoint(req: MenuRequest, authorization: Optional[str] = Header(None)):
+    """
+    メイン処理
+    """
+    # 世帯は ID トークンの uid で決める（ボディの user_id は信用しない）
+    user_id = await asyncio.to_thread(verify_firebase_user, authorization)
+    try:
+        processor = await asyncio.to_thread(registry.get, "processor")
+        # データ読み込み（キャッシュになければ BigQuery から読む。同期処理のためスレッドで実行）
+        demo = await asyncio.to_thread(get_demographics, user_id)
+        human_prompt = build_human_prompt(demo)
+
         # Gemini呼び出し
-        result_df = generate_menu(processor, human_prompt)
+        result_df = await generate_menu_async(processor, human_prompt)
         header_df, nutrition_df, ingredients_df, instructions_df = parse_menu_json(result_df.loc[0, "output"])
         # # 結果の表示
         # print("\n=== 生成されたメニュー ===")
@@ -572,4 +1322,46 @@ def generate_menu_endpoint(req: MenuRequest):
             "instructions": instructions_df.to_dict(orient="records"),
         }
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/generate_stream")
+async def generate_menu_stream_endpoint(req: MenuRequest, authorization: Optional[str] = Header(None)):
+    """
+    /generate のストリーミング版（Server-Sent Events）
+
+    生成中のJSONを逐次パースし、値が確定したセクションから
+    title → cuisine → total_time_min → nutrition → ingredients → instructions の順に
+    イベントとして送る。最後に /generate と同じ形の "done"、失敗時は "error" を送る
+    """
+    # ストリームを始める前に認証する（失敗はイベントではなく 401 で返す）
+    user_id = await asyncio.to_thread(verify_firebase_user, authorization)
+
+    async def events():
+        try:
+            processor = await asyncio.to_thread(registry.get, "processor")
+            demo = await asyncio.to_thread(get_demographics, user_id)
+            human_prompt = build_human_prompt(demo)
+
+            parser = MenuStreamParser()
+            async for chunk in processor.stream_text_async(SYSTEM_PROMPT, human_prompt):
+                for key, value in parser.feed(chunk):
+                    yield sse_event(key, value)
+
+            header_df, nutrition_df, ingredients_df, instructions_df = parse_menu_json(parser.buffer)
+            yield sse_event("done", {
+                "header": header_df.to_dict(orient="records"),
+                "nutrition": nutrition_df.to_dict(orient="records"),
+                "ingredients": ingredients_df.to_dict(orient="records"),
+                "instructions": instructions_df.to_dict(orient="records"),
+            })
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# モジュール読み込みの完了時刻（起動レポート用）
+MODULE_LOADED = time.perf_counter()